@@ -0,0 +1,79 @@
+# Micro-benchmark for the instruction dispatch of compiled code.
+#
+# Runs the compiled aggregation programs from test/test_basic.py
+# (test_compiler3 and test_compiler5) and reports how many compiled
+# instructions are executed per second.  The recursive fib program can not
+# currently be compiled (see test_compiler6), so it is not included.
+#
+# usage: python benchmarks/compiled_dispatch.py [repeats]
+
+import sys
+import time
+
+from dyna import *
+from dyna import compiler
+from dyna.interpreter import VariableId
+
+
+def define_programs():
+    srange = Aggregator(interpreter.ret_variable, variables_named(0,1), VariableId('RR'), AggregatorOpImpl(lambda a,b:a+b),
+                        dyna_system.call_term('range', 3)(VariableId('RR'), 0, 1))
+    dyna_system.define_term('bench_range', 2, srange)
+
+    srange5 = Aggregator(interpreter.ret_variable, variables_named(0,1), VariableId('RR'), AggregatorOpImpl(lambda a,b:a+b),
+                         Partition(variables_named(0,1,'RR'),
+                                   [
+                                       Intersect(dyna_system.call_term('*', 2)(1, constant(2), ret='mm'),
+                                                 dyna_system.call_term('range', 3)(VariableId('RR'), 0, 'mm'),
+                                                 dyna_system.call_term('<', 2)(VariableId('RR'), constant(8))),
+                                       Intersect(dyna_system.call_term('range', 3)(VariableId('RR'), 0, 1),
+                                                 dyna_system.call_term('>', 2)(VariableId('RR'), constant(5))),
+                                   ]))
+    dyna_system.define_term('bench_range_partition', 2, srange5)
+
+    programs = []
+    for name in ('bench_range', 'bench_range_partition'):
+        dyna_system._optimize_term((name, 2))
+        dyna_system._compile_term((name, 2), set(variables_named(0,1)))
+        ce = dyna_system.terms_as_compiled[(name, 2)]
+        # the compiled code takes its arguments in the order of ce.variable_order
+        values = {VariableId(0): 0, VariableId(1): 1000}
+        arguments = tuple(values.get(v) for v in ce.variable_order)
+        mode = tuple(a is not None for a in arguments)
+        programs.append((name, ce.compiled_expressions[mode], arguments))
+    return programs
+
+
+def count_instructions(program, arguments):
+    count = 0
+    handlers = compiler._OPERATION_HANDLERS
+    saved = list(handlers)
+    def counting(handler):
+        def f(state, data, pc):
+            nonlocal count
+            count += 1
+            return handler(state, data, pc)
+        return f
+    handlers[:] = [counting(h) for h in saved]
+    try:
+        program.execute_operations(arguments)
+    finally:
+        handlers[:] = saved
+    return count
+
+
+def main(repeats=50):
+    for name, program, arguments in define_programs():
+        ninstrs = count_instructions(program, arguments)
+        # report the best of a few trials as the timings are noisy
+        elapsed = float('inf')
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                program.execute_operations(arguments)
+            elapsed = min(elapsed, time.perf_counter() - start)
+        print(f'{name}: {ninstrs} instructions per run, {ninstrs * repeats / elapsed:,.0f} instructions/sec')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
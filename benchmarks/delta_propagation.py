@@ -0,0 +1,65 @@
+# Benchmark for the propagation of updates through `+=` memo tables.
+#
+#   w(X) = 3 for X in 0..N
+#   g(X) += e(X) * w(X).
+#   total += g(X).
+#
+# After the tables have converged, single entries of e are updated.  With
+# deltas (semi-naive evaluation), the update to total only combines the
+# change of g(X) into the stored sum, rather than recomputing the sum over all
+# of g.  The same program is also run with the deltas disabled by marking `+=`
+# as not invertible.
+#
+# usage: python benchmarks/delta_propagation.py [N] [updates]
+
+import random
+import sys
+import time
+
+from dyna import Frame, Terminal, saturate, interpreter
+from dyna.aggregators import AGGREGATORS
+from dyna.context import SystemContext
+
+
+def run(n, updates):
+    system = SystemContext()
+    system.add_rules(' '.join(f'e({i}) += {i}.' for i in range(n)) + f"""
+    w(X) = 3 for range(X, 0, {n}).
+    g(X) += e(X) * w(X).
+    total += g(X).
+    """)
+    for name in [('e', 1), ('w', 1), ('g', 1), ('total', 0)]:
+        system.memoize_term(name, 'null')
+    system.run_agenda()
+
+    rand = random.Random(0)
+    expected = [3*i for i in range(n)]
+    start = time.perf_counter()
+    for _ in range(updates):
+        i = rand.randrange(n)
+        expected[i] += 3
+        system.add_rules(f'e({i}) += 1.')
+        system.run_agenda()
+    elapsed = time.perf_counter() - start
+
+    frame = Frame()
+    assert saturate(system.call_term('total', 0), frame) == Terminal(1)
+    assert interpreter.ret_variable.getValue(frame) == sum(expected)
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    agg = AGGREGATORS['+=']
+    for name, invertible in [('refresh', False), ('delta', True)]:
+        agg.invertible = invertible
+        try:
+            elapsed = run(n, updates)
+        finally:
+            agg.invertible = True
+        print(f'{name:8} {elapsed / updates * 1000:8.2f} ms/update')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# Loading N facts into a table which a memoized term reads
+#
+#   deg(X) += 1 for edge(X, Y).
+#
+# once with a `table[x, y] = True` for each fact (which adds and invalidates
+# the table once for each of them), and once with a single table.load of a
+# numpy array (see fact_loading.py).
+#
+# usage: python benchmarks/fact_loading.py [N]
+
+import sys
+import time
+
+import numpy as np
+
+from dyna.api import DynaAPI
+
+
+def run(n, bulk):
+    api = DynaAPI('deg(X) += 1 for edge(X, Y).')
+    edge = api.table('edge', 2)
+    api._system.memoize_term(('deg', 1), 'null')
+    rng = np.random.default_rng(0)
+    rows = np.column_stack((rng.integers(0, n // 10, n), np.arange(n), np.ones(n, dtype=np.int64)))
+
+    start = time.perf_counter()
+    if bulk:
+        edge.load(rows)
+    else:
+        for x, y, v in rows.tolist():
+            edge[x, y] = v
+    api._system.run_agenda()
+    elapsed = time.perf_counter() - start
+    total = sum(v for _, v in api.make_call('deg(%)'))
+    assert total == n
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f'{n} facts')
+    print(f'  per fact  {run(n, False):8.3f}s')
+    print(f'  load      {run(n, True):8.3f}s')
+
+
+if __name__ == '__main__':
+    main()
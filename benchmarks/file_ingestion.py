@@ -0,0 +1,55 @@
+# Loading the rows of a csv file as the facts of a memoized term
+#
+#   out_deg(X) += 1 for edge(X, Y).
+#
+# once by turning each row into a fact of dyna source (`edge(x, y).`) and
+# adding the text with add_rules, and once with load_file, which streams the
+# rows in chunks into typed columns (see fact_loading.py).  The time and peak
+# memory allocated by python (tracemalloc) to add the facts are reported, and
+# then the time to compute out_deg from them.
+#
+# usage: python benchmarks/file_ingestion.py [ROWS]
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dyna.context import SystemContext
+
+
+def run(path, streaming):
+    system = SystemContext()
+    system.add_rules('out_deg(X) += 1 for edge(X, Y).')
+    tracemalloc.start()
+    start = time.perf_counter()
+    if streaming:
+        system.load_file(path, 'edge')
+    else:
+        with open(path) as f:
+            system.add_rules(''.join(f'edge({line.strip()}).\n' for line in f))
+    ingest = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    system.memoize_term(('out_deg', 1), 'null')
+    system.run_agenda()
+    return ingest, peak, time.perf_counter() - start
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'edges.csv')
+        with open(path, 'w') as f:
+            for i in range(rows):
+                f.write(f'{i % 1000},{i}\n')
+        print(f'{rows} rows')
+        for name, streaming in (('add_rules', False), ('load_file', True)):
+            ingest, peak, query = run(path, streaming)
+            print(f'  {name:10} add {ingest:8.3f}s  peak {peak / 2**20:8.1f} MiB   out_deg {query:8.3f}s')
+
+
+if __name__ == '__main__':
+    main()
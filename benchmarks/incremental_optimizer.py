@@ -0,0 +1,52 @@
+# Optimizing a term which is defined by many rules, and then optimizing it
+# again after one more rule is added to it.
+#
+#   f(X) += g(X, i) * i for int(X).    for i in 0..N-1
+#
+# With SystemContext(incremental_optimizer=True) the branches of f are
+# optimized one at a time and only the new branch is optimized after the rule
+# is added.  Otherwise the optimizer runs over the whole body both times.
+#
+# usage: python benchmarks/incremental_optimizer.py [N]
+
+import sys
+import time
+
+from dyna import interpreter, Frame, saturate
+from dyna.context import SystemContext
+
+
+def run(n, incremental):
+    system = SystemContext(incremental_optimizer=incremental)
+    system.add_rules('g(X, Y) = X + Y. ' + ' '.join(f'f(X) += g(X, {i}) * {i} for int(X).' for i in range(n)))
+
+    start = time.perf_counter()
+    system._optimize_term(('f', 1))
+    first = time.perf_counter() - start
+
+    system.add_rules('f(X) += 1 for int(X).')
+    if incremental:
+        system.optimizer_cache.reset_counters()
+    start = time.perf_counter()
+    system._optimize_term(('f', 1))
+    again = time.perf_counter() - start
+    counters = system.optimizer_counters()
+    system.run_agenda()
+
+    frame = Frame()
+    frame[0] = 3
+    saturate(system.call_term('f', 1), frame)
+    return first, again, interpreter.ret_variable.getValue(frame), counters
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    expected = sum((3 + i) * i for i in range(n)) + 1
+    for name, incremental in [('whole body', False), ('incremental', True)]:
+        first, again, value, counters = run(n, incremental)
+        assert value == expected
+        print(f'{name:12} first {first:8.3f}s  after adding a rule {again:8.3f}s  {counters}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+# Memory used by the storage of a ground memo table.
+#
+# A null memo table for something like `f(X) += ...` stores a row (X, value)
+# for each of the keys with the value [Terminal(1)].  This compares the number
+# of bytes per row used by the nested dicts of PrefixTrie with the typed
+# columns of ColumnarTrie (as measured by tracemalloc).
+#
+# usage: python benchmarks/memo_memory.py [rows]
+
+import sys
+import time
+import tracemalloc
+
+from dyna.interpreter import Terminal
+from dyna.prefix_trie import PrefixTrie, ColumnarTrie
+
+
+def fill(trie, rows, unit):
+    for i in range(rows):
+        trie[(i, i * .5)] = [unit]
+    return trie
+
+
+def measure(make, rows):
+    unit = Terminal(1)
+    tracemalloc.start()
+    start = time.perf_counter()
+    trie = fill(make(unit), rows, unit)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    total = sum(k[1] for k, v in trie)
+    scan = time.perf_counter() - start
+    assert total == sum(i * .5 for i in range(rows))
+    return size, elapsed, scan
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    for name, make in [('PrefixTrie', lambda unit: PrefixTrie(2)),
+                       ('ColumnarTrie', lambda unit: ColumnarTrie(2, unit))]:
+        size, elapsed, scan = measure(make, rows)
+        print(f'{name:14} {size / rows:8.1f} bytes/row   insert {elapsed:6.2f}s   scan {scan:6.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# One memo table which is read by many other memo tables, each of which only
+# reads the entries with a single value of the second argument.
+#
+#   base(I) for I < N
+#   src(I, J) += base(I) + J for range(J, 0, K).
+#   c_j(I) += src(I, j) * 2.          for j in 0..K-1
+#
+# The entries of base are then changed one at a time, which changes K entries
+# of src.  The signal for each of those is routed only to the consumer which
+# reads that key (see Assumption.track), instead of every consumer working out
+# that the change does not affect it.
+#
+# usage: python benchmarks/signal_routing.py [K] [N] [UPDATES]
+
+import sys
+import time
+
+from dyna.context import SystemContext
+
+
+def main():
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    updates = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    system = SystemContext()
+    system.add_rules(' '.join(f'base({i}) += {i}.' for i in range(n)))
+    system.add_rules(f'src(I, J) += base(I) + J for range(J, 0, {k}).')
+    system.add_rules(' '.join(f'c_{j}(I) += src(I, {j}) * 2.' for j in range(k)))
+    system.memoize_term(('base', 1), 'null')
+    system.memoize_term(('src', 2), 'null')
+    for j in range(k):
+        system.memoize_term((f'c_{j}', 1), 'null')
+    system.run_agenda()
+
+    src = system.memo_containers(('src', 2))[0]
+    print(f'{k} consumers, fan out of src: {src.assumption.fan_out()}')
+
+    start = time.perf_counter()
+    for u in range(updates):
+        system.add_rules(f'base({u % n}) += 1.')
+        system.run_agenda()
+    elapsed = time.perf_counter() - start
+    print(f'{updates} updates {elapsed:8.3f}s  {system.agenda.counters()}')
+
+
+if __name__ == '__main__':
+    main()
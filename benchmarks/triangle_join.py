@@ -0,0 +1,58 @@
+# Triangle query over a random directed graph.
+#
+#   e(X,Y) for M random edges between N nodes
+#   t(X,Y,Z) |= e(X,Y), e(Y,Z), e(Z,X).
+#
+# The time to compute the memo table of t with the join of the tries
+# (TrieJoinIterator) and with the nested loop which binds one variable at a
+# time and saturates the body after each binding.
+#
+# usage: python benchmarks/triangle_join.py [N] [M]
+
+import random
+import sys
+import time
+
+from dyna import interpreter
+from dyna.context import SystemContext
+
+
+def run(edges, join):
+    interpreter.join_iterators(join)
+    try:
+        system = SystemContext()
+        system.add_rules(' '.join(f'e({a},{b}).' for a, b in edges))
+        system.add_rules('t(X,Y,Z) |= e(X,Y), e(Y,Z), e(Z,X).')
+        system.memoize_term(('e', 2), 'null')
+        system.run_agenda()
+
+        start = time.perf_counter()
+        system.memoize_term(('t', 3), 'null')
+        system.run_agenda()
+        elapsed = time.perf_counter() - start
+
+        table = system.memo_containers(('t', 3))[0]
+        return elapsed, len(table.memos._children)
+    finally:
+        interpreter.join_iterators(True)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    m = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    random.seed(0)
+    edges = set()
+    while len(edges) < m:
+        a, b = random.randrange(n), random.randrange(n)
+        if a != b:
+            edges.add((a, b))
+    expected = sum(1 for a, b in edges for c in range(n) if (b, c) in edges and (c, a) in edges)
+
+    for name, join in [('nested loop', False), ('trie join', True)]:
+        elapsed, triangles = run(edges, join)
+        assert triangles == expected
+        print(f'{name:12} {elapsed:8.3f}s  ({triangles} triangles)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Time of the operations on a trie with ground keys for the nested dicts of
+# PrefixTrie and the single dict of FlatTrie.  The workload is what a refresh
+# of a memo table does: build the result of a partition, compare it against
+# the current table with zip_tries and rewrite the values with map_values.
+#
+# usage: python benchmarks/trie_layouts.py [rows] [arity]
+
+import sys
+import time
+
+from dyna.prefix_trie import PrefixTrie, FlatTrie, zip_tries
+
+
+def run(make, rows, arity):
+    keys = [tuple((i * (j + 7)) % (rows // 3 + 1 + j) for j in range(arity - 1)) + (i,) for i in range(rows)]
+    times = {}
+
+    start = time.perf_counter()
+    a = make(arity)
+    b = make(arity)
+    for k in keys:
+        a[k] = [1]
+        b[k] = [1] if k[-1] % 10 else [2]
+    times['insert'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    n = sum(1 for _ in a.items())
+    times['iterate'] = time.perf_counter() - start
+    assert n == rows
+
+    start = time.perf_counter()
+    changed = sum(1 for _, x, y in zip_tries(a, b) if x != y)
+    times['zip_tries'] = time.perf_counter() - start
+    assert changed == rows // 10
+
+    start = time.perf_counter()
+    a.map_values(lambda v: v + v)
+    times['map_values'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for k in keys[::10]:
+        assert a.filter_raw(k).single_item() is not None
+    times['lookup'] = time.perf_counter() - start
+    return times
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    arity = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    for name, make in [('PrefixTrie', PrefixTrie), ('FlatTrie', FlatTrie)]:
+        times = run(make, rows, arity)
+        print(f'{name:12}' + '  '.join(f'{op} {t:6.3f}s' for op, t in times.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,10 @@ from . import aggregators
 # dyna_system = context.dyna_system # this will get moved into this file as the default
 
 from .interpreter import (
-    RBaseType, FinalState, Terminal, Variable, variables_named, constant, Frame,
-    simplify, getPartitions, saturate, loop,
-    intersect as Intersect, partition as Partition, Unify, Aggregator, AggregatorOpImpl, AggregatorOpBase
+    RBaseType, FinalState, Terminal, Variable, variables_named, constant, Frame, SlotFrame, number_variables,
+    simplify, getPartitions, saturate, loop, iter_loop,
+    intersect as Intersect, partition as Partition, Unify, Aggregator, AggregatorOpImpl, AggregatorOpBase,
+    hash_consing, intern_rexpr, join_iterators
 )
 
 from .terms import (
@@ -1,28 +1,241 @@
 from typing import *
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import heapq
+import itertools
+
+
+class AgendaPolicy:
+    """
+    Controls the order in which work is popped off of the agenda.  The policy
+    owns the queue representation, the agenda itself only tracks which tasks are
+    currently pending so that duplicated pushes are ignored.
+
+    The default is FIFO, which processes updates in the order that they arrived.
+    """
+
+    name = 'fifo'
+
+    def new_queue(self):
+        return deque()
+
+    def push(self, queue, task):
+        queue.append(task)
+
+    def pop(self, queue):
+        return queue.popleft()
+
+    def batch_key(self, task):
+        # only work that has the same batch key is merged into a single batch
+        return None
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}()'
+
+
+FIFOPolicy = AgendaPolicy
+
+
+class LIFOPolicy(AgendaPolicy):
+    name = 'lifo'
+
+    def pop(self, queue):
+        return queue.pop()
 
-class Agenda:
+
+class PriorityPolicy(AgendaPolicy):
+    """
+    Pop the task with the smallest key first.  Ties (and tasks that are given the
+    same key) are broken by the order in which they were pushed so that this
+    behaves like FIFO when the key is constant.
+    """
+
+    name = 'priority'
+
+    def __init__(self, key :Callable):
+        self.key = key
+        self._counter = itertools.count()
+
+    def new_queue(self):
+        return []
+
+    def push(self, queue, task):
+        heapq.heappush(queue, (self.key(task), next(self._counter), task))
+
+    def pop(self, queue):
+        return heapq.heappop(queue)[2]
+
+    def batch_key(self, task):
+        # merging work with different priorities would run the lower priority
+        # work early, so batches are split by the priority
+        return self.key(task)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.key})'
+
+
+def agenda_message_priority(task):
+    # priority for tasks that are refreshing a memo table which is aggregated
+    # with a selective aggregator such as `min=` or `max=`.  Like Dijkstra's
+    # algorithm, the update which carries the "best" value is processed first,
+    # as that is the one that is most likely to be final and it will dominate the
+    # values which arrive later.
+    #
+    # Tasks which are not messages (refreshing a whole table, running the
+    # optimizer etc) or which do not have a numeric priority are run before
+    # everything else, as they are typically setting up the work that will be
+    # prioritized.
+    if isinstance(task, AgendaBatch):
+        # a batch is prioritized by the message that created it
+        msg = next(iter(task.items))
+    else:
+        msg = getattr(task, 'work', None)
+    priority = getattr(msg, 'priority', None)
+    if priority is None or isinstance(priority, bool) or not isinstance(priority, (int, float)):
+        return (0, 0)
+    aggregator = getattr(msg.table, 'aggregator', None)
+    if aggregator is None or not aggregator.selective:
+        return (0, 0)
+    direction = getattr(aggregator, 'priority_direction', 0)
+    if direction == 0:
+        return (0, 0)
+    return (1, direction * priority)
+
+
+class SelectiveAggregatorPolicy(PriorityPolicy):
+    name = 'selective'
 
     def __init__(self):
-        self._agenda = deque()
+        super().__init__(agenda_message_priority)
+
+
+AGENDA_POLICIES = {
+    'fifo': FIFOPolicy,
+    'lifo': LIFOPolicy,
+    'selective': SelectiveAggregatorPolicy,
+    'priority': SelectiveAggregatorPolicy,
+}
+
+
+def make_agenda_policy(policy):
+    """
+    Construct a policy from either a name in AGENDA_POLICIES, an AgendaPolicy
+    instance or a user supplied key function (lower keys are popped first).
+    """
+    if policy is None:
+        return FIFOPolicy()
+    if isinstance(policy, AgendaPolicy):
+        return policy
+    if isinstance(policy, str):
+        if policy not in AGENDA_POLICIES:
+            raise ValueError(f'Unknown agenda policy {policy}, expected one of {", ".join(AGENDA_POLICIES)}')
+        return AGENDA_POLICIES[policy]()
+    if callable(policy):
+        return PriorityPolicy(policy)
+    raise TypeError(f'Can not construct an agenda policy from {policy!r}')
+
+
+class Agenda:
+
+    def __init__(self, policy=None, parallel=None):
+        self._policy = make_agenda_policy(policy)
+        self._agenda = self._policy.new_queue()
         self._contains = set()
+        self._batches = {}  # (func, group) -> AgendaBatch which is currently pending
         self._agenda_empty_notfies = []  # list of Callable
 
+        # counters so that different policies can be compared on the same program
+        self.push_count = 0
+        self.duplicate_push_count = 0
+        self.batched_push_count = 0
+        self.pop_count = 0
+        self.wave_count = 0
+        self.parallel_task_count = 0
+
+        self._executor = None
+        self._owns_executor = False
+        self.set_parallel(parallel)
+
+    @property
+    def policy(self):
+        return self._policy
+
+    def set_policy(self, policy):
+        # change how the pending work is ordered, anything that is currently
+        # pending is moved over to the new queue
+        policy = make_agenda_policy(policy)
+        old_policy, old_queue = self._policy, self._agenda
+        self._batches.clear()  # pending batches are still run, but new work will not be merged into them
+        self._policy = policy
+        self._agenda = policy.new_queue()
+        while old_queue:
+            policy.push(self._agenda, old_policy.pop(old_queue))
+
+    def set_parallel(self, parallel):
+        # parallel is None/False to run the agenda serially, True or the number
+        # of worker threads, or a concurrent.futures.Executor which is used to
+        # run the computation for the independent memo tables (see _run_wave)
+        if self._owns_executor:
+            self._executor.shutdown()
+        self._owns_executor = False
+        if parallel is None or parallel is False:
+            self._executor = None
+        elif parallel is True or isinstance(parallel, int):
+            self._executor = ThreadPoolExecutor(max_workers=None if parallel is True else parallel,
+                                                thread_name_prefix='dyna-agenda')
+            self._owns_executor = True
+        else:
+            self._executor = parallel
+
+    @property
+    def parallel(self):
+        return self._executor is not None
+
     def push(self, task: Callable):
         # first check if the work is already added to the agenda.  In which case this should not be processed
+        self.push_count += 1
         if task not in self._contains:
-            self._agenda.append(task)
+            self._policy.push(self._agenda, task)
             self._contains.add(task)
+        else:
+            self.duplicate_push_count += 1
+
+    def push_batch(self, func, group, item):
+        # items which are pushed with the same (func, group) while there is
+        # still a pending batch are merged into that batch, so that func is
+        # called once with all of the items rather than once per item
+        self.push_count += 1
+        group = (group, self._policy.batch_key(AgendaWork(func, item)))
+        batch = self._batches.get((func, group))
+        if batch is not None:
+            if item in batch.items:
+                self.duplicate_push_count += 1
+            else:
+                self.batched_push_count += 1
+                batch.items[item] = None
+            return
+        batch = AgendaBatch(func, group, item)
+        self._batches[(func, group)] = batch
+        self._policy.push(self._agenda, batch)
+        self._contains.add(batch)
 
     def pop(self):
         if self._agenda:
-            r = self._agenda.popleft()
+            r = self._policy.pop(self._agenda)
             self._contains.remove(r)
+            if isinstance(r, AgendaBatch):
+                # once the batch is running, anything new needs to go into a new batch
+                if self._batches.get((r.func, r.group)) is r:
+                    del self._batches[(r.func, r.group)]
+            self.pop_count += 1
             return r
 
     def run(self):
         while self._agenda:
             while self._agenda:
+                if self._executor is not None:
+                    self._run_wave()
+                    continue
                 r = self.pop()
                 #print(r)
                 r()  # run the task.
@@ -31,9 +244,77 @@ class Agenda:
             for n in self._agenda_empty_notfies:
                 n()
 
+    def _run_wave(self):
+        # Everything which is currently pending is popped as a wave.  Tasks
+        # which can compute their result without writing anything (refreshing
+        # a null memo table whose body only reads other null memo tables, see
+        # memos.prepare_agenda_messages) are split into a compute step and an
+        # apply step.  The compute steps for the different tables run
+        # concurrently on the executor against the state of the tables at the
+        # start of the wave.  Only once all of them have finished are the
+        # tasks run by this thread in the order that they were popped, with
+        # the apply step writing the computed result.  As nothing is written
+        # while the computation is running, the result does not depend on how
+        # the threads are scheduled.
+        #
+        # A table which is changed by an earlier task in the wave signals the
+        # tables that read it, which pushes another refresh for the next wave,
+        # so this converges to the same memos as the serial agenda.
+        wave = []
+        while self._agenda:
+            wave.append(self.pop())
+        self.wave_count += 1
+
+        prepared = [None] * len(wave)
+        groups = set()
+        for i, task in enumerate(wave):
+            prepare = getattr(task, 'prepare_parallel', None)
+            p = prepare() if prepare is not None else None
+            # a single task for each table is computed in parallel
+            if p is not None and p[0] not in groups:
+                groups.add(p[0])
+                prepared[i] = p
+
+        futures = {}
+        if len(groups) > 1:
+            futures = {i: self._executor.submit(p[1]) for i, p in enumerate(prepared) if p is not None}
+            wait(futures.values())
+            self.parallel_task_count += len(futures)
+
+        for i, task in enumerate(wave):
+            f = futures.get(i)
+            if f is None or f.exception() is not None:
+                # if the computation raised, then the task is rerun so that
+                # the exception is raised in the same way as the serial agenda
+                task()
+            else:
+                prepared[i][2](f.result())
+
+    def counters(self):
+        return {
+            'pushes': self.push_count,
+            'duplicate_pushes': self.duplicate_push_count,
+            'batched_pushes': self.batched_push_count,
+            'pops': self.pop_count,
+            'pending': len(self._agenda),
+            'waves': self.wave_count,
+            'parallel_tasks': self.parallel_task_count,
+        }
+
+    def reset_counters(self):
+        self.push_count = 0
+        self.duplicate_push_count = 0
+        self.batched_push_count = 0
+        self.pop_count = 0
+        self.wave_count = 0
+        self.parallel_task_count = 0
+
     def __bool__(self):
         return bool(self._agenda)
 
+    def __len__(self):
+        return len(self._agenda)
+
 
 class AgendaWork(Callable):
     __slots__ = ('func', 'work')
@@ -42,6 +323,11 @@ class AgendaWork(Callable):
         self.work = work
     def __call__(self):
         self.func(self.work)
+    def prepare_parallel(self):
+        # func.parallel_prepare(work) returns (group, compute, apply) if the
+        # task can be run by the parallel agenda, see Agenda._run_wave
+        prepare = getattr(self.func, 'parallel_prepare', None)
+        return prepare(self.work) if prepare is not None else None
     def __hash__(self):
         return hash(self.func) ^ hash(self.work)
     def __eq__(self, other):
@@ -51,6 +337,25 @@ class AgendaWork(Callable):
     __repr__ = __str__
 
 
+class AgendaBatch(Callable):
+    # the items are kept in a dict as an ordered set, so the batch is processed
+    # in the order that things were pushed.  The batch is identified by its
+    # object identity as the items change while it is pending
+    __slots__ = ('func', 'group', 'items')
+    def __init__(self, func, group, item):
+        self.func = func
+        self.group = group
+        self.items = {item: None}
+    def __call__(self):
+        self.func(list(self.items))
+    def prepare_parallel(self):
+        prepare = getattr(self.func, 'parallel_prepare', None)
+        return prepare(list(self.items)) if prepare is not None else None
+    def __str__(self):
+        return f'{self.func}[{self.group}]({len(self.items)} items)'
+    __repr__ = __str__
+
+
 def push_work(func, work, dyna_system=None):
     # I suppose that there should be some "global" accessable function which can
     # do the agenda pushes, which is either going to be pushing to some local
@@ -59,3 +364,11 @@ def push_work(func, work, dyna_system=None):
     if dyna_system is None:
         from . import dyna_system
     dyna_system.agenda.push(AgendaWork(func, work))
+
+
+def push_batched_work(func, group, work, dyna_system=None):
+    # like push_work, but func is called with a list of all of the work items
+    # that were pushed with the same group before it was run
+    if dyna_system is None:
+        from . import dyna_system
+    dyna_system.agenda.push_batch(func, group, work)
@@ -72,10 +72,10 @@ def gc_colon_equals(rexpr):
 
 AGGREGATORS = {
     '=': AggregatorEqual(),
-    '+=': AggregatorOpImpl(lambda a,b: a+b),
-    '*=': AggregatorOpImpl(lambda a,b: a*b),
-    'max=': AggregatorOpImpl(max, True),
-    'min=': AggregatorOpImpl(min, True),
+    '+=': AggregatorOpImpl(lambda a,b: a+b, inverse_op=lambda a,b: a-b, vector_op='add'),
+    '*=': AggregatorOpImpl(lambda a,b: a*b, vector_op='multiply'),
+    'max=': AggregatorOpImpl(max, True, priority_direction=-1, vector_op='max'),
+    'min=': AggregatorOpImpl(min, True, priority_direction=1, vector_op='min'),
     ':-': AggregatorSaturate(lambda a,b: a or b, True),
     '|=': AggregatorSaturate(lambda a,b: a or b, True),
     '&=': AggregatorSaturate(lambda a,b: a and b, False),
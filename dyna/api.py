@@ -3,8 +3,10 @@
 import re
 import inspect
 
+import numpy as np
+
 from dyna import context
-from dyna.interpreter import saturate, loop, Frame, Terminal, ret_variable, VariableId, UnificationFailure as DynaUnificationFailure, constant, Unify, unify, intersect, partition, ConstantVariable, Aggregator
+from dyna.interpreter import saturate, iter_loop, Frame, Terminal, ret_variable, VariableId, UnificationFailure as DynaUnificationFailure, constant, Unify, unify, intersect, partition, ConstantVariable, Aggregator
 from dyna.builtins import moded_op
 from dyna.syntax.normalizer import user_query_to_rexpr, run_parser, FVar as ParserWrappedVariableName
 from dyna.optimize import run_optimizer
@@ -287,9 +289,21 @@ class DynaExpressionWrapper:
         # if this just defines an expression using :=, then it would
         #raise NotImplemented()
 
-    def callback(self, cb):
+    def load(self, rows):
+        # set many values at once, the same as `table[key] = value` for each of
+        # the rows, but the table is only invalidated once.  The rows are
+        # either a dict {key: value}, an iterable of (arguments..., value) or a
+        # 2d numpy array with a column for each argument and the value
+        assert self._name, "can not set the value of an expression which does not have a user referencable name"
+        if isinstance(rows, dict):
+            rows = ((*(k if isinstance(k, tuple) else (k,)), v) for k, v in rows.items())
+        if not isinstance(rows, np.ndarray):
+            rows = [tuple(cast_to_dyna(v) for v in r) for r in rows]
+        return self._api._system.load_facts(self._name[0], self._name[1], rows, aggregator=':=')
+
+    def results(self):
+        # a generator over the values of the expression as ((arguments...), result)
         self._api._check_run_agenda()
-        # this is going to take the expression and loop over its different and callback for each of the values
         frame = Frame()
         user_vars = [VariableId(i) for i in range(self._arity)] + [ret_variable]
         r = self._call
@@ -297,30 +311,31 @@ class DynaExpressionWrapper:
             r, _ = run_optimizer(r, user_vars)
         r = saturate(r, frame)
 
-        def mapper(rr, ff):
+        for rr, ff in iter_loop(r, frame, best_effort=True):
             if not isinstance(rr, Terminal):
                 if self._api._expose_rexprs:
-                    cb(rr)
+                    yield rr
+                    continue
                 else:
                     raise DynaIncompleteComputationException(rr)
-            if rr.isEmpty(): return
+            if rr.isEmpty(): continue
             *arg_values, res_value = [cast_from_dyna(v.getValue(ff)) for v in user_vars]
             arg_values = tuple(arg_values)
             for _ in range(rr.multiplicity):
-                cb((arg_values, res_value))
+                yield (arg_values, res_value)
 
-        loop(r, frame, mapper, best_effort=True)
+    def callback(self, cb):
+        # this is going to take the expression and loop over its different and callback for each of the values
+        for v in self.results():
+            cb(v)
 
     loop_via_callback = callback
 
     def __iter__(self):
-        return callback_to_iterator(self.callback)
+        return self.results()
 
     def to_dict(self):
-        ret = {}
-        @self.loop_via_callback
-        def s(x): ret[x[0]] = x[1]
-        return ret
+        return dict(self.results())
 
     # def set_memoized(self, mode):
     #     assert mode in ('null', 'unk', 'none')
@@ -399,11 +414,18 @@ class DynaAPI:
         # if it matches the expression where it would have some expression that corresponds with
         return DynaExpressionWrapper(self, statement=method)
 
-    def table(self, name, arity):
+    def table(self, name, arity, max_entries=None, eviction=None):
+        # if max_entries is set, then reads of the table are memoized as unk
+        # and the least recently (or frequently with eviction='lfu') used
+        # entries are evicted once there are more than max_entries
         key = (name, arity)
         if key not in self._tables:
             make_call_proxy(self._system, f'{name}_value_defined_table', name, arity)
-            self._system.memoize_term((f'{name}', arity), kind='null', mem_variables=()) #tuple(VariableId(i) for i in range(arity)))
+            if max_entries is None:
+                self._system.memoize_term((f'{name}', arity), kind='null', mem_variables=()) #tuple(VariableId(i) for i in range(arity)))
+            else:
+                self._system.memoize_term((f'{name}', arity), kind='unk', mem_variables=tuple(range(arity)),
+                                          max_entries=max_entries, eviction=eviction)
 
             # then this is going to want to create some table which corresponds with this expression
             pass
@@ -412,6 +434,10 @@ class DynaAPI:
         #r.set_memoized('null')
         return r
 
+    def memo_counters(self, name, arity):
+        """The number of hits, misses and evictions of the memo table for name/arity"""
+        return self._system.memo_counters((name, arity))
+
     def define_function(self, name=None, arity=None):
         """This could be used as:
 
@@ -456,52 +482,6 @@ class DynaAPI:
             self.run_agenda()
 
 
-def callback_to_iterator(func):
-    # due to the technical differences between iterators and callbacks, we need this nasty method
-    # only one of these two threads is ever running at a time, so not a big issue...
-    import threading
-    send = threading.Semaphore(0)
-    recv = threading.Semaphore(0)
-    done = False
-    value = None
-    def callback(v):
-        nonlocal value, done, send, recv
-        value = v
-        recv.release()
-        send.acquire()
-        if done:
-            raise KeyboardInterrupt()
-        return value
-    def threadF():
-        nonlocal value, done, send, recv
-        send.acquire()
-        try:
-            if not done:
-                func(callback)
-        except KeyboardInterrupt:
-            pass
-        finally:
-            done = True
-            recv.release()
-
-    def iterator():
-        nonlocal value, done, send, recv
-        try:
-            while True:
-                send.release()
-                recv.acquire()
-                if done: break
-                value = (yield value)
-        finally:
-            done = True
-            send.release()
-
-    thread = threading.Thread(target=threadF, daemon=True)
-    thread.start()
-
-    return iterator()
-
-
 __all__ = [
     'DynaAPI',
     'DynaIncompleteComputationException',
@@ -41,10 +41,11 @@ class SteppableParamters(object):
             dassum = dest.assumption
 
             changes = []
-            for key, a, b in zip_tries(dm, source.memos._children):
-                if a != b:
-                    changes.append((key, b))
+            for key, a, b in zip_tries(dm, source.memos._children, changed_only=True):
+                changes.append((key, b))
 
+            if changes:
+                dest.refresh_epoch += 1
             for key, value in changes:
                 if value is None:
                     del dm[key]
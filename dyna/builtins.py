@@ -662,3 +662,25 @@ def define_builtins(dyna_system):
     dyna_system.add_rules("$load(0).")
     # whenever $load("file_name"). is defined, it will load the file into the program
     dyna_system.watch_term_changes(('$load', 1), watch_load_callback)
+
+    loaded_fact_files = set()
+
+    def watch_load_facts(file_format):
+        def callback(msg):
+            file_name, target, value = msg.key
+            if value is None or file_name == 0 or (file_name, target, file_format) in loaded_fact_files:
+                return
+            loaded_fact_files.add((file_name, target, file_format))
+            # the target is written as &edge, the arity is the number of columns in the file
+            if isinstance(target, Term) and not target.arguments:
+                target = target.name
+            if not isinstance(target, str):
+                raise RuntimeError(f'$load_{file_format} expects a term name like &edge, got {target}')
+            from .fact_loading import load_file
+            load_file(dyna_system, file_name, target, format=file_format)
+        return callback
+
+    # $load_csv("edges.csv", &edge). streams the rows of the file into the facts edge(A, B).
+    for file_format in ('csv', 'tsv', 'ndjson', 'npy'):
+        dyna_system.add_rules(f"$load_{file_format}(0, 0).")
+        dyna_system.watch_term_changes((f'$load_{file_format}', 2), watch_load_facts(file_format))
@@ -0,0 +1,251 @@
+# Generate Python source for a CompiledInstance.
+#
+# The compiler produces a list of operations that are run by
+# CompiledInstance.execute_program.  For modes that are called many times, the
+# overhead of dispatching each of the operations adds up, so this turns the
+# operations back into structured python code.  The slots of the frame become
+# locals of the generated function, loops become `for` loops over the
+# iterator's values and the branches of a partition are wrapped in `try`
+# blocks which act as the failure handler for the branch.
+#
+# Only the operations that the compiler currently generates for the "simple"
+# cases are handled.  If something else is encountered, then
+# CodegenUnsupported is raised and the compiled instance continues to use the
+# operations interpreter.
+
+from .interpreter import ConstantVariable, FinalState, Terminal
+from .vector_reduce import ChunkedReducer
+
+
+class CodegenUnsupported(Exception):
+    pass
+
+
+class CompiledFailure(Exception):
+    # raised by the generated code when something fails and it is not inside
+    # of a loop or the branch of a partition (where the failure handler would
+    # be -1 in the operations interpreter)
+    pass
+
+
+def _final_success(r):
+    assert isinstance(r, Terminal)  # TODO: handle other cases?
+    if r.multiplicity == 0:
+        return False
+    elif r.multiplicity == 1:
+        return True
+    else:
+        assert False  # ???
+
+
+def _moded_iterable(r, mode, binding_index):
+    # the same as the get_iterator in abstract_outmodes_modedop, but returns
+    # the values for the variable that is bound rather than an Iterator
+    assert r != () and not isinstance(r, FinalState)
+    ret = None
+    for i, (val, imode) in enumerate(zip(r, mode)):
+        if hasattr(val, '__iter__'):
+            assert ret is None and i == binding_index
+            ret = val
+        elif not imode:
+            assert ret is None and i == binding_index
+            ret = (val,)
+    return ret
+
+
+class PythonCodeGenerator:
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.operations = instance.operations
+        self.slots = {name: f's{i}' for i, name in enumerate(instance.frame_variables)}
+        self.namespace = {
+            'CompiledFailure': CompiledFailure,
+            'FinalState': FinalState,
+            '_failure': CompiledFailure(),
+            '_final_success': _final_success,
+            '_moded_iterable': _moded_iterable,
+            '_ChunkedReducer': ChunkedReducer,
+        }
+        self._constants = {}
+        self.lines = []
+        self._iterators = {}  # iterator slot -> the variable that it binds
+        self._reducer_slots = set()  # aggregator slots which hold a ChunkedReducer
+
+    def var(self, v):
+        if isinstance(v, ConstantVariable):
+            return self.const(v.getValue(None))
+        name = self.slots.get(v._compiler_name)
+        if name is None:
+            raise CodegenUnsupported(f'variable {v} does not have a slot in the frame')
+        return name
+
+    def target(self, v):
+        if isinstance(v, ConstantVariable):
+            raise CodegenUnsupported('assignment to a constant')
+        return self.var(v)
+
+    def const(self, value):
+        # values are referenced through the namespace of the generated function
+        # as they might not have a repr which can be parsed back
+        key = id(value)
+        if key not in self._constants:
+            name = f'c{len(self._constants)}'
+            self._constants[key] = name
+            self.namespace[name] = value
+        return self._constants[key]
+
+    def emit(self, indent, line):
+        self.lines.append('    '*indent + line)
+
+    def generate(self):
+        instance = self.instance
+        self.emit(0, 'def compiled_program(arguments):')
+        self.emit(1, ' = '.join(self.slots.values()) + ' = None')
+        for vid, imode in enumerate(instance.incoming_mode):
+            if imode:
+                self.emit(1, f'{self.slots[vid]} = arguments[{vid}]')
+
+        self.gen_block(0, len(self.operations), 1, 'raise _failure')
+
+        out = [self.slots[vid] for vid in range(len(instance.incoming_mode))]
+        out += [self.var(v) for v in instance.outgoing_additional_variables]
+        self.emit(1, f'return ({", ".join(out)}{"," if len(out) == 1 else ""})')
+        return '\n'.join(self.lines) + '\n'
+
+    def gen_block(self, start, end, indent, fail):
+        ops = self.operations
+        first_line = len(self.lines)
+        pc = start
+        while pc < end:
+            instr, data = ops[pc]
+            if instr == 'run_function':
+                self.gen_function(data, indent, fail)
+            elif instr in ('clear_slot', 'aggregator_init'):
+                self.emit(indent, f'{self.target(data)} = None')
+            elif instr == 'set_slot':
+                variable, value = data
+                self.emit(indent, f'{self.target(variable)} = {self.const(value)}')
+            elif instr == 'copy_slot':
+                target, source = data
+                self.emit(indent, f'{self.target(target)} = {self.var(source)}')
+            elif instr == 'aggregator_add':
+                slot, body_res, aggregator = data
+                slot, body_res = self.target(slot), self.var(body_res)
+                if aggregator.vector_op is not None:
+                    self._reducer_slots.add(slot)
+                    self.emit(indent, f'if {slot} is None: {slot} = _ChunkedReducer({self.const(aggregator)})')
+                    self.emit(indent, f'{slot}.add({body_res})')
+                else:
+                    self.emit(indent, f'{slot} = {body_res} if {slot} is None else {self.const(aggregator)}.combine({slot}, {body_res})')
+            elif instr == 'aggregator_finalize':
+                slot, out_var = data
+                if self.var(slot) in self._reducer_slots:
+                    self.emit(indent, f'if {self.var(slot)} is not None: {self.var(slot)} = {self.var(slot)}.result()')
+                self.emit(indent, f'if {self.var(slot)} is None: {fail}')
+                self.emit(indent, f'{self.target(out_var)} = {self.var(slot)}')
+            elif instr == 'iterator_load':
+                self.gen_iterator_load(data, indent)
+            elif instr == 'iterator_start':
+                pc = self.gen_loop(pc, indent)
+                continue
+            elif instr == 'failure_handler_conditional_run':
+                pc = self.gen_partition_branch(pc, indent)
+                continue
+            elif instr == 'failure_handler_jump':
+                # the failure handlers are handled by the structure of the generated code
+                pass
+            else:
+                raise CodegenUnsupported(instr)
+            pc += 1
+        if len(self.lines) == first_line:
+            self.emit(indent, 'pass')
+
+    def gen_function(self, ev, indent, fail):
+        info = getattr(ev, 'codegen', None)
+        if info is None:
+            raise CodegenUnsupported(f'unknown function {ev}')
+        kind = info[0]
+        if kind == 'moded_det':
+            _, f, variables, mode = info
+            self.emit(indent, f'_r = {self.const(f)}({", ".join(map(self.var, variables))})')
+            self.emit(indent, 'if isinstance(_r, FinalState):')
+            self.emit(indent+1, f'if not _final_success(_r): {fail}')
+            assigns = []
+            for i, (v, imode) in enumerate(zip(variables, mode)):
+                if imode:
+                    assigns.append(f'if {self.var(v)} != _r[{i}]: {fail}')
+                else:
+                    assigns.append(f'{self.target(v)} = _r[{i}]')
+            if assigns:
+                self.emit(indent, 'else:')
+                for a in assigns:
+                    self.emit(indent+1, a)
+        elif kind == 'check_equal':
+            _, a, b = info
+            self.emit(indent, f'if not ({self.var(a)} == {self.var(b)}): {fail}')
+        elif kind == 'copy':
+            _, target, source = info
+            self.emit(indent, f'{self.target(target)} = {self.var(source)}')
+        elif kind == 'check_constant':
+            _, v, value = info
+            self.emit(indent, f'if not ({self.var(v)} == {self.const(value)}): {fail}')
+        elif kind == 'set_constant':
+            _, v, value = info
+            self.emit(indent, f'{self.target(v)} = {self.const(value)}')
+        else:
+            raise CodegenUnsupported(kind)
+
+    def gen_iterator_load(self, data, indent):
+        get_iterator, iter_slot = data
+        info = getattr(get_iterator, 'codegen', None)
+        if info is None:
+            raise CodegenUnsupported(f'unknown iterator {get_iterator}')
+        if info[0] == 'moded_nondet':
+            _, f, variables, mode, binding_var = info
+            self.emit(indent, f'{self.target(iter_slot)} = _moded_iterable({self.const(f)}({", ".join(map(self.var, variables))}), '
+                      f'{self.const(mode)}, {variables.index(binding_var)})')
+        elif info[0] == 'single':
+            _, binding_var, value = info
+            self.emit(indent, f'{self.target(iter_slot)} = ({self.const(value)},)')
+        else:
+            raise CodegenUnsupported(info[0])
+        self._iterators[self.var(iter_slot)] = binding_var
+
+    def gen_loop(self, pc, indent):
+        # iterator_start, iterator_next, <body>, jump, failure_handler_jump (generated by compile_run_loop)
+        ops = self.operations
+        raw_iter, iter_slot = ops[pc][1]
+        instr, (next_slot, end) = ops[pc+1]
+        if (instr != 'iterator_next' or next_slot is not iter_slot or ops[end-2] != ('jump', pc+1) or
+            ops[end-1][0] != 'failure_handler_jump'):
+            raise CodegenUnsupported('unexpected loop structure')
+        raw = self.var(raw_iter)
+        if raw not in self._iterators:
+            raise CodegenUnsupported('loop over unknown iterator')
+        self.emit(indent, f'for {self.target(self._iterators[raw])} in {raw}:')
+        # a failure inside of the loop goes to the next iteration
+        self.gen_block(pc+2, end-2, indent+1, 'continue')
+        return end
+
+    def gen_partition_branch(self, pc, indent):
+        next_pc, condition, condition_variable = self.operations[pc][1]
+        self.emit(indent, f'if not ({self.var(condition_variable)} & {1 << condition}):')
+        self.emit(indent+1, 'try:')
+        # a failure inside of the branch skips to the next branch
+        self.gen_block(pc+1, next_pc, indent+2, 'raise _failure')
+        self.emit(indent+1, 'except CompiledFailure:')
+        self.emit(indent+2, 'pass')
+        return next_pc
+
+
+def generate_python(instance):
+    """
+    Returns (source, function) for the CompiledInstance, raises
+    CodegenUnsupported if the operations can not be converted
+    """
+    gen = PythonCodeGenerator(instance)
+    source = gen.generate()
+    namespace = gen.namespace
+    exec(compile(source, f'<dyna compiled {instance.incoming_mode}>', 'exec'), namespace)
+    return source, namespace['compiled_program']
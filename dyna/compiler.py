@@ -2,7 +2,11 @@ from typing import *
 
 from .interpreter import *
 from .terms import CallTerm, BuildStructure, Evaluate, ReflectStructure, Evaluate_reflect
-from .guards import remove_all_assumptions, Assumption
+from .guards import remove_all_assumptions, Assumption, AssumptionResponse
+from .vector_reduce import ChunkedReducer
+
+# the number of times that a compiled mode is called before python source is generated for it
+PYTHON_CODEGEN_THRESHOLD = 100
 
 
 class IdentityKey:
@@ -55,6 +59,7 @@ def abstract_outmodes_modedop(self, manager: 'CompiledInstance'):
                     var.rawSetValue(frame, val)
 
             return True  # indicate that this was successful
+        ev.codegen = ('moded_det', f, self.vars, mode)  # used by codegen.py to inline this operation
         return  [
             # what it rewrites as, what would become bound, some function that needs to be evaluated
             (True, Terminal(1), self.vars, ev),
@@ -82,6 +87,7 @@ def abstract_outmodes_modedop(self, manager: 'CompiledInstance'):
                     assert ret is None
                     ret = SingleIterator(var, val)
             return ret
+        get_iterator.codegen = ('moded_nondet', f, self.vars, mode, binding_vars[0])
 
         assert len(binding_vars) == 1  # this should generate different expressions for the variable that it is binding
 
@@ -99,6 +105,7 @@ def abstract_outmodes_unify(self, manager):
         # then we are just going to check equlaity
         def check_equals(frame):
             return self.v1.getValue(frame) == self.v2.getValue(frame)
+        check_equals.codegen = ('check_equal', self.v1, self.v2)
 
         return [
             (True, Terminal(1), (), check_equals)
@@ -111,6 +118,7 @@ def abstract_outmodes_unify(self, manager):
             def copy_var(frame):
                 b.rawSetValue(frame, a.getValue(frame))
                 return True  # this doesn't check anything as it isn't bound
+            copy_var.codegen = ('copy', b, a)
             return [
                 (True, Terminal(1), (b,), copy_var)
             ]
@@ -205,12 +213,18 @@ class CompilerUnionIteratorInfo(CompilerIteratorInfo):
 ####################################################################################################
 
 
-class CompiledFrame:
+class CompiledFrame(SlotTrail):
+    __slots__ = ('_values', '_vmap', '_trail', '_trail_marks')
 
     def __init__(self, variables):
         self._values = [None]*len(variables)
         # the map from variables to slots should be done before we are running or something
         self._vmap = dict((v, i) for i,v in enumerate(variables))
+        # the same trail as Frame (the entries are (None, slot, old value)).
+        # This lets the interpreter's loops run over a compiled frame without
+        # copying it
+        self._trail = None
+        self._trail_marks = 0
 
     def __contains__(self, varname):
         import ipdb; ipdb.set_trace()
@@ -222,7 +236,8 @@ class CompiledFrame:
         return self._values[key]
 
     def get(self, varname, default):
-        return self[varname]
+        # this is what Variable.getValue calls, so avoid going through __getitem__
+        return self._values[self._vmap[varname]]
 
     def __setitem__(self, varname, value):
         key = self._vmap[varname]
@@ -234,6 +249,15 @@ class CompiledFrame:
         # key = self._vmap[varname]
         # self._values[key] = value
 
+    def _frame_rawsetvalue(self, varname, value):
+        key = self._vmap[varname]
+        if self._trail is not None:
+            self._trail.append((None, key, self._values[key]))
+        self._values[key] = value
+
+    def _restore_slot(self, slot, old):
+        self._values[slot] = old
+
     def _frame_settype(self, varname, typ):
         # ignore this operation in compiled code as it should have been already processed by this points
         pass
@@ -452,6 +476,7 @@ def abstract_outmodes_checkequals(self, manager):
         def ev(frame):
             # then the value is bound, so we are just going to check equality
             return self.variable.getValue(frame) == self.constant
+        ev.codegen = ('check_constant', self.variable, self.constant)
         return [
             (True, Terminal(1), self.vars, ev)
         ]
@@ -460,9 +485,11 @@ def abstract_outmodes_checkequals(self, manager):
         def ev(frame):
             self.variable.rawSetValue(frame, self.constant)
             return True
+        ev.codegen = ('set_constant', self.variable, self.constant)
 
         def get_iterator(frame):
             return SingleIterator(self.variable, self.constant)
+        get_iterator.codegen = ('single', self.variable, self.constant)
         return [
             (True, Terminal(1), self.vars, ev),
             (False, Terminal(1), self.vars, get_iterator)
@@ -552,6 +579,18 @@ class CompiledInstance:
                 self.bound_variables[i] = True
         self.failure_handler_instruction = -1
 
+        # the lowered version of operations that is run by execute_program
+        self._opcodes = None
+        self._operands = None
+
+        # once this has been called PYTHON_CODEGEN_THRESHOLD times, the
+        # operations are turned into python source (see codegen.py) which is
+        # then used instead of interpreting the operations
+        self._execute_count = 0
+        self.python_source = None
+        self._python_function = None
+        self._python_disabled = False  # set if the codegen is not supported or the assumptions are invalidated
+
     def _frame_isbound(self, varname):
         return self.bound_variables[varname]
 
@@ -589,6 +628,8 @@ class CompiledInstance:
 
         additional_mode = tuple(self.bound_variables[v._compiler_name] for v in self.outgoing_additional_variables)
         self.outgoing_mode = in_vars_out + additional_mode
+
+        self._lower_program()
         # I suppose that we should save this back?  This is the returned expression that we are going to have to handle.
 
     def do_compilation(self):
@@ -990,30 +1031,70 @@ class CompiledInstance:
 
     ##################################################
 
+    def _lower_program(self):
+        # lower the operations into a dense array of opcodes and an array of
+        # their operands, so that dispatch is a single index into
+        # _OPERATION_HANDLERS rather than walking a chain of string comparisons
+        opcodes = []
+        operands = []
+        for instr, data in self.operations:
+            assert instr in OPCODES, instr
+            opcodes.append(OPCODES[instr])
+            operands.append(data)
+        self._opcodes = opcodes
+        self._operands = operands
+
+    def generate_python(self):
+        # generate the python source for this program, returns True if the
+        # generated code will be used
+        from .codegen import generate_python, CodegenUnsupported
+        if self._python_function is not None:
+            return True
+        if self._python_disabled or not all(a.isValid() for a in self.collected_assumptions):
+            return False
+        try:
+            source, func = generate_python(self)
+        except CodegenUnsupported:
+            self._python_disabled = True
+            return False
+        self.python_source = source
+        self._python_function = func
+
+        # if any of the assumptions that were used while compiling are
+        # invalidated, then go back to interpreting the operations
+        response = AssumptionResponse(self._invalidate_python)
+        for a in self.collected_assumptions:
+            a.track(response)
+        return True
+
+    def _invalidate_python(self):
+        self._python_function = None
+        self._python_disabled = True
+
     def execute_program(self, arguments):
+        func = self._python_function
+        if func is not None:
+            return func(arguments)
+        self._execute_count += 1
+        if self._execute_count == PYTHON_CODEGEN_THRESHOLD and self.generate_python():
+            return self._python_function(arguments)
+        return self.execute_operations(arguments)
+
+    def execute_operations(self, arguments):
         # this is the "bytecode interpeter" of the compiled sequence.  This is
         # just because we are compiling a sequence of instructions instead being
         # some compiled external thunk
 
-        # setup initial registers for this method
-        pc = 0  # the program counter
-        ninstrs = len(self.operations)
-        frame = CompiledFrame(self.frame_variables)
-        failure_handler = -1
-
-        # this stack stuff should just become embedded as new variables rather than having its own things that are tracked?
-        # then we can just put it into the frame
-        #failure_handler_stack = [0]  # this should just become static variables in C++
-        failure_handler_condition = 0
-        failure_handler_variable = None
+        if self._opcodes is None or len(self._opcodes) != len(self.operations):
+            self._lower_program()
 
-        def fail():
-            nonlocal pc, frame, failure_handler, failure_handler_condition, failure_handler_variable
-            pc = failure_handler
-            if failure_handler_variable is not None:
-                v = failure_handler_variable.getValue(frame)
-                v |= failure_handler_condition
-                failure_handler_variable.rawSetValue(frame, v)
+        # setup initial registers for this method
+        state = ProgramState(CompiledFrame(self.frame_variables))
+        frame = state.frame
+        opcodes = self._opcodes
+        operands = self._operands
+        handlers = _OPERATION_HANDLERS
+        ninstrs = len(opcodes)
 
         # load in the arguments for this expression
         for vid, (imode, val) in enumerate(zip(self.incoming_mode, arguments)):
@@ -1022,150 +1103,220 @@ class CompiledInstance:
                 VariableId(vid).rawSetValue(frame, val)
 
         # run
+        pc = 0  # the program counter
         while pc < ninstrs:  # if we fall off the edge, then we should be done, but maybe we should have some final instruction which tracks this instead?
             assert pc >= 0
-            instr, data = self.operations[pc]
-            print(f'>>> {pc} {instr} {data}')
-            if instr == 'run_function':
-                # this is currently run builtin and run external as we are just wrapping that up into a python function that does the work internally
-                success = data(frame)
-                if not success:
-                    fail()
-                else:
-                    #assert success == True  # need to handle failure cases, or where we find ourselves branching to a different case becasue of a difference in values
-                    pc += 1
-            elif instr == 'jump':
-                pc = data
-            elif instr == 'clear_slot':
-                data.rawSetValue(frame, None)
-                pc += 1
-            elif instr == 'set_slot':
-                # normally, variables that are "used" by the program directly are immutable, though
-                # we are also storing the partition branches controls into these variables which
-                # means that those variables are going to become mutable.
-                variable, value = data
-                variable.rawSetValue(frame, value)
-                pc += 1
-            elif instr == 'copy_slot':
-                target, source = data
-                target.rawSetValue(frame, source.getValue(frame))
-                pc += 1
-            elif instr == 'iterator_load_start':
-                # take something that we are going to iterate over and save it
-                # to some slot.  This will then set the
-                assert False  # DELETE THIS INSTRUCTION
-                get_iterator, iter_slot = data
-                iterators = list(get_iterator(frame))  # this should maybe just return a single iterator in actuallity, so do we actually need a yield?
-                assert len(iterators) == 1
-                iter_slot.rawSetValue(frame, make_interpreter_iterator_to_compiler(iterators[0], frame))  # start the iterator
-                pc += 1
-            elif instr == 'iterator_load':
-                # load a single "simple" iterator.  at this point, these iterators are the same as the ones that are used in the interpreter.
-                get_iterator, iter_slot = data
-                iterator = get_iterator(frame)
-                iter_slot.rawSetValue(frame, iterator)  # this indirection might not be required in actuallity
-                pc += 1
-            elif instr == 'iterator_start':
-                iterator_construct_slot, iter_slot = data
-                it = iterator_construct_slot.getValue(frame)
-                if it is None:
-                    # then all of the iterators failed to be constructed, this is empty
-                    # we are going to need to go to some failure handler in this case
-                    fail()
-                else:
-                    iter_slot.rawSetValue(frame, make_interpreter_iterator_to_compiler(it, frame))
-                pc += 1
-            elif instr == 'iterator_union_make':
-                # construct a union iterator taking into account which partition is currently "alive"
-                source_slot, iter_slot, condition, condition_variable = data
-
-                # check the condition
-                condition_variable_value = condition_variable.getValue(frame)
-                if not (condition_variable_value & (1 << condition)):
-                    # then we can add this iterator
-                    it = iter_slot.getValue(frame)
-                    if it is None:
-                        it = UnionIterator(None, None, [])
-                        iter_slot.rawSetValue(frame, it)
-                    iter_source = source_slot.getValue(frame)
-                    if iter_source is None:
-                        assert False  # IDK what to do in this case?
-
-                    # add this iterator to the list of iterators that this iterator will iterate through?
-                    # don't need to reset the slot as this is just a pointer atm.  This is just a bad hack/abstraction leak....need to handle this better
-                    it.iterators.append(iter_source)
-
-                    # the iterator is always a union iterator, and we are just giong to bind the variable to it?
-
-                    # if it is None:
-                    #     assert False
-                    # elif isinstance(it, UnionIterator):
-                    #     assert False
-                    # else:
-                    #     # then build a union iterator out of these two iterators
-                    #     assert False
-                    # iter_slot.rawSetValue(frame, it)
-
-                pc += 1
-            elif instr == 'iterator_next':
-                iterator_slot, end_iterator_location = data
-                iterator = iterator_slot.getValue(frame)
-                failure_handler = pc
-                try:
-                    next(iterator)  # get the next value from the iterator
-                    pc += 1  # go to the next instruction
-                except StopIteration:
-                    pc = end_iterator_location
-                    iterator_slot.rawSetValue(frame, None)  # delete the iterator from the frame slot
-                iterator = None
-            elif instr == 'aggregator_init':  # this is the same as clear slot
-                data.rawSetValue(frame, None)  # init the value to nothing
-                pc += 1
-            elif instr == 'aggregator_add':
-                slot, body_res, aggregator = data
-                old_value = slot.getValue(frame)
-                new_value = body_res.getValue(frame)
-                if old_value is not None:
-                    new_value = aggregator.combine(old_value, new_value)
-                slot.rawSetValue(frame, new_value)
-                pc += 1
-            elif instr == 'aggregator_finalize':
-                slot, out_var = data
-                value = slot.getValue(frame)
-                if value is None:
-                    fail()
-                    #assert False  # TODO: handle.  In this case there was nothing that got aggregated together and we need to error out this statement and go to whatever the failure handler is in this case
-                else:
-                    out_var.rawSetValue(frame, value)
-                    pc += 1
-            elif instr == 'failure_handler_jump':  # this shouldn't really be here?  I suppose that we currently need to be able to reset this instruction
-                failure_handler = data
-                pc += 1
-            elif instr == 'failure_handler_conditional_variable':
-                # set the variable that is currently tracking where failures would be set
-                failure_handler_variable = data
-                pc += 1
-            elif instr == 'failure_handler_conditional_run':  # run the next block if it hasn't already been marked as failed, otherwise set
-                next_pc, condition, condition_variable = data
-                failure_condition_value = condition_variable.getValue(frame)
-                if failure_condition_value & (1 << condition):
-                    # then this branch is currently disabled
-                    pc = next_pc
-                    failure_handler = -1
-                else:
-                    # then this branch is not disabled, so we are going to run the code
-                    failure_handler = next_pc
-                    failure_handler_condition = 1 << condition  # use a bit mask for this stuff
-                    pc += 1
-            else:
-                assert False, instr
-
+            pc = handlers[opcodes[pc]](state, operands[pc], pc)
 
         # this is the returned values that are bound by the expression.  This should instead
         out_values = tuple((VariableId(vid).getValue(frame) for vid in range(len(self.incoming_mode)))) + tuple((v.getValue(frame) for v in self.outgoing_additional_variables))
         return out_values
 
 
+class ProgramState:
+    # the registers of the running program
+
+    # the program counter is kept as a local in execute_program, and is
+    # returned by each of the operation handlers
+
+    __slots__ = ('frame', 'failure_handler', 'failure_handler_condition', 'failure_handler_variable')
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.failure_handler = -1
+
+        # this stack stuff should just become embedded as new variables rather than having its own things that are tracked?
+        # then we can just put it into the frame
+        #failure_handler_stack = [0]  # this should just become static variables in C++
+        self.failure_handler_condition = 0
+        self.failure_handler_variable = None
+
+    def fail(self):
+        # returns the pc of the failure handler
+        if self.failure_handler_variable is not None:
+            v = self.failure_handler_variable.getValue(self.frame)
+            v |= self.failure_handler_condition
+            self.failure_handler_variable.rawSetValue(self.frame, v)
+        return self.failure_handler
+
+
+# the implementation of each of the instructions.  Each takes the state of the
+# program, the operand of the instruction and the current pc and returns the pc
+# of the next instruction to run
+
+def _op_run_function(state, data, pc):
+    # this is currently run builtin and run external as we are just wrapping that up into a python function that does the work internally
+    success = data(state.frame)
+    if not success:
+        return state.fail()
+    else:
+        #assert success == True  # need to handle failure cases, or where we find ourselves branching to a different case becasue of a difference in values
+        return pc + 1
+
+def _op_jump(state, data, pc):
+    return data
+
+def _op_clear_slot(state, data, pc):
+    data.rawSetValue(state.frame, None)
+    return pc + 1
+
+def _op_set_slot(state, data, pc):
+    # normally, variables that are "used" by the program directly are immutable, though
+    # we are also storing the partition branches controls into these variables which
+    # means that those variables are going to become mutable.
+    variable, value = data
+    variable.rawSetValue(state.frame, value)
+    return pc + 1
+
+def _op_copy_slot(state, data, pc):
+    target, source = data
+    target.rawSetValue(state.frame, source.getValue(state.frame))
+    return pc + 1
+
+def _op_iterator_load_start(state, data, pc):
+    # take something that we are going to iterate over and save it
+    # to some slot.  This will then set the
+    assert False  # DELETE THIS INSTRUCTION
+    get_iterator, iter_slot = data
+    iterators = list(get_iterator(state.frame))  # this should maybe just return a single iterator in actuallity, so do we actually need a yield?
+    assert len(iterators) == 1
+    iter_slot.rawSetValue(state.frame, make_interpreter_iterator_to_compiler(iterators[0], state.frame))  # start the iterator
+    return pc + 1
+
+def _op_iterator_load(state, data, pc):
+    # load a single "simple" iterator.  at this point, these iterators are the same as the ones that are used in the interpreter.
+    get_iterator, iter_slot = data
+    iterator = get_iterator(state.frame)
+    iter_slot.rawSetValue(state.frame, iterator)  # this indirection might not be required in actuallity
+    return pc + 1
+
+def _op_iterator_start(state, data, pc):
+    iterator_construct_slot, iter_slot = data
+    frame = state.frame
+    it = iterator_construct_slot.getValue(frame)
+    if it is None:
+        # then all of the iterators failed to be constructed, this is empty
+        # we are going to need to go to some failure handler in this case
+        pc = state.fail()
+    else:
+        iter_slot.rawSetValue(frame, make_interpreter_iterator_to_compiler(it, frame))
+    return pc + 1
+
+def _op_iterator_union_make(state, data, pc):
+    # construct a union iterator taking into account which partition is currently "alive"
+    source_slot, iter_slot, condition, condition_variable = data
+    frame = state.frame
+
+    # check the condition
+    condition_variable_value = condition_variable.getValue(frame)
+    if not (condition_variable_value & (1 << condition)):
+        # then we can add this iterator
+        it = iter_slot.getValue(frame)
+        if it is None:
+            it = UnionIterator(None, None, [])
+            iter_slot.rawSetValue(frame, it)
+        iter_source = source_slot.getValue(frame)
+        if iter_source is None:
+            assert False  # IDK what to do in this case?
+
+        # add this iterator to the list of iterators that this iterator will iterate through?
+        # don't need to reset the slot as this is just a pointer atm.  This is just a bad hack/abstraction leak....need to handle this better
+        it.iterators.append(iter_source)
+
+        # the iterator is always a union iterator, and we are just giong to bind the variable to it?
+
+    return pc + 1
+
+def _op_iterator_next(state, data, pc):
+    iterator_slot, end_iterator_location = data
+    iterator = iterator_slot.getValue(state.frame)
+    state.failure_handler = pc
+    try:
+        next(iterator)  # get the next value from the iterator
+        return pc + 1  # go to the next instruction
+    except StopIteration:
+        iterator_slot.rawSetValue(state.frame, None)  # delete the iterator from the frame slot
+        return end_iterator_location
+
+def _op_aggregator_init(state, data, pc):  # this is the same as clear slot
+    data.rawSetValue(state.frame, None)  # init the value to nothing
+    return pc + 1
+
+def _op_aggregator_add(state, data, pc):
+    slot, body_res, aggregator = data
+    frame = state.frame
+    old_value = slot.getValue(frame)
+    new_value = body_res.getValue(frame)
+    if aggregator.vector_op is not None:
+        # the slot holds a ChunkedReducer until aggregator_finalize
+        if old_value is None:
+            old_value = ChunkedReducer(aggregator)
+            slot.rawSetValue(frame, old_value)
+        old_value.add(new_value)
+        return pc + 1
+    if old_value is not None:
+        new_value = aggregator.combine(old_value, new_value)
+    slot.rawSetValue(frame, new_value)
+    return pc + 1
+
+def _op_aggregator_finalize(state, data, pc):
+    slot, out_var = data
+    value = slot.getValue(state.frame)
+    if type(value) is ChunkedReducer:
+        value = value.result()
+    if value is None:
+        return state.fail()
+        #assert False  # TODO: handle.  In this case there was nothing that got aggregated together and we need to error out this statement and go to whatever the failure handler is in this case
+    else:
+        out_var.rawSetValue(state.frame, value)
+        return pc + 1
+
+def _op_failure_handler_jump(state, data, pc):  # this shouldn't really be here?  I suppose that we currently need to be able to reset this instruction
+    state.failure_handler = data
+    return pc + 1
+
+def _op_failure_handler_conditional_variable(state, data, pc):
+    # set the variable that is currently tracking where failures would be set
+    state.failure_handler_variable = data
+    return pc + 1
+
+def _op_failure_handler_conditional_run(state, data, pc):  # run the next block if it hasn't already been marked as failed, otherwise set
+    next_pc, condition, condition_variable = data
+    failure_condition_value = condition_variable.getValue(state.frame)
+    if failure_condition_value & (1 << condition):
+        # then this branch is currently disabled
+        state.failure_handler = -1
+        return next_pc
+    else:
+        # then this branch is not disabled, so we are going to run the code
+        state.failure_handler = next_pc
+        state.failure_handler_condition = 1 << condition  # use a bit mask for this stuff
+        return pc + 1
+
+
+_OPERATIONS = (
+    ('run_function', _op_run_function),
+    ('jump', _op_jump),
+    ('clear_slot', _op_clear_slot),
+    ('set_slot', _op_set_slot),
+    ('copy_slot', _op_copy_slot),
+    ('iterator_load_start', _op_iterator_load_start),
+    ('iterator_load', _op_iterator_load),
+    ('iterator_start', _op_iterator_start),
+    ('iterator_union_make', _op_iterator_union_make),
+    ('iterator_next', _op_iterator_next),
+    ('aggregator_init', _op_aggregator_init),
+    ('aggregator_add', _op_aggregator_add),
+    ('aggregator_finalize', _op_aggregator_finalize),
+    ('failure_handler_jump', _op_failure_handler_jump),
+    ('failure_handler_conditional_variable', _op_failure_handler_conditional_variable),
+    ('failure_handler_conditional_run', _op_failure_handler_conditional_run),
+)
+
+OPCODES = {name: i for i, (name, _) in enumerate(_OPERATIONS)}  # the name of the instruction -> opcode
+_OPERATION_HANDLERS = [handler for _, handler in _OPERATIONS]  # indexed by the opcode
+
+
 
 
 def run_compiler(dyna_system, ce, R, incoming_mode):
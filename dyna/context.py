@@ -8,10 +8,12 @@ from .interpreter import *
 from .terms import CallTerm, Evaluate, Evaluate_reflect, ReflectStructure, BuildStructure
 from .guards import Assumption, AssumptionWrapper, AssumptionResponse
 from .agenda import Agenda
-from .optimize import run_optimizer
+from .optimize import run_optimizer, run_optimizer_incremental, OptimizerCache
 from .compiler import run_compiler, EnterCompiledCode
-from .memos import rewrite_to_memoize, RMemo, AgendaMessage, process_agenda_message, MemoContainer
+from .memos import rewrite_to_memoize, RMemo, AgendaMessage, push_agenda_message, MemoContainer, generalize_keys, BATCH_GENERALIZE_THRESHOLD
 from .safety_planner import SafetyPlanner
+from . import memo_snapshot
+from . import fact_loading
 
 from functools import reduce
 import operator
@@ -22,7 +24,7 @@ class SystemContext:
     Represents the dyna system with the overrides for which expressions are going to be set and written
     """
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, agenda_policy=None, parallel_agenda=None, slot_frames=False, incremental_optimizer=False):
         # the terms as the user defined them (before we do any rewriting) we can
         # not delete these, as we must keep around the origional definitions
         # so that we can recover in the case of "delete everything" etc
@@ -34,6 +36,10 @@ class SystemContext:
         # the memo tables that are wrapped around the terms.
         self.terms_as_memoized = {}
 
+        # the memo tables made by watch_term_changes.  The assumptions only
+        # hold memo tables weakly, so these are kept here for the callbacks
+        self.term_watchers = []
+
         # Dict[RExpr, CompiledRexprs]
         # when we compile a term this will be the resulting reference for that object
         self.terms_as_compiled = {}
@@ -43,7 +49,17 @@ class SystemContext:
         self.term_assumptions = {}
         self.terms_as_defined_assumptions = {}
 
-        self.agenda = Agenda()
+        # the order in which the agenda processes updates, see agenda.AGENDA_POLICIES
+        # parallel_agenda computes the refreshes of independent memo tables on a thread pool, see Agenda.set_parallel
+        self.agenda = Agenda(agenda_policy, parallel=parallel_agenda)
+
+        # number the variables of the memo tables' bodies and compute them with
+        # SlotFrames (used by memo tables that are set up after this is changed)
+        self.slot_frames = slot_frames
+
+        # reuse the optimized branches of terms that have not changed when a
+        # term is optimized again (see run_optimizer_incremental)
+        self.optimizer_cache = OptimizerCache() if incremental_optimizer else None
 
         self.infered_constraints = []  # the constraints with generic versions that can be quickly matched to identify when something new can be infered
         self.infered_constraints_index = {}
@@ -121,6 +137,8 @@ class SystemContext:
             del self.terms_as_compiled[a]
         if a in self.merged_expressions:
             del self.merged_expressions[a]  # TODO: is this what we want?
+        if self.optimizer_cache is not None:
+            self.optimizer_cache.forget(a)
 
         # do invalidation last as we want anything that rechecks to get the new values
         self.invalidate_term_assumption(a)
@@ -153,7 +171,10 @@ class SystemContext:
             nm[rexpr.result] = prev.result
             nm[rexpr.body_res] = prev.body_res
 
-            nr = rexpr.rename_vars(lambda x: nm.get(x,x))
+            if any(k != v for k, v in nm.items()):
+                nr = rexpr.rename_vars(lambda x: nm.get(x,x))
+            else:
+                nr = rexpr  # eg load_facts, which already uses the variables of the current expression
 
             # merge the branches of the partition
             assert isinstance(prev.body, Partition) and isinstance(nr.body, Partition)
@@ -162,8 +183,9 @@ class SystemContext:
             # this is going to modify the branches of the currently stored body rather than create something new...sigh, I guess we also do this with the memos
 
             mt = prev.body._children
-            for key, vals in nr.body._children.items():
-                mt.setdefault(key, []).extend(vals)
+            if not (isinstance(mt, ColumnarTrie) and mt.extend_rows(nr.body._children)):
+                for key, vals in nr.body._children.items():
+                    mt.setdefault(key, []).extend(vals)
 
             # if there is a memo table, then will mark these keys as needing to be refreshed
             memoized = self.terms_as_memoized.get(a)
@@ -171,9 +193,14 @@ class SystemContext:
                 for child in memoized.all_children():
                     if isinstance(child, RMemo):
                         table = child.memos
-                        for key, vals in nr.body._children.items():
+                        table.body_extended()
+                        new_keys = nr.body._children.keys()
+                        if len(nr.body._children) > BATCH_GENERALIZE_THRESHOLD:
+                            # eg load_facts, these would be generalized on the agenda anyways
+                            new_keys = [generalize_keys(new_keys)]
+                        for key in new_keys:
                             msg = AgendaMessage(table=table, key=key)
-                            self.agenda.push(lambda: process_agenda_message(msg))
+                            push_agenda_message(msg, dyna_system=self)
 
         # track that this expression has changed, which can cause things to get recomputed/propagated to the agenda etc
         self.invalidate_term_as_defined_assumption(a)
@@ -193,8 +220,11 @@ class SystemContext:
                 name = k
         return t.aggregator, k
 
-    def memoize_term(self, name, kind='null', mem_variables=None):
+    def memoize_term(self, name, kind='null', mem_variables=None, max_entries=None, eviction=None):
+        # max_entries bounds the size of an unk memo table, with the entries to
+        # delete selected by eviction ('lru' or 'lfu', see memos.MEMO_EVICTION_POLICIES)
         assert kind in ('unk', 'null', 'none')
+        assert max_entries is None or kind == 'unk', 'only unk memo tables can be bounded'
 
         if mem_variables is not None:
             mem_variables = variables_named(*mem_variables)  # ensure these are cast to variables
@@ -207,7 +237,8 @@ class SystemContext:
             # this really needs to call, but avoid hitting the memo wrapper that we
             # are going to add.  As in the case that the assumption is blown then we
             # are going to want to get a new version of the code.
-            Rm = rewrite_to_memoize(R, mem_variables=mem_variables, is_null_memo=(kind == 'null'), dyna_system=self)
+            Rm = rewrite_to_memoize(R, mem_variables=mem_variables, is_null_memo=(kind == 'null'), dyna_system=self,
+                                    max_entries=max_entries, eviction=eviction)
             self.terms_as_memoized[name] = Rm
         else:
             self.terms_as_memoized.pop(name)
@@ -220,6 +251,53 @@ class SystemContext:
                     # single to anything that was depending on this memo table that it no longer exists
                     child.memos.assumption.invalidate()
 
+    def memo_containers(self, name):
+        Rm = self.terms_as_memoized.get(name)
+        if Rm is None:
+            return []
+        return [c.memos for c in Rm.all_children() if isinstance(c, RMemo)]
+
+    def optimizer_counters(self):
+        # how many branches (and R-expr nodes) were optimized or reused from the cache by the incremental optimizer
+        if self.optimizer_cache is None:
+            return {}
+        return self.optimizer_cache.counters()
+
+    def assumption_fan_out(self):
+        # the number of live receivers of the assumptions of the terms and memo
+        # tables, as {assumption: fan out}
+        res = {}
+        for a in (*self.terms_as_defined_assumptions.values(), *self.term_assumptions.values()):
+            res[a] = a.fan_out()
+        for name in self.terms_as_memoized:
+            for m in self.memo_containers(name):
+                res[m.assumption] = m.assumption.fan_out()
+        return res
+
+    def memo_counters(self, name):
+        # the hit/miss/eviction counters of the memo tables for a term
+        res = {}
+        for m in self.memo_containers(name):
+            for k, v in m.counters().items():
+                res[k] = res.get(k, 0) + v
+        return res
+
+    def save_memo_snapshot(self, path):
+        # write the converged null memo tables to a file, see memo_snapshot.py
+        return memo_snapshot.save_memo_snapshot(self, path)
+
+    def load_memo_snapshot(self, path):
+        # the tables must already be memoized, returns None if the program has changed since the snapshot was saved
+        return memo_snapshot.load_memo_snapshot(self, path)
+
+    def load_facts(self, name, arity, rows, aggregator=':-'):
+        # add many facts to a term with a single invalidation, see fact_loading.py
+        return fact_loading.load_facts(self, name, arity, rows, aggregator)
+
+    def load_file(self, path, name, arity=None, **options):
+        # stream the rows of a csv, tsv, ndjson or npy file into the facts of name
+        return fact_loading.load_file(self, path, name, arity, **options)
+
     def define_infered(self, required :RBaseType, added :RBaseType):
         z = (required, added)
         self.infered_constraints.append(z)
@@ -300,6 +378,15 @@ class SystemContext:
     def run_agenda(self):
         return self.agenda.run()
 
+    def set_agenda_policy(self, policy):
+        # policy is one of 'fifo', 'lifo', 'selective' (prioritized by the value
+        # for min=/max= tables), a key function of the agenda task or an AgendaPolicy
+        self.agenda.set_policy(policy)
+
+    def set_agenda_parallel(self, parallel):
+        # None/False for the serial agenda, True or the number of threads, or an Executor
+        self.agenda.set_parallel(parallel)
+
     def optimize_system(self):
         # want to optimize all of the rules in the program, which will then
         # require that expressions are handled if they are later invalidated?
@@ -355,7 +442,10 @@ class SystemContext:
             name, arity = term  # the name matching the way that we are storing dyna terms
             r = self.terms_as_defined[term]
             exposed = (ret_variable, *variables_named(*range(arity)))
-        rr, assumptions = run_optimizer(r, exposed)
+        if self.optimizer_cache is not None:
+            rr, assumptions = run_optimizer_incremental(r, exposed, self.optimizer_cache, term)
+        else:
+            rr, assumptions = run_optimizer(r, exposed)
 
         assumptions.add(assumpt_d)
         #assumptions.add(assumpt)
@@ -429,11 +519,18 @@ class SystemContext:
             def signal(self, msg):
                 callback(msg)
 
+            def isValid(self):
+                # this is invalidated along with the memo table, but is tracked
+                # again by the new assumption of the memo table, so it is never
+                # removed as a stale dependent
+                return True
+
         R = self.call_term(name, arity)
         R = partition(variables, [R])
         argument_mode = (True,)*arity+(False,)
         supported_mode = (False,)*len(argument_mode)
         memos = MemoContainer(argument_mode, supported_mode, variables, R, is_null_memo=True, assumption_always_listen=(AL(),), dyna_system=self)
+        self.term_watchers.append(memos)
 
         return memos
 
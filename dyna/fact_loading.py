@@ -0,0 +1,341 @@
+# Loading many facts into a term at once
+#
+# Adding facts one at a time (with add_rules or the `table[...] = value` of the
+# python api) parses and normalizes each fact, renames its variables, merges it
+# into the partition of the term and invalidates the term (and everything which
+# depends on it) once for every fact.  load_facts instead builds the partition
+# of all of the facts directly as a ColumnarTrie, with a column for each
+# argument and the value, and adds it to the term with a single call to
+# add_to_term.  A column which is all ints or all floats is stored as an array
+# (a numpy array is copied into it without creating a python object per value).
+#
+# A row is the arguments of a fact followed by its value.  For `:-` the value is
+# True and can be left out, so the rows of `edge(1,2).` are just (1, 2).  For
+# `:=` (which is what the tables of the python api use) every row gets its own
+# line number, so a later row overrides an earlier row with the same arguments,
+# the same as a later `:=` rule.
+#
+# load_file streams the rows of a csv, tsv, ndjson or npy file.  The file is
+# read a chunk of rows at a time, and each chunk is parsed into typed columns
+# which are appended to the columns of the earlier chunks, so only the rows of
+# one chunk exist as python objects at any time.  The term is then extended
+# (and invalidated) once at the end, rather than once per row or chunk.
+
+import csv
+import itertools
+import json
+import os
+from array import array
+
+import numpy as np
+
+from .interpreter import Aggregator, Partition, Terminal, VariableId, ret_variable, variables_named
+from .prefix_trie import ColumnarTrie
+from .terms import Term
+from .aggregators import AGGREGATORS, colon_line_tracking
+
+# aggregators where loading the same row twice is the same as loading it once
+_SET_AGGREGATORS = (':-', '=')
+
+
+def _column(values):
+    # an array for a column of all ints or all floats, otherwise a list
+    types = set(map(type, values))
+    if types == {int}:
+        try:
+            return array('q', values)
+        except OverflowError:
+            pass
+    elif types == {float}:
+        return array('d', values)
+    return list(values)
+
+
+def _numpy_column(values):
+    kind = values.dtype.kind
+    if kind in 'iu' and (kind == 'i' or values.size == 0 or int(values.max()) < 2**63):
+        r = array('q')
+        r.frombytes(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+        return r
+    if kind == 'f':
+        r = array('d')
+        r.frombytes(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return r
+    return values.tolist()
+
+
+def fact_columns(rows, aggregator=':-'):
+    """
+    The columns of rows which are either an iterable of tuples or a 2d numpy
+    array, without duplicate rows for `:-` and `=`.  Returns None if there are
+    no rows.
+    """
+    if isinstance(rows, np.ndarray):
+        if rows.ndim == 1:
+            rows = rows.reshape(-1, 1)
+        if rows.ndim != 2:
+            raise ValueError('expected a 2d array of facts')
+        if aggregator in _SET_AGGREGATORS and rows.dtype.kind in 'iufb':
+            rows = np.unique(rows, axis=0)
+        elif rows.dtype.kind not in 'iufb':
+            rows = rows.tolist()  # dedup and build the columns as python values below
+    if isinstance(rows, np.ndarray):
+        if not len(rows):
+            return None
+        columns = [_numpy_column(rows[:, i]) for i in range(rows.shape[1])]
+    else:
+        rows = [tuple(r) for r in rows]
+        if aggregator in _SET_AGGREGATORS:
+            rows = list(dict.fromkeys(rows))
+        if not rows:
+            return None
+        width = len(rows[0])
+        if any(len(r) != width for r in rows):
+            raise ValueError('all of the facts must have the same number of arguments')
+        columns = [_column(c) for c in zip(*rows)]
+
+    return columns
+
+
+def add_fact_columns(dyna_system, name, arity, columns, aggregator=':-'):
+    """
+    Add the rows of the columns (which should not contain duplicates) to the
+    term name/arity with a single call to add_to_term.  Returns the number of rows.
+    """
+    if aggregator not in (*_SET_AGGREGATORS, ':='):
+        raise ValueError(f'can not load facts with the aggregator {aggregator}')
+    columns = list(columns)
+    if len(columns) == arity and aggregator == ':-':
+        columns.append([True] * len(columns[0]))
+    if len(columns) != arity + 1:
+        raise ValueError(f'expected rows with {arity} arguments and a value, got {len(columns)} columns')
+
+    if aggregator == ':=':
+        columns[-1] = [Term('$colon_line_tracking', (colon_line_tracking(), v)) for v in columns[-1]]
+    elif aggregator == ':-' and any(v is not True for v in columns[-1]):
+        raise ValueError('the value of a `:-` fact must be True')
+
+    # use the variables of the current definition, so that add_to_term does
+    # not have to rename the rows
+    prev = dyna_system.terms_as_defined.get((name, arity))
+    if (isinstance(prev, Aggregator) and isinstance(prev.body, Partition) and
+        prev.body._unioned_vars == (*prev.head_vars, prev.body_res)):
+        result, head_vars, body_res = prev.result, prev.head_vars, prev.body_res
+    else:
+        result, head_vars, body_res = ret_variable, variables_named(*range(arity)), VariableId()
+
+    trie = ColumnarTrie.from_columns(columns, Terminal(1))
+    R = Aggregator(result, head_vars, body_res, AGGREGATORS[aggregator], Partition((*head_vars, body_res), trie))
+    dyna_system.add_to_term(name, arity, R)
+    return len(columns[0])
+
+
+def load_facts(dyna_system, name, arity, rows, aggregator=':-'):
+    """
+    Add the facts `name(args...) aggregator value` for all of the rows to the
+    program, invalidating the term once.  Returns the number of rows which were
+    added (after removing duplicates).
+    """
+    columns = fact_columns(rows, aggregator)
+    if columns is None:
+        return 0
+    return add_fact_columns(dyna_system, name, arity, columns, aggregator)
+
+
+def _parse_csv_value(s):
+    # ints, then floats, otherwise the string
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s)
+    except ValueError:
+        return s
+
+
+CHUNK_ROWS = 65536
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _check_width(path, rows):
+    width = len(rows[0])
+    if any(len(r) != width for r in rows):
+        raise ValueError(f'{path}: all of the rows must have the same number of columns')
+    return width
+
+
+def _parse_column(values, kind, strict):
+    # returns (column, kind).  An inferred kind (strict is False) falls back
+    # from int to float to parsing each value on its own if a value does not
+    # parse, an explicit kind raises the ValueError instead
+    while True:
+        try:
+            if kind == 'int':
+                return array('q', map(int, values)), kind
+            if kind == 'float':
+                return array('d', map(float, values)), kind
+            if kind == 'str':
+                return list(values), kind
+            if kind == 'auto':
+                return _column([_parse_csv_value(v) for v in values]), kind
+            if callable(kind):
+                return _column(list(map(kind, values))), kind
+        except (ValueError, OverflowError):
+            if strict:
+                raise
+            kind = 'float' if kind == 'int' else 'auto'
+            continue
+        raise ValueError(f'unknown column type {kind!r}')
+
+
+def iter_csv_columns(path, types=None, header=False, delimiter=',', chunk_rows=CHUNK_ROWS):
+    """
+    The typed columns of a csv file, a chunk of rows at a time.  types is a
+    type for each column ('int', 'float', 'str', 'auto' or a function of the
+    string), otherwise the type of each column is inferred.
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        if header:
+            next(reader, None)
+        kinds = None
+        for chunk in _chunks((r for r in reader if r), chunk_rows):
+            width = _check_width(path, chunk)
+            if kinds is None:
+                kinds = list(types) if types is not None else ['int'] * width
+                if len(kinds) != width:
+                    raise ValueError(f'{path}: got {len(kinds)} column types for {width} columns')
+            columns = []
+            for i, values in enumerate(zip(*chunk)):
+                c, kinds[i] = _parse_column(values, kinds[i], types is not None)
+                columns.append(c)
+            yield columns
+
+
+def _json_value(v):
+    if isinstance(v, list):
+        return Term.fromlist([_json_value(x) for x in v])
+    if v is None or isinstance(v, dict):
+        raise ValueError(f'can not load {json.dumps(v)} as a value')
+    return v
+
+
+def iter_ndjson_columns(path, fields=None, chunk_rows=CHUNK_ROWS):
+    """
+    The columns of a file with a json value on each line, a chunk of rows at a
+    time.  A line is either a list of the columns or an object, in which case
+    the columns are the values of fields (by default the keys of the first object).
+    """
+    with open(path) as f:
+        for chunk in _chunks((json.loads(l) for l in f if l.strip()), chunk_rows):
+            rows = []
+            for r in chunk:
+                if isinstance(r, dict):
+                    if fields is None:
+                        fields = list(r)
+                    r = [r[k] for k in fields]
+                elif not isinstance(r, list):
+                    r = [r]
+                rows.append(tuple(map(_json_value, r)))
+            _check_width(path, rows)
+            yield [_column(c) for c in zip(*rows)]
+
+
+def iter_npy_columns(path, chunk_rows=CHUNK_ROWS):
+    """
+    The columns of a 2d array saved with numpy.save, a chunk of rows at a time.
+    The file is mmaped rather than read into memory.
+    """
+    arr = np.load(path, mmap_mode='r')
+    if arr.ndim == 1:
+        arr = arr.reshape(-1, 1)
+    if arr.ndim != 2:
+        raise ValueError(f'{path}: expected a 2d array of facts')
+    for start in range(0, len(arr), chunk_rows):
+        chunk = arr[start:start+chunk_rows]
+        yield [_numpy_column(chunk[:, i]) for i in range(chunk.shape[1])]
+
+
+FILE_FORMATS = {
+    'csv': iter_csv_columns,
+    'tsv': lambda path, **options: iter_csv_columns(path, delimiter='\t', **options),
+    'ndjson': iter_ndjson_columns,
+    'jsonl': iter_ndjson_columns,
+    'npy': iter_npy_columns,
+}
+
+
+def _extend_columns(columns, chunk):
+    # append the columns of a chunk to the columns of the earlier chunks
+    if columns is None:
+        return chunk
+    if len(chunk) != len(columns):
+        raise ValueError('all of the rows must have the same number of columns')
+    for i, c in enumerate(chunk):
+        a = columns[i]
+        if type(a) is array and type(c) is array and a.typecode == c.typecode:
+            a.extend(c)
+        else:
+            if type(a) is array:
+                a = columns[i] = a.tolist()
+            a.extend(c)
+    return columns
+
+
+def _unique_rows(columns):
+    # the columns without the rows which are the same as an earlier row
+    nrows = len(columns[0])
+    arrays = None
+    if all(type(c) is array for c in columns):
+        arrays = [np.frombuffer(c, dtype=np.int64 if c.typecode == 'q' else np.float64) for c in columns]
+        # rows with a nan are never the same as another row (as nan != nan),
+        # which is left to the dict below
+        if any(a.dtype == np.float64 and np.isnan(a).any() for a in arrays):
+            arrays = None
+    if arrays is not None:
+        # compare the bits of the values, so an array of ints and floats can
+        # be sorted together.  Adding 0.0 turns -0.0 into 0.0, as they are equal
+        bits = [(a + 0.0 if a.dtype == np.float64 else a).view(np.int64) for a in arrays]
+        _, first = np.unique(np.column_stack(bits), axis=0, return_index=True)
+        if len(first) == nrows:
+            return columns
+        first.sort()
+        return [array(c.typecode, a[first].tobytes()) for c, a in zip(columns, arrays)]
+    rows = dict.fromkeys(zip(*columns))
+    if len(rows) == nrows:
+        return columns
+    return [_column(c) for c in zip(*rows)]
+
+
+def load_file(dyna_system, path, name, arity=None, format=None, aggregator=':-', **options):
+    """
+    Stream the rows of a csv, tsv, ndjson or npy file into the facts of name.
+    The format is found from the extension of the file if it is not given, and
+    the options are passed to the iter_*_columns function for the format.  The
+    number of arguments is the number of columns (less the value for
+    aggregators other than `:-`) if arity is not given.  Returns the number of
+    rows which were added.
+    """
+    if format is None:
+        format = os.path.splitext(path)[1].lstrip('.').lower()
+    if format not in FILE_FORMATS:
+        raise ValueError(f'unknown file format {format!r} for {path}')
+    columns = None
+    for chunk in FILE_FORMATS[format](path, **options):
+        columns = _extend_columns(columns, chunk)
+    if columns is None:
+        return 0
+    if aggregator in _SET_AGGREGATORS:
+        columns = _unique_rows(columns)
+    if arity is None:
+        arity = len(columns) - (aggregator != ':-')
+    return add_fact_columns(dyna_system, name, arity, columns, aggregator)
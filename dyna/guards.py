@@ -1,5 +1,9 @@
+import weakref
+
 from .interpreter import *
 
+PRUNE_SIZE = 64  # the number of dependents before track first removes the invalid ones
+
 class Assumption:
     """
     The assumption object that we are going to track
@@ -8,20 +12,73 @@ class Assumption:
     """
 
     def __init__(self, name=None):
+        # receivers which are kept alive by something else (weak_track is set
+        # on their class) are only weakly referenced, so that a memo table which
+        # has been dropped is not kept around by the assumptions it read from.
+        # Other receivers (AssumptionResponse) might only be referenced by this
+        # assumption.  Receivers which have become invalid are removed when they
+        # are found by signal or track
         self._dependents = set()
+        self._weak_dependents = weakref.WeakSet()
+        # receivers which only want the signals for some keys, indexed by the
+        # positions in the key which are matched
+        # {positions: {values at the positions: (set, WeakSet)}}
+        self._routes = {}
         self._invalid = False  # invalid can only go from False -> True, there is no transition back to False
         self._name = name
+        self._tracked = 0
+        self._prune_at = PRUNE_SIZE
 
-        # TODO: this should delete references to assumptions which are no longer valid
-
-    def track(self, reciever):
+    def track(self, reciever, key_patterns=None):
+        # key_patterns are the keys of the signals which the reciever wants
+        # (with None for any value at a position), or None for all signals
         assert not self._invalid
-        self._dependents.add(reciever)
+        weak = bool(getattr(reciever, 'weak_track', False))
+        if key_patterns is None or any(all(v is None for v in p) for p in key_patterns):
+            (self._weak_dependents if weak else self._dependents).add(reciever)
+        else:
+            for p in key_patterns:
+                positions = tuple(i for i, v in enumerate(p) if v is not None)
+                values = tuple(p[i] for i in positions)
+                buckets = self._routes.setdefault(positions, {})
+                b = buckets.get(values)
+                if b is None:
+                    b = buckets[values] = (set(), weakref.WeakSet())
+                b[weak].add(reciever)
+        self._tracked += 1
+        if self._tracked >= self._prune_at:
+            self._prune()
+            self._tracked = self.fan_out()
+            self._prune_at = max(PRUNE_SIZE, 2 * self._tracked)
+
+    def _containers(self):
+        yield self._dependents
+        yield self._weak_dependents
+        for buckets in self._routes.values():
+            for b in buckets.values():
+                yield from b
+
+    def _prune(self):
+        for c in self._containers():
+            for d in [d for d in c if not d.isValid()]:
+                c.discard(d)
+        for positions, buckets in list(self._routes.items()):
+            for values, (strong, weak) in list(buckets.items()):
+                if not strong and not weak:
+                    del buckets[values]
+            if not buckets:
+                del self._routes[positions]
 
     def invalidate(self):
         if not self._invalid:
             self._invalid = True
-            for d in self._dependents:
+            dependents = self.dependents()
+            # nothing can be tracked after this, and the dependents will all be
+            # invalid, so this does not need to keep them
+            self._dependents = set()
+            self._weak_dependents = weakref.WeakSet()
+            self._routes = {}
+            for d in dependents:
                 d.notify_invalidated()
 
     def notify_invalidated(self):
@@ -32,9 +89,44 @@ class Assumption:
         # this should be overriden such that it tracks
         self.invalidate()
 
+    def _recievers(self, key):
+        # the receivers of a signal for key (None if the signal is not for a key)
+        yield from self._dependents
+        yield from self._weak_dependents
+        for positions, buckets in self._routes.items():
+            if key is None or any(key[i] is None for i in positions):
+                # the signal might be for any of the values at these positions
+                for b in buckets.values():
+                    yield from b[0]
+                    yield from b[1]
+            else:
+                b = buckets.get(tuple(key[i] for i in positions))
+                if b is not None:
+                    yield from b[0]
+                    yield from b[1]
+
     def signal(self, msg):
-        for d in self._dependents:
-            d.signal(msg)
+        stale = False
+        recievers = list(self._recievers(getattr(msg, 'key', None)))
+        if self._routes:
+            # a reciever which is routed with more than one pattern might match more than once
+            recievers = list(dict.fromkeys(recievers))
+        for d in recievers:
+            if d.isValid():
+                d.signal(msg)
+            else:
+                stale = True
+        if stale:
+            self._prune()
+
+    def dependents(self):
+        # the receivers which are still valid
+        self._prune()
+        return list(dict.fromkeys(d for c in self._containers() for d in c))
+
+    def fan_out(self):
+        # the number of receivers which might be notified by signal
+        return len(set(d for c in self._containers() for d in c))
 
     def __str__(self):
         return f'Assumption({self._name}, valid={not self._invalid})'
@@ -48,7 +140,9 @@ class Assumption:
 
 class AssumptionListener:
     # something that can be invalidated, and then will turn of getting further
-    # signals, though, we are going to want to clean these out or something....
+    # signals.  This is held by the memo table which it wraps, so the
+    # assumptions only keep a weak reference to it
+    weak_track = True
 
     def __init__(self, wrapped):
         self.wrapped = wrapped
@@ -68,6 +162,9 @@ class AssumptionListener:
         # something else that should be done here
         self.invalidate()
 
+    def isValid(self):
+        return not self._invalid
+
 
 class AssumptionResponse:
 
@@ -86,6 +183,9 @@ class AssumptionResponse:
     def notify_invalidated(self):
         self.invalidate()
 
+    def isValid(self):
+        return self.method is not None
+
 
 class AssumptionWrapper(RBaseType):
 
@@ -1,7 +1,12 @@
 from typing import *
+from collections import OrderedDict
 import pprint
+import sys
+import time
+import weakref
 
-from .prefix_trie import PrefixTrie
+from .prefix_trie import PrefixTrie, ColumnarTrie, FlatTrie
+from .vector_reduce import ChunkedReducer
 from .exceptions import *
 
 TRACK_CONSTRUCTED_FROM = False
@@ -9,7 +14,12 @@ TRACK_CONSTRUCTED_FROM = False
 
 class RBaseType:
 
-    __slots__ = ('_hashcache',) + (('_constructed_from',) if TRACK_CONSTRUCTED_FROM else ())
+    __slots__ = ('_hashcache', '__weakref__') + (('_constructed_from',) if TRACK_CONSTRUCTED_FROM else ())
+
+    # if simplify only depends on the values of the variables in the frame
+    # (not reading memo tables, calling other terms, etc), so the result can be
+    # cached by the SimplifyCache
+    _simplify_deterministic = False
 
     def __init__(self):
         self._hashcache = None
@@ -40,6 +50,13 @@ class RBaseType:
         self._hashcache = hv
         return hv
 
+    def _intern_key(self):
+        # the key used by hash consing (see InternPool), None if this type of
+        # R-expr is not interned.  The key only refers to the children by
+        # their identity, so that interning is not recursive.  It has to
+        # include everything which makes the R-expr distinct, as the __eq__ of
+        # some R-exprs ignores things like the name of a structure
+        return None
     def rewrite(self, rewriter=lambda x: x):
         return self
     def rename_vars(self, remap):
@@ -139,6 +156,7 @@ class FinalState(RBaseType):
 
 class Terminal(FinalState):
     __slots__ = ('multiplicity',)
+    _simplify_deterministic = True
     def __init__(self, multiplicity):
         super().__init__()
         self.multiplicity = multiplicity
@@ -150,6 +168,8 @@ class Terminal(FinalState):
         return self.multiplicity == 0
     def _tuple_rep(self):
         return (self.__class__.__name__, self.multiplicity)
+    def _intern_key(self):
+        return Terminal, type(self.multiplicity), self.multiplicity
 
 
 # if might be better to make this its own top level thing.  We might want to
@@ -175,6 +195,85 @@ def terminal(n):
     return Terminal(n)
 
 
+class InternPool:
+    """
+    Hash consing of R-exprs.  R-exprs that are structurally the same are
+    replaced with a single object, so that comparing them is an identity check
+    rather than recursing through the children.  The pool only holds weak
+    references, so R-exprs which are no longer used are removed from it.
+
+    Only immutable R-exprs which define _intern_key are interned.  Partitions
+    are modified in place by the memo tables, so they are never shared.
+    """
+
+    def __init__(self):
+        self._pool = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, R, key=None):
+        if key is None:
+            key = R._intern_key()
+            if key is None:
+                return R
+        try:
+            r = self._pool.get(key)
+            if r is None:
+                self._pool[key] = r = R
+                self.misses += 1
+            else:
+                self.hits += 1
+        except TypeError:
+            # some constant in the R-expr is not hashable
+            return R
+        return r
+
+    def intern_deep(self, R):
+        # intern the children first so that the keys of the parents match
+        if R._intern_key() is None:
+            return R
+        return self.intern(R.rewrite(self.intern_deep))
+
+    def stats(self):
+        return {'size': len(self._pool), 'hits': self.hits, 'misses': self.misses}
+
+
+def intern_var_key(v):
+    # a variable in an _intern_key.  Constants are equal (and hash the same)
+    # when their values are, so the constants 1, 1.0 and True also need the
+    # type of the value to not be interned as the same R-expr
+    if isinstance(v, ConstantVariable):
+        val = v.getValue(None)
+        return ConstantVariable, type(val), val
+    return v
+
+def intern_vars_key(vs):
+    return tuple(map(intern_var_key, vs))
+
+
+_intern_pool = None
+
+
+def hash_consing(enabled=True):
+    """
+    Turn hash consing of the R-exprs returned by visitors (such as simplify) on
+    or off.  Returns the InternPool, or None if it was turned off.
+    """
+    global _intern_pool
+    if not enabled:
+        _intern_pool = None
+    elif _intern_pool is None:
+        _intern_pool = InternPool()
+    return _intern_pool
+
+
+def intern_rexpr(R):
+    # returns the interned version of R (and its children), or R if hash consing is not enabled
+    if _intern_pool is None:
+        return R
+    return _intern_pool.intern_deep(R)
+
+
 ####################################################################################################
 # Frame base type
 
@@ -229,8 +328,7 @@ class VariableId(Variable):
         return frame.get(self.__name, InvalidValue)
 
     def _unset(self, frame):
-        if self.__name in frame:
-            del frame[self.__name]
+        frame._frame_unset(self.__name)
 
     def setValue(self, frame, value):
         return frame._frame_setvalue(self.__name, value)
@@ -243,7 +341,7 @@ class VariableId(Variable):
         # return True  # if not equal return values, todo handle this throughout the code
 
     def rawSetValue(self, frame, value):
-        frame[self.__name] = value
+        frame._frame_rawsetvalue(self.__name, value)
 
     def setType(self, frame, typ):
         frame._frame_settype(self.__name, typ)
@@ -252,7 +350,7 @@ class VariableId(Variable):
         return frame._frame_gettype(self.__name)
 
     def _unset_type(self, frame):
-        frame.variable_types.pop(self.__name, None)
+        frame._frame_unsettype(self.__name)
 
     def __eq__(self, other):
         return (self is other) or (type(self) is type(other) and (self.__name == other.__name))
@@ -322,6 +420,93 @@ class ConstantVariable(Variable):
 #         assert value is not InvalidValue  # ignore setting a value as no one will read it.....
 #         return True
 
+class SlotVariable(VariableId):
+    # A variable which has been numbered by number_variables.  On a SlotFrame
+    # the value is stored at the slot in a list instead of in the dict.  This is
+    # equal to the VariableId with the same name, which is where the value is
+    # stored on any other frame
+    __slots__ = ('_slot',)
+
+    def __init__(self, slot):
+        super().__init__(f'$S{slot}')
+        self._slot = slot
+
+    def isBound(self, frame):
+        try:
+            return (frame._slot_bound >> self._slot) & 1 == 1
+        except AttributeError:
+            return frame._frame_isbound(self._VariableId__name)
+
+    def getValue(self, frame):
+        try:
+            return frame._slot_values[self._slot]
+        except AttributeError:
+            return frame.get(self._VariableId__name, InvalidValue)
+        except IndexError:
+            return InvalidValue
+
+    # the common case of a slot within the SlotFrame's list is inlined here
+    # rather than calling the frame, which would cost more than hashing the name
+
+    def setValue(self, frame, value):
+        try:
+            values = frame._slot_values
+            old = values[self._slot]
+        except AttributeError:
+            return frame._frame_setvalue(self._VariableId__name, value)
+        except IndexError:
+            return frame._frame_slot_setvalue(self._slot, value)
+        if old is not InvalidValue:
+            if old != value:
+                raise UnificationFailure()
+            return True
+        slot = self._slot
+        if frame._trail is not None:
+            frame._trail.append((None, slot, InvalidValue))
+        values[slot] = value
+        frame._slot_bound |= 1 << slot
+        return True
+
+    def rawSetValue(self, frame, value):
+        try:
+            set_slot = frame._frame_slot_rawsetvalue
+        except AttributeError:
+            return frame._frame_rawsetvalue(self._VariableId__name, value)
+        set_slot(self._slot, value)
+
+    def _unset(self, frame):
+        try:
+            values = frame._slot_values
+            old = values[self._slot]
+        except AttributeError:
+            return frame._frame_unset(self._VariableId__name)
+        except IndexError:
+            return
+        if old is not InvalidValue:
+            slot = self._slot
+            if frame._trail is not None:
+                frame._trail.append((None, slot, old))
+            values[slot] = InvalidValue
+            frame._slot_bound &= ~(1 << slot)
+
+    def __eq__(self, other):
+        return (self is other) or (isinstance(other, VariableId) and self._VariableId__name == other._VariableId__name)
+    def __hash__(self):
+        return hash(VariableId) ^ hash(self._VariableId__name)
+
+
+def number_variables(R, ignored=()):
+    """
+    Rename the variables of R (other than the ignored ones) to SlotVariables,
+    which are numbered densely in the order that weak_equiv uses.  Returns (R,
+    the number of slots).  A SlotFrame with that many slots stores the values
+    of the variables in a list.
+    """
+    R, wmap = R.weak_equiv(ignored=ignored)
+    slots = {w: SlotVariable(i) for i, w in enumerate(wmap)}
+    return R.rename_vars(lambda v: slots.get(v, v)), len(slots)
+
+
 def variables_named(*vars):
     return tuple((VariableId(v) if not isinstance(v, Variable) else v for v in vars))
 
@@ -334,12 +519,57 @@ ret_variable = VariableId('Return')
 def constant(v):
     return ConstantVariable(None, v)
 
-class Frame(dict):
-    __slots__ = ('call_stack', 'in_optimizer', 'assumption_tracker', 'variable_types')
+_trail_unbound = object()  # marker on the trail for an entry which was not previously set
+
+
+class SlotTrail:
+    # The undo log of changes made to a frame since the first mark, like the
+    # trail of the WAM.  This lets loops bind variables in place and rollback
+    # afterwards instead of copying the frame for every binding.  The entries
+    # are (dict, key, old value) or (None, slot, old value) for a value that
+    # is stored in a list, which is restored by _restore_slot.  This is shared
+    # by Frame, SlotFrame and the compiler's CompiledFrame.
+    __slots__ = ()
+
+    def mark(self):
+        # returns a position that the frame can later be rolled back to using
+        # `undo`.  Every mark must be paired with a `release`
+        if self._trail is None:
+            self._trail = []
+        self._trail_marks += 1
+        return len(self._trail)
+
+    def undo(self, mark):
+        # undo all of the changes to the values and types since the mark
+        trail = self._trail
+        while len(trail) > mark:
+            d, key, old = trail.pop()
+            if d is None:
+                self._restore_slot(key, old)
+            elif old is _trail_unbound:
+                d.pop(key, None)
+            else:
+                d[key] = old
+
+    def release(self, mark):
+        # undo the changes and stop tracking the mark
+        self.undo(mark)
+        self._trail_marks -= 1
+        if self._trail_marks == 0:
+            self._trail = None
+
+    def _restore_slot(self, slot, old):
+        raise NotImplementedError()
+
+
+class Frame(dict, SlotTrail):
+    __slots__ = ('call_stack', 'in_optimizer', 'assumption_tracker', 'variable_types', '_trail', '_trail_marks')
 
     def __init__(self, f=None):
         if f is not None:
             super().__init__(f)
+            if isinstance(f, SlotFrame) and not isinstance(self, SlotFrame):
+                self.update(f._slot_items())  # the names of the SlotVariables are used on a Frame
             self.call_stack = f.call_stack.copy()
             self.in_optimizer = f.in_optimizer
             self.assumption_tracker = f.assumption_tracker
@@ -350,6 +580,10 @@ class Frame(dict):
             self.in_optimizer = False  # if we are in the optimizer, meaning that we should avoid performing reads of the memo tables as we want a generic expression
             self.assumption_tracker = lambda x: None  # when we encounter an assumption during simplification, log that here
             self.variable_types = {}
+        # see SlotTrail.  This is None when nothing is marked so that there is
+        # no cost when not looping
+        self._trail = None
+        self._trail_marks = 0
 
     def __repr__(self):
         nice = {str(k).split('\n')[0]: v for k,v in self.items()}
@@ -361,9 +595,22 @@ class Frame(dict):
             if self[varname] != value:
                 raise UnificationFailure()
         else:
+            if self._trail is not None:
+                self._trail.append((self, varname, _trail_unbound))
             self[varname] = value
         return True
 
+    def _frame_rawsetvalue(self, varname, value):
+        if self._trail is not None:
+            self._trail.append((self, varname, self.get(varname, _trail_unbound)))
+        self[varname] = value
+
+    def _frame_unset(self, varname):
+        if varname in self:
+            if self._trail is not None:
+                self._trail.append((self, varname, self[varname]))
+            del self[varname]
+
     def _frame_isbound(self, varname):
         return varname in self
 
@@ -371,6 +618,8 @@ class Frame(dict):
         if not self.in_optimizer:
             ot = self.variable_types.get(varname)
             if ot is None:
+                if self._trail is not None:
+                    self._trail.append((self.variable_types, varname, _trail_unbound))
                 self.variable_types[varname] = typ
             elif ot != typ:
                 # these are two different types
@@ -379,14 +628,98 @@ class Frame(dict):
     def _frame_gettype(self, varname):
         return self.variable_types.get(varname)
 
+    def _frame_unsettype(self, varname):
+        if varname in self.variable_types:
+            if self._trail is not None:
+                self._trail.append((self.variable_types, varname, self.variable_types[varname]))
+            del self.variable_types[varname]
+
+
+class SlotFrame(Frame):
+    # A frame where the values of SlotVariables are stored in a list (indexed
+    # by the slot) with a bitmap of which slots are bound, instead of hashing
+    # the name of the variable.  Other variables are stored in the dict like a
+    # Frame.  The number of slots comes from number_variables, and the list
+    # grows if a variable with a larger slot is set.
+    __slots__ = ('_slot_values', '_slot_bound')
+
+    def __init__(self, nslots=0, f=None):
+        super().__init__(f)
+        if isinstance(f, SlotFrame):
+            self._slot_values = f._slot_values + [InvalidValue]*(nslots - len(f._slot_values))
+            self._slot_bound = f._slot_bound
+        else:
+            self._slot_values = [InvalidValue]*nslots
+            self._slot_bound = 0
+            if f is not None:
+                # move the values of SlotVariables that were stored by name
+                for k in [k for k in self if type(k) is str and k.startswith('$S') and k[2:].isdigit()]:
+                    self._frame_slot_rawsetvalue(int(k[2:]), dict.pop(self, k))
+
+    def _slot_items(self):
+        return [(f'$S{i}', v) for i, v in enumerate(self._slot_values) if v is not InvalidValue]
+
+    def items(self):
+        return list(super().items()) + self._slot_items()
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def _frame_slot_setvalue(self, slot, value):
+        values = self._slot_values
+        if slot >= len(values):
+            values.extend([InvalidValue]*(slot + 1 - len(values)))
+        old = values[slot]
+        if old is not InvalidValue:
+            if old != value:
+                raise UnificationFailure()
+            return True
+        if self._trail is not None:
+            self._trail.append((None, slot, InvalidValue))
+        values[slot] = value
+        self._slot_bound |= 1 << slot
+        return True
+
+    def _frame_slot_rawsetvalue(self, slot, value):
+        values = self._slot_values
+        if slot >= len(values):
+            values.extend([InvalidValue]*(slot + 1 - len(values)))
+        if self._trail is not None:
+            self._trail.append((None, slot, values[slot]))
+        values[slot] = value
+        self._slot_bound |= 1 << slot
+
+    def _frame_slot_unset(self, slot):
+        values = self._slot_values
+        if slot < len(values) and values[slot] is not InvalidValue:
+            if self._trail is not None:
+                self._trail.append((None, slot, values[slot]))
+            values[slot] = InvalidValue
+            self._slot_bound &= ~(1 << slot)
+
+    def _restore_slot(self, slot, old):
+        self._slot_values[slot] = old
+        if old is InvalidValue:
+            self._slot_bound &= ~(1 << slot)
+        else:
+            self._slot_bound |= 1 << slot
+
 ####################################################################################################
 # Iterators and other things
 
+# the guess for the number of values from an iterator which can not tell how
+# many values it will yield (such as one that wraps a generator)
+UNKNOWN_CARDINALITY = 1000
+
 class Iterator:
     def bind_iterator(self, frame, variable, value):
         raise NotImplementedError()
     def run(self, frame):
         raise NotImplementedError()
+    def estimate_cardinality(self, frame):
+        # the estimated number of values that run will yield.  This is used by
+        # loop to select which variable to bind first
+        return UNKNOWN_CARDINALITY
 
     @property
     def variables(self):
@@ -399,18 +732,35 @@ class Iterator:
 
 
 class UnionIterator(Iterator):
-    def __init__(self, partition, variable, iterators):
+    def __init__(self, partition, variable, iterators, position=None, key=None):
         self.partition = partition
         self.variable = variable  # can variable just be get the variable from the iterators that it wraps instead?  do we
         self.iterators = iterators
+        # if all of the branches of the partition have a ground value for the
+        # variable, then position is the index of the variable in the
+        # partition's trie and key is the values which were already bound
+        self.position = position
+        self.key = key
     def bind_iterator(self, frame, variable, value):
         assert variable == self.variable
-        return any(v.bind_iterator(self.variable, value) for v in self.iterators)
+        if self.position is not None:
+            key = list(self.key)
+            key[self.position] = value
+            for _ in self.partition._children.filter_raw(key):
+                return True
+            return False
+        return any(v.bind_iterator(frame, self.variable, value) for v in self.iterators)
     def run(self, frame):
         # this needs to identify the domain of the two iterators, and the
         # combine then such that it doesn't loop twice.  We are also going to
         # need to turn of branches of a partition when they are not productive.
 
+        if self.position is not None:
+            # the branches are all SingleIterators, so the distinct values can be found directly
+            for v in dict.fromkeys(it.value for it in self.iterators):
+                yield {self.variable: v}
+            return
+
         for i in range(len(self.iterators)):
             for val in self.iterators[i].run(frame):
                 # check if any of the previous iterators produced this value
@@ -423,15 +773,21 @@ class UnionIterator(Iterator):
                         break
                 if emit:
                     yield val
+    def estimate_cardinality(self, frame):
+        # the values of the branches might overlap, so this is an upper bound.
+        # For a memo table the branches are the rows which match the bound
+        # variables (each a SingleIterator), so this is the size of the table
+        return sum(v.estimate_cardinality(frame) for v in self.iterators)
 
 
 class RemapVarIterator(Iterator):
-    def __init__(self, remap, wrapped, variable):
+    def __init__(self, remap, wrapped, variable, wrapped_frame=None):
         self.remap = remap
         self.wrapped = wrapped
         self.variable = variable
+        self.wrapped_frame = wrapped_frame  # the frame the wrapped iterator was created with
     def run(self, frame):
-        for r in self.wrapped.run(None):  # TODO: handle the remapping of the argument frame
+        for r in self.wrapped.run(self.wrapped_frame):  # TODO: handle the remapping of the argument frame
 
             yield {self.remap[k]: v for k,v in r.items()}
 
@@ -442,10 +798,35 @@ class RemapVarIterator(Iterator):
     def bind_iterator(self, frame, variable, value):
         rmap = dict((b,a) for a,b in self.remap.items())
         v = rmap.get(variable, variable)
-        return self.wrapped.bind_iterator(self, None, r, value)
+        return self.wrapped.bind_iterator(self.wrapped_frame, v, value)
+    def estimate_cardinality(self, frame):
+        return self.wrapped.estimate_cardinality(self.wrapped_frame)
+
 
 
 
+class ColumnIterator(Iterator):
+    # iterate the distinct values of a column in a ColumnarTrie which are
+    # consistent with the variables that are already bound in the frame
+    def __init__(self, partition, variable, position):
+        self.partition = partition
+        self.variable = variable
+        self.position = position
+    def _key(self, frame):
+        return tuple(v.getValue(frame) if v.isBound(frame) else None for v in self.partition._unioned_vars)
+    def run(self, frame):
+        for v in list(self.partition._children.column_values(self.position, self._key(frame))):
+            yield {self.variable: v}
+    def bind_iterator(self, frame, variable, value):
+        assert variable == self.variable
+        return self.partition._children.contains_value(self.position, value, self._key(frame))
+    def estimate_cardinality(self, frame):
+        # the number of matching rows, which bounds the number of distinct values
+        return self.partition._children.count_rows(self._key(frame))
+    @property
+    def variables(self):
+        return (self.variable,)
+
 
 class SingleIterator(Iterator):
     # iterator over a single constant value
@@ -457,6 +838,96 @@ class SingleIterator(Iterator):
     def bind_iterator(self, frame, variable, value):
         assert self.variable == variable
         return self.value == value  # return if this iterator would have emitted this value
+    def estimate_cardinality(self, frame):
+        return 1
+
+
+class TrieJoinIterator(Iterator):
+    # Join of several partitions whose keys are ground (such as memo tables)
+    # which are children of the same intersection.  The variables are bound one
+    # at a time, and the values for a variable are taken from one of the tries
+    # and then looked up in the other tries which contain the variable, so a
+    # value is only bound if every relation has a row that is consistent with
+    # the values bound so far.  This is the "generic join" form of a leapfrog
+    # triejoin (with hash lookups in the trie instead of seeks in sorted
+    # columns), and unlike joining the relations one pair at a time it does not
+    # construct intermediate results which are larger than the output.  The
+    # bindings for all of the variables are yielded together, so loop only
+    # has to saturate the R-expr once per result.
+
+    def __init__(self, variables, atoms, iterators):
+        # atoms is a list of (trie, the variables of the trie's columns (None
+        # for a column which is not bound by the join), key of already bound
+        # values).  iterators are the single variable iterators which are
+        # replaced by this join
+        self.variable = variables[0]
+        self._variables = variables
+        self.atoms = atoms
+        self.iterators = iterators
+
+    @property
+    def variables(self):
+        return self._variables
+
+    def estimate_cardinality(self, frame):
+        # the size of the smallest relation (which bounds the first variable)
+        return min(it.estimate_cardinality(frame) for it in self.iterators)
+
+    def bind_iterator(self, frame, variable, value):
+        assert variable in self._variables
+        for _ in self._join({variable: value}):
+            return True
+        return False
+
+    def run(self, frame):
+        return self._join({})
+
+    def _join(self, binding):
+        # each level of the stack is the iterator of values for the variable
+        variables = [v for v in self._variables if v not in binding]
+        binding = dict(binding)
+        if not variables:
+            yield binding
+            return
+        stack = [self._values(variables[0], binding)]
+        while stack:
+            var = variables[len(stack)-1]
+            val = next(stack[-1], _join_done)
+            if val is _join_done:
+                stack.pop()
+                binding.pop(var, None)
+                continue
+            binding[var] = val
+            if len(stack) == len(variables):
+                yield dict(binding)
+            else:
+                stack.append(self._values(variables[len(stack)], binding))
+
+    def _values(self, var, binding):
+        # the values of var which all of the atoms that contain it have a row for
+        atoms = []
+        for trie, avars, key in self.atoms:
+            if var in avars:
+                key = list(key)
+                for i, v in enumerate(avars):
+                    if v is not None and v in binding:
+                        key[i] = binding[v]
+                atoms.append((sum(k is not None for k in key), trie, avars.index(var), key))
+        # take the values from the trie with the most values already bound
+        atoms.sort(key=lambda a: -a[0])
+        _, trie, position, key = atoms[0]
+        others = atoms[1:]
+        for val in dict.fromkeys(k[position] for k, _ in trie.filter_raw(key)):
+            for _, otrie, oposition, okey in others:
+                okey[oposition] = val
+                for _ in otrie.filter_raw(okey):
+                    break
+                else:
+                    break
+            else:
+                yield val
+
+_join_done = object()
 
 
 ####################################################################################################
@@ -480,6 +951,13 @@ class Visitor:
         res = self.lookup(R)(R, *args, **kwargs)
         if not self._track_source:
             return res
+        if _intern_pool is not None and isinstance(res, RBaseType):
+            key = res._intern_key()
+            if key is not None:
+                # the children were already returned by the visitor, so they
+                # are interned.  The interned object is shared, so it does not
+                # track what it was constructed from
+                return _intern_pool.intern(res, key)
         if R == res:
             return R
         # we want to track the R expr that this was constructed from as it might
@@ -524,15 +1002,143 @@ class RefinedVisitor(Visitor):
         return self._methods.get(typ, self._default)
 
 
+class SimplifyCache:
+    """
+    Cache of the results of simplify for an R-expr and the values/types that
+    its variables have in the frame.  Calls are expanded with fresh variable
+    names each time, so the R-expr is keyed by its weak_equiv form (the
+    variables renamed in the order that they appear) and the cached result is
+    renamed back to the variables of the R-expr that is being simplified.  The
+    changes that simplify made to the variables in the frame are saved with
+    the result, so that they are replayed on the frame when the cache is hit.
+
+    Only the R-exprs of cached_types are looked up, as the key is as expensive
+    as simplifying a single constraint.  R-exprs which contain something that
+    is not _simplify_deterministic (memo reads, calls which could be
+    redefined, assumptions, and partitions as their tries are changed in place
+    by add_to_term and the memo tables) are not cached.  The least recently used entries
+    are evicted after max_entries.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.cached_types = (Intersect, Aggregator, Partition)
+        self._entries = OrderedDict()  # key -> (result, changes to the variables, seconds it took)
+        self.stats = {}  # name of type -> [hits, misses, bypassed, seconds saved]
+
+    def _plan(self, R):
+        # (weak_equiv of R, variables of R in that order) or None if R can not be cached
+        if not all(c._simplify_deterministic for c in R.all_children()):
+            return None
+        canon, back = R.weak_equiv()
+        return canon, tuple(back.values())
+
+    def simplify(self, func, R, frame):
+        st = self.stats.get(type(R).__name__)
+        if st is None:
+            st = self.stats[type(R).__name__] = [0, 0, 0, 0.0]
+        plan = self._plan(R)
+        if plan is None:
+            st[2] += 1
+            return func(R, frame)
+        canon, variables = plan
+        before = tuple((v.getValue(frame), v.getType(frame)) for v in variables)
+        # 1, 1.0 and True are equal as keys of a dict, but can give different results
+        key = (canon, frame.in_optimizer, before, tuple(type(b[0]) for b in before))
+        try:
+            entry = self._entries.get(key)
+        except TypeError:
+            # a value in the frame which is not hashable
+            st[2] += 1
+            return func(R, frame)
+
+        if entry is not None:
+            self._entries.move_to_end(key)
+            res, changes, elapsed = entry
+            try:
+                for i, (old_val, old_typ), (val, typ) in changes:
+                    v = variables[i]
+                    if val is not old_val:
+                        if val is InvalidValue:
+                            v._unset(frame)
+                        elif old_val is InvalidValue:
+                            v.setValue(frame, val)
+                        else:
+                            v.rawSetValue(frame, val)
+                    if typ is not old_typ:
+                        if typ is None:
+                            v._unset_type(frame)
+                        else:
+                            v.setType(frame, typ)
+            except UnificationFailure:
+                return terminal(0)
+            st[0] += 1
+            st[3] += elapsed
+            # variables that were created by simplify get new names
+            rmap = dict(zip(canon_variables(len(variables)), variables))
+            return res.rename_vars_unique(rmap.get)
+
+        start = time.perf_counter()
+        res = func(R, frame)
+        elapsed = time.perf_counter() - start
+        changes = []
+        for i, (v, b) in enumerate(zip(variables, before)):
+            a = (v.getValue(frame), v.getType(frame))
+            if a[0] is not b[0] or a[1] is not b[1]:
+                changes.append((i, b, a))
+        st[1] += 1
+        rmap = dict(zip(variables, canon_variables(len(variables))))
+        self._entries[key] = (res.rename_vars(lambda v: rmap.get(v, v)), tuple(changes), elapsed)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return res
+
+    def clear(self):
+        self._entries.clear()
+
+    def report(self):
+        # type -> hit rate and seconds saved
+        return {name: {'hits': h, 'misses': m, 'bypassed': b,
+                       'hit_rate': h / (h + m) if h + m else 0.0, 'time_saved': saved}
+                for name, (h, m, b, saved) in self.stats.items()}
+
+
+def canon_variables(n):
+    # the names of the variables used by weak_equiv
+    return [VariableId(f'$W{i}') for i in range(n)]
+
+
 class SimplifyVisitor(Visitor):
+    def __init__(self):
+        super().__init__()
+        self._cache = None
+
+    def enable_cache(self, max_entries=4096):
+        # opt-in cache of the results, see SimplifyCache
+        self._cache = SimplifyCache(max_entries)
+        return self._cache
+
+    def disable_cache(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        return self._cache
+
     def __call__(self, R, *args, **kwargs):
+        cache = self._cache
+        if cache is not None and not kwargs and len(args) == 1 and type(R) in cache.cached_types:
+            return cache.simplify(self._simplify, R, args[0])
+        return self._simplify(R, *args, **kwargs)
+
+    def _simplify(self, R, *args, **kwargs):
         # special handling for unification failure though, maybe this should
         # just be handled in the unions?  Everything else should just end up
         # pushing this failure up the chain?  Though maybe that is closer to
         # what we want
         try:
             #assert R is not None
-            return super().__call__(R, *args, **kwargs)
+            return Visitor.__call__(self, R, *args, **kwargs)
             #assert r is not None
             #return r
         except UnificationFailure:
@@ -582,19 +1188,41 @@ def getPartitions_default(self, frame):
 
 def loop_partition(R, frame, callback, partition):
     # use a callback instead of iterator as will be easier to rewrite this later
-    for bd in partition.run(frame):
-        # make a copy of the frame for now would like to just modify the frame,
-        # and track which variables are bound instead, so that this doesn't have
-        # to make copies.  That is probably something that would become a
-        # worthwhile optimization in the future.
-        f = Frame(frame)
-        try:
-            for var, val in bd.items():  # we can't use update here as the names on variables are different from the values in the frame
-                var.setValue(f, val)
-            s = saturate(R, f)  # probably want this to be handled via the callback?
-            callback(s, f)
-        except UnificationFailure:
-            pass
+    #
+    # The variables are bound in place on the frame and then rolled back using
+    # the frame's trail after each binding.  This means that the callback must
+    # not hold onto the frame after it returns, it should read out any values
+    # that it needs (or make a copy with `Frame(frame)`).
+    mark = frame.mark()
+    try:
+        for bd in partition.run(frame):
+            try:
+                for var, val in bd.items():  # we can't use update here as the names on variables are different from the values in the frame
+                    var.setValue(frame, val)
+                s = saturate(R, frame)  # probably want this to be handled via the callback?
+                callback(s, frame)
+            except UnificationFailure:
+                pass
+            frame.undo(mark)
+    finally:
+        frame.release(mark)
+
+
+def cheapest_partition(parts, frame):
+    # select the iterator which is estimated to yield the fewest values, so
+    # that the most selective variable is bound first.  If nothing can be
+    # iterated, then this returns the first partition (or None)
+    first = best = None
+    for p in parts:
+        if first is None:
+            first = p
+        if isinstance(p, Iterator):
+            cost = p.estimate_cardinality(frame)
+            if best is None or cost < best_cost:
+                best, best_cost = p, cost
+                if cost <= 1:
+                    break  # can not do better than binding a single value
+    return first if best is None else best
 
 
 def loop(R, frame, callback, till_terminal=False, best_effort=False, partition=None):
@@ -607,22 +1235,15 @@ def loop(R, frame, callback, till_terminal=False, best_effort=False, partition=N
         return
 
     if partition is None:
-        # then we need to select some partition to use, which will mean choosing
-        # which one of theses is "best"?
-        parts = getPartitions(R, frame)
-        for p in parts:  # just choose something, and ensure that we can iterate this whole list without a problem
-            partition = p
-            break
+        # then we need to select some partition to use
+        partition = cheapest_partition(getPartitions(R, frame), frame)
 
     if partition is None:
         # try 2
         #print('making aggregator loopable', R)
         #import ipdb; ipdb.set_trace()
         R = make_aggregator_loopable(R, frame=frame)
-        parts = getPartitions(R, frame)
-        for p in parts:  # just choose something, and ensure that we can iterate this whole list without a problem
-            partition = p
-            break
+        partition = cheapest_partition(getPartitions(R, frame), frame)
 
     if not best_effort:
         if not isinstance(partition, Iterator):
@@ -645,11 +1266,65 @@ def loop(R, frame, callback, till_terminal=False, best_effort=False, partition=N
     loop_partition(R, frame, cb, partition)
 
 
+def iter_loop_partition(R, frame, partition):
+    # The generator version of loop_partition, yields (R, frame) for every
+    # binding of the partition.  As with loop_partition, the frame is rolled
+    # back once the generator is resumed, so the values must be read out
+    # before asking for the next one.  If the generator is closed before it is
+    # exhausted, then the frame is rolled back when it is closed.
+    mark = frame.mark()
+    try:
+        for bd in partition.run(frame):
+            try:
+                for var, val in bd.items():
+                    var.setValue(frame, val)
+                s = saturate(R, frame)
+            except UnificationFailure:
+                frame.undo(mark)
+                continue
+            yield s, frame
+            frame.undo(mark)
+    finally:
+        frame.release(mark)
+
+
+def iter_loop(R, frame, till_terminal=False, best_effort=False, partition=None):
+    # The generator version of loop, which yields (R, frame) instead of calling
+    # a callback.  Unlike loop, an exception raised by the consumer of the
+    # values is not raised inside of the loop (so a UnificationFailure does not
+    # skip the binding), it is raised from where the values are consumed.
+    if isinstance(R, FinalState):
+        yield R, frame
+        return
+
+    if partition is None:
+        partition = cheapest_partition(getPartitions(R, frame), frame)
+
+    if partition is None:
+        R = make_aggregator_loopable(R, frame=frame)
+        partition = cheapest_partition(getPartitions(R, frame), frame)
+
+    if not best_effort:
+        if not isinstance(partition, Iterator):
+            raise DynaSolverUnLoopable(R)
+    else:
+        if partition is None:
+            yield R, frame
+            return
+
+    for r, f in iter_loop_partition(R, frame, partition):
+        if (till_terminal or best_effort) and not isinstance(r, FinalState):
+            yield from iter_loop(r, f, till_terminal=till_terminal, best_effort=best_effort)
+        else:
+            yield r, f
+
+
 ####################################################################################################
 # the core R structure such as intersect and partition
 
 
 class Intersect(RBaseType):
+    _simplify_deterministic = True
 
     def __init__(self, children :Tuple[RBaseType]):
         super().__init__()
@@ -662,6 +1337,9 @@ class Intersect(RBaseType):
     def rewrite(self, rewriter):
         return intersect(*(rewriter(c) for c in self._children))
 
+    def _intern_key(self):
+        return (Intersect, *map(id, self._children))
+
 def intersect(*children):
     mul = 1
     r = []
@@ -697,10 +1375,54 @@ def simplify_intersect(self :Intersect, frame: Frame):
     return intersect(*vs)
 
 
+_join_iterators = True
+
+def join_iterators(enabled=True):
+    """
+    Turn on or off the TrieJoinIterator which getPartitions creates for the
+    ground partitions (memo tables) that are children of an intersection.  When
+    off, loop binds one variable at a time from one of the children (nested
+    loop join).
+    """
+    global _join_iterators
+    _join_iterators = enabled
+
+
+@getPartitions.define(Intersect)
+def getPartitions_intersect(self, frame):
+    parts = [p for c in self.children for p in getPartitions(c, frame)]
+    if _join_iterators:
+        # the partitions with a ground column for the iterated variables
+        atoms = {}
+        for p in parts:
+            if isinstance(p, UnionIterator) and p.position is not None:
+                atoms.setdefault(p.partition, []).append((p, p.position, p.key))
+            elif isinstance(p, ColumnIterator):
+                atoms.setdefault(p.partition, []).append((p, p.position, p._key(frame)))
+        counts = {}
+        for its in atoms.values():
+            for it, _, _ in its:
+                counts[it.variable] = counts.get(it.variable, 0) + 1
+        if len(atoms) > 1 and any(c > 1 for c in counts.values()):
+            # the variables which are in more relations are bound first
+            variables = sorted(counts, key=lambda v: -counts[v])
+            join_atoms = []
+            iterators = []
+            for partition, its in atoms.items():
+                avars = [None]*len(partition._unioned_vars)
+                for it, position, key in its:
+                    avars[position] = it.variable
+                    iterators.append(it)
+                join_atoms.append((partition._children, tuple(avars), tuple(its[0][2])))
+            yield TrieJoinIterator(variables, join_atoms, iterators)
+    yield from parts
+
+
 class Partition(RBaseType):
     """
     This class is /very/ overloaded in that we are going to be using the same representation for memoized entries as well as the partitions
     """
+
     def __init__(self, unioned_vars :Tuple, children :PrefixTrie):#Dict[Tuple[object], List[RBaseType]]):
         super().__init__()
         self._unioned_vars = unioned_vars
@@ -788,7 +1510,9 @@ def simplify_partition(self :Partition, frame: Frame, *, map_function=None, redu
     incoming_values = [v.getValue(frame) for v in self._unioned_vars]
     incoming_types = [v.getType(frame) for v in self._unioned_vars]
 
-    nc = PrefixTrie(len(self._unioned_vars))
+    # the result is usually ground (especially with flatten_keys), it becomes
+    # a nested PrefixTrie if a key has an unbound variable
+    nc = FlatTrie(len(self._unioned_vars))
 
     def saveL(res, frame):
         # this would have bound new values in the frame potentially, so we going to unset those (if they were unset on being called)
@@ -945,6 +1669,13 @@ def getPartitions_partition(self :Partition, frame):
     # map of all of the children branches
     #vmap = [[None]*len(self._unioned_vars) for _ in range(len(self._children))]
 
+    if isinstance(self._children, ColumnarTrie) and self._children.is_columnar:
+        # all of the branches are Terminal(1), so we can iterate the columns directly
+        for i, var in enumerate(self._unioned_vars):
+            if not var.isBound(frame):
+                yield ColumnIterator(self, var, i)
+        return
+
     citers = []
     incoming_mode = [v.isBound(frame) for v in self._unioned_vars]
 
@@ -952,7 +1683,12 @@ def getPartitions_partition(self :Partition, frame):
 
     vmaps = []
 
-    for vals, Rexprs in self._children.items():
+    # only the branches which match the values that are already bound (the
+    # trie has a secondary index if these are not a prefix of the variables)
+    bound_key = [v.getValue(frame) if m else None for v, m in zip(self._unioned_vars, incoming_mode)]
+    ground = [True]*len(self._unioned_vars)  # if all of the keys have a value for the variable
+
+    for vals, Rexprs in self._children.filter_raw(bound_key):
         # need to get all of the iterators from this child branch, in the case
         # that a variable is already bound want to include that.  If a variable
         # is not in the union map, then we want to ignore it
@@ -961,6 +1697,8 @@ def getPartitions_partition(self :Partition, frame):
         for i, val in enumerate(vals):
             if val is not None:
                 vm_[i] = SingleIterator(self._unioned_vars[i], val)
+            else:
+                ground[i] = False
 
         for child in Rexprs:
             vm = list(vm_)
@@ -976,6 +1714,8 @@ def getPartitions_partition(self :Partition, frame):
             for it in getPartitions(child, frame):
                 if isinstance(it, Partition):  # if this is not consolidated, then we are going to want to bind a variable
                    citers.append(it)  # these are just partitions, so buffer these I suppose
+                elif isinstance(it, TrieJoinIterator):
+                    pass  # binds more than one variable, the iterators it was made from are also yielded
                 else:
                     # then this is going to be some variable that we are looking for
                     if it.variable in vmap:
@@ -991,8 +1731,10 @@ def getPartitions_partition(self :Partition, frame):
         vs = [v[i] for v in vmaps]
         if all(v is not None for v in vs):
             # then we can iterate this variable
-
-            yield UnionIterator(self, var, vs)
+            if ground[i]:
+                yield UnionIterator(self, var, vs, i, bound_key)
+            else:
+                yield UnionIterator(self, var, vs)
 
     # yield any partitions which can be branched (after the unions over variables
 
@@ -1007,6 +1749,8 @@ def getPartitions_partition(self :Partition, frame):
 
 
 class Unify(RBaseType):
+    _simplify_deterministic = True
+
     def __init__(self, v1, v2):
         super().__init__()
         assert v1 != v2
@@ -1024,6 +1768,9 @@ class Unify(RBaseType):
     def _tuple_rep(self):
         return self.__class__.__name__, self.v1, self.v2
 
+    def _intern_key(self):
+        return Unify, intern_var_key(self.v1), intern_var_key(self.v2)
+
 def unify(a, b):
     if a == b:
         return Terminal(1)
@@ -1060,9 +1807,15 @@ def simplify_unify(self, frame):
 # combine and combine_multiplicity.
 class AggregatorOpBase:
     selective = False  # if the aggregator takes some combination of all branches or just one
+    priority_direction = 0  # for selective aggregators, 1 if smaller values are preferred (min), -1 if larger values are preferred (max)
+    invertible = False  # if inverse can remove a value which was combined, used by memos to propagate deltas
+    vector_op = None  # the name of the numpy reduction that is the same as combine (see vector_reduce.py)
     def lift(self, x): raise NotImplementedError()
     def lower(self, x): raise NotImplementedError()
     def combine(self, x, y): raise NotImplementedError()
+    def inverse(self, x, y):
+        # x - y, such that inverse(combine(x, y), y) == x
+        raise NotImplementedError()
     def combine_multiplicity(self, x, y, mul):
         # x + (y * mul)
         for _ in range(mul):
@@ -1071,12 +1824,17 @@ class AggregatorOpBase:
 
 
 class AggregatorOpImpl(AggregatorOpBase):
-    def __init__(self, op, selective=False):
+    def __init__(self, op, selective=False, priority_direction=0, inverse_op=None, vector_op=None):
         self.op = op
         self.selective = selective
+        self.priority_direction = priority_direction
+        self.inverse_op = inverse_op
+        self.invertible = inverse_op is not None
+        self.vector_op = vector_op
     def lift(self, x): return x
     def lower(self, x): return x
     def combine(self, x, y): return self.op(x,y)
+    def inverse(self, x, y): return self.inverse_op(x,y)
 
 class AggregatorSaturated(Exception):
     # not a "real" exception.  Used to stop the aggregator for continuing to run in the case that the value is done
@@ -1085,6 +1843,7 @@ class AggregatorSaturated(Exception):
 
 
 class Aggregator(RBaseType):
+    _simplify_deterministic = True
 
     def __init__(self, result: Variable, head_vars: Tuple[Variable], body_res: Variable,
                  aggregator :AggregatorOpBase, body :RBaseType):
@@ -1125,6 +1884,16 @@ class Aggregator(RBaseType):
     def _tuple_rep(self):
         return self.__class__.__name__, self.result, self.head_vars, self.body_res, self.body._tuple_rep()
 
+    def __eq__(self, other):
+        return super().__eq__(other) and self.aggregator == other.aggregator
+
+    def __hash__(self):
+        return super().__hash__()
+
+    def _intern_key(self):
+        return (Aggregator, intern_var_key(self.result), intern_vars_key(self.head_vars), intern_var_key(self.body_res),
+                id(self.aggregator), id(self.body))
+
 
 @simplify.define(Aggregator)
 def simplify_aggregator(self, frame):
@@ -1143,26 +1912,39 @@ def simplify_aggregator(self, frame):
 
 
         agg_result = None
-        def loop_cb(R, frame):
-            nonlocal agg_result
-            # if this isn't a final state, then I suppose that we are going to
-            # need to perform more loops?
-            assert isinstance(R, FinalState)
-
-            if not R.isEmpty():  # ignore the empty states
-                v = self.body_res.getValue(frame)
-                assert v is not InvalidValue  # if this happens some invalid R-expr was generated?
-                mul = R.multiplicity
-                if agg_result is None:
-                    agg_result = v
-                    mul -= 1
-                if mul > 0:
-                    agg_result = self.aggregator.combine_multiplicity(agg_result, v, mul)
+        if self.aggregator.vector_op is not None:
+            # the values are collected and combined in chunks
+            reducer = ChunkedReducer(self.aggregator)
+            def loop_cb(R, frame):
+                assert isinstance(R, FinalState)
+                if not R.isEmpty():
+                    v = self.body_res.getValue(frame)
+                    assert v is not InvalidValue
+                    reducer.add(v, R.multiplicity)
+        else:
+            reducer = None
+            def loop_cb(R, frame):
+                nonlocal agg_result
+                # if this isn't a final state, then I suppose that we are going to
+                # need to perform more loops?
+                assert isinstance(R, FinalState)
+
+                if not R.isEmpty():  # ignore the empty states
+                    v = self.body_res.getValue(frame)
+                    assert v is not InvalidValue  # if this happens some invalid R-expr was generated?
+                    mul = R.multiplicity
+                    if agg_result is None:
+                        agg_result = v
+                        mul -= 1
+                    if mul > 0:
+                        agg_result = self.aggregator.combine_multiplicity(agg_result, v, mul)
 
         body = saturate(body, frame)
 
         try:
             loop(body, frame, loop_cb)
+            if reducer is not None:
+                agg_result = reducer.result()
         except AggregatorSaturated as s:
             agg_result = s.value
         except DynaSolverUnLoopable as ex:
@@ -1195,7 +1977,10 @@ def simplify_aggregator(self, frame):
 @getPartitions.define(Aggregator)
 def getPartitions_aggregator(self, frame):
     for p in getPartitions(self.body, frame):
-        if p.variable in self.head_vars:
+        if isinstance(p, TrieJoinIterator):
+            if all(v in self.head_vars for v in p.variables):
+                yield p
+        elif p.variable in self.head_vars:
             # filter out the iterators that are going to yield unconsolidated results
             yield p
 
@@ -1225,6 +2010,8 @@ def make_aggregator_loopable_partition(R, frame=None):
 
 
 class ModedOp(RBaseType):
+    _simplify_deterministic = True
+
     def __init__(self, name, det, nondet, vars):
         super().__init__()
         self.det = det
@@ -1244,6 +2031,8 @@ class ModedOp(RBaseType):
         return super().__eq__(other) and self.det is other.det and self.nondet is other.nondet
     def __hash__(self):
         return super().__hash__() ^ object.__hash__(self.det) ^ object.__hash__(self.nondet)
+    def _intern_key(self):
+        return ModedOp, self.name, id(self.det), id(self.nondet), intern_vars_key(self.vars_)
 
 class IteratorFromIterable(Iterator):
     def __init__(self, variable, iterable):
@@ -1255,6 +2044,13 @@ class IteratorFromIterable(Iterator):
     def run(self, frame):
         for v in self.iterable:
             yield {self.variable: v}
+    def estimate_cardinality(self, frame):
+        try:
+            return len(self.iterable)
+        except TypeError:
+            return UNKNOWN_CARDINALITY
+        except OverflowError:
+            return sys.maxsize  # a range which is larger than len can return
     @property
     def variables(self):
         return (self.variable,)
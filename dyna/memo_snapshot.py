@@ -0,0 +1,231 @@
+# Snapshots of the memo tables on disk
+#
+# The null memo tables are computed when the program is loaded (starting with
+# refresh_whole_table), which can take a long time for large programs.  A
+# snapshot saves the converged memo tables so that the next process which
+# loads the same program can skip that computation.
+#
+# The snapshot contains a fingerprint of the program (the repr of
+# SystemContext.terms_as_defined), and it is rejected if the program has
+# changed.  When a snapshot is loaded, the file is mmaped and the tables are
+# attached to the MemoContainers without reading the rows.  Numeric columns are
+# read directly out of the mmap, and the rows are sorted by the first column so
+# that MemoContainer.lookup can fault in only the rows for the value of the
+# first variable which is read.
+#
+# Only tables that are stored in a ColumnarTrie (all of the rows are ground) are
+# saved, other tables are recomputed as normal.
+#
+# file layout:
+#   MAGIC, u64 length of the header, pickled header, column data (8 byte aligned)
+
+import bisect
+import hashlib
+import mmap
+import pickle
+import struct
+from array import array
+
+from .interpreter import Terminal, ConstantVariable, constant, ret_variable, variables_named
+from .terms import BuildStructure
+from .prefix_trie import ColumnarTrie
+
+MAGIC = b'DYNAMEMO\x01'
+_HEADER_LEN = struct.Struct('<Q')
+
+
+def program_fingerprint(dyna_system):
+    # The names of the variables generated by the normalizer and the line
+    # numbers used by `:=` are global counters, so these are renamed to the
+    # order in which they appear in the program.  Otherwise the same program
+    # would have a different fingerprint depending on what was loaded before it.
+    terms = sorted(dyna_system.terms_as_defined.items(), key=lambda x: repr(x[0]))
+
+    lines = set()
+    for _, R in terms:
+        for c in R.all_children():
+            if isinstance(c, BuildStructure) and c.name == '$colon_line_tracking' and isinstance(c.arguments[0], ConstantVariable):
+                lines.add(c.arguments[0].getValue(None))
+    line_map = {constant(v): constant(i) for i, v in enumerate(sorted(lines))}
+
+    def canonical_lines(R):
+        if isinstance(R, BuildStructure) and R.name == '$colon_line_tracking':
+            return BuildStructure(R.name, R.result, (line_map.get(R.arguments[0], R.arguments[0]), *R.arguments[1:]))
+        return R.rewrite(canonical_lines)
+
+    h = hashlib.sha256()
+    for (name, arity), R in terms:
+        interface = (ret_variable, *variables_named(*range(arity)))
+        R, _ = canonical_lines(R).weak_equiv(ignored=interface)
+        h.update(repr(((name, arity), R)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _snapshot_tables(dyna_system):
+    # (name, index of the memo container, MemoContainer) for all tables that can be saved
+    for name in sorted(dyna_system.terms_as_memoized, key=repr):
+        for i, table in enumerate(dyna_system.memo_containers(name)):
+            if not table.is_null_memo:
+                continue
+            memos = table.memos
+            trie = memos._children
+            if (isinstance(trie, ColumnarTrie) and trie.is_columnar and
+                trie._filter == (None,)*len(table.variables) and
+                trie._store.unit == Terminal(1)):
+                yield name, i, table
+
+
+def save_memo_snapshot(dyna_system, path):
+    """
+    Write the null memo tables of the system to path.  The agenda is run first,
+    so that the tables are converged.  Returns the names of the tables which
+    were saved.
+    """
+    dyna_system.run_agenda()
+
+    tables = []
+    chunks = []
+    offset = 0
+
+    def add_chunk(data):
+        nonlocal offset
+        pad = -offset % 8
+        if pad:
+            chunks.append(b'\0' * pad)
+            offset += pad
+        start = offset
+        chunks.append(data)
+        offset += len(data)
+        return start, len(data)
+
+    for name, index, table in _snapshot_tables(dyna_system):
+        store = table.memos._children._store
+        nrows = store.nrows
+        columns = store.columns if nrows else []
+
+        # sort the rows by the first column, so that the rows for a value
+        # are contiguous and can be found with a binary search
+        indexed = bool(columns) and type(columns[0]) is array
+        order = range(nrows)
+        if indexed:
+            order = sorted(order, key=columns[0].__getitem__)
+
+        cols = []
+        for c in columns:
+            if type(c) is array:
+                cols.append((c.typecode,) + add_chunk(array(c.typecode, (c[r] for r in order)).tobytes()))
+            else:
+                cols.append(('pickle',) + add_chunk(pickle.dumps([c[r] for r in order], protocol=pickle.HIGHEST_PROTOCOL)))
+
+        tables.append({
+            'name': name,
+            'index': index,
+            'nargs': len(table.variables),
+            'nrows': nrows,
+            'indexed': indexed,
+            'columns': cols,
+        })
+
+    header = pickle.dumps({
+        'fingerprint': program_fingerprint(dyna_system),
+        'tables': tables,
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LEN.pack(len(header)))
+        f.write(header)
+        base = len(MAGIC) + _HEADER_LEN.size + len(header)
+        f.write(b'\0' * (-base % 8))
+        for c in chunks:
+            f.write(c)
+
+    return [t['name'] for t in tables]
+
+
+class SnapshotTable:
+    """
+    The rows of a single table inside of a mmaped snapshot.  The columns are
+    only read when the rows are requested.
+    """
+
+    def __init__(self, buffer, data_start, info):
+        self._buffer = buffer
+        self._data_start = data_start
+        self.name = info['name']
+        self.index = info['index']
+        self.nargs = info['nargs']
+        self.nrows = info['nrows']
+        self.indexed = info['indexed']
+        self._column_info = info['columns']
+        self._columns = None
+
+    def _load_columns(self):
+        if self._columns is None:
+            cols = []
+            for kind, offset, length in self._column_info:
+                start = self._data_start + offset
+                view = self._buffer[start:start+length]
+                if kind == 'pickle':
+                    cols.append(pickle.loads(view))
+                else:
+                    cols.append(view.cast(kind))
+            self._columns = cols
+        return self._columns
+
+    def rows(self, first_value=None):
+        columns = self._load_columns()
+        if first_value is None:
+            rows = range(self.nrows)
+        else:
+            assert self.indexed
+            c = columns[0]
+            try:
+                rows = range(bisect.bisect_left(c, first_value), bisect.bisect_right(c, first_value))
+            except TypeError:
+                # a value which can not be compared with the numbers in the column
+                return
+        for r in rows:
+            yield tuple(c[r] for c in columns)
+
+
+def open_memo_snapshot(path):
+    """
+    Returns (fingerprint, list of SnapshotTable) for a snapshot file
+    """
+    with open(path, 'rb') as f:
+        buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'{path} is not a memo snapshot')
+    pos = len(MAGIC)
+    header_len, = _HEADER_LEN.unpack(buffer[pos:pos+_HEADER_LEN.size])
+    pos += _HEADER_LEN.size
+    header = pickle.loads(buffer[pos:pos+header_len])
+    pos += header_len
+    data_start = pos + (-pos % 8)
+    return header['fingerprint'], [SnapshotTable(buffer, data_start, t) for t in header['tables']]
+
+
+def load_memo_snapshot(dyna_system, path):
+    """
+    Attach the tables in the snapshot to the memo tables of the system.  The
+    tables have to be memoized (with memoize_term) before this is called.
+    Returns the names of the tables that were loaded, or None if the snapshot
+    was rejected as the program has changed since it was saved.
+    """
+    fingerprint, tables = open_memo_snapshot(path)
+    if fingerprint != program_fingerprint(dyna_system):
+        print(f'[warn] memo snapshot {path} does not match the current program, ignoring')
+        return None
+
+    loaded = []
+    for st in tables:
+        containers = dyna_system.memo_containers(st.name)
+        if st.index >= len(containers):
+            continue
+        table = containers[st.index]
+        if not table.is_null_memo or len(table.variables) != st.nargs:
+            continue
+        table.attach_snapshot(st)
+        loaded.append(st.name)
+    return loaded
@@ -1,12 +1,142 @@
 import itertools
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from typing import *
 
 from .interpreter import *
-from .terms import inline_all_calls
+from .terms import inline_all_calls, CallTerm, Evaluate, Evaluate_reflect
 from .guards import Assumption, AssumptionListener, get_all_assumptions
-from .agenda import push_work
-from .prefix_trie import zip_tries
+from .agenda import push_work, push_batched_work
+from .prefix_trie import zip_tries, ColumnarTrie, PrefixTrie
+
+class MemoEvictionPolicy:
+    """
+    Tracks the entries of an unk memo table and selects which entry should be
+    evicted once the table is over its capacity.  Evicting an entry from an
+    unk table is always safe, it will just be recomputed on the next lookup.
+
+    The default policy is LRU.
+    """
+
+    name = 'lru'
+
+    def __init__(self):
+        self._entries = OrderedDict()
+
+    def add(self, key):
+        self._entries[key] = None
+        self._entries.move_to_end(key)
+
+    def touch(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def victim(self):
+        # remove and return the key that should be evicted next
+        return self._entries.popitem(last=False)[0]
+
+    def clear(self):
+        self._entries.clear()
+
+    def keys(self):
+        return list(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}()'
+
+
+LRUEviction = MemoEvictionPolicy
+
+
+class LFUEviction(MemoEvictionPolicy):
+    """
+    Evict the entry which has been read the least number of times, ties are
+    broken by evicting the least recently used entry.
+    """
+
+    name = 'lfu'
+
+    def __init__(self):
+        self._counts = {}  # key -> number of reads
+        self._buckets = defaultdict(OrderedDict)  # number of reads -> keys in LRU order
+        self._min_count = 0
+
+    def _move(self, key, old, new):
+        bucket = self._buckets[old]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[old]
+            if self._min_count == old:
+                self._min_count = new
+        self._counts[key] = new
+        self._buckets[new][key] = None
+
+    def add(self, key):
+        if key in self._counts:
+            self.touch(key)
+            return
+        self._counts[key] = 1
+        self._buckets[1][key] = None
+        self._min_count = 1
+
+    def touch(self, key):
+        c = self._counts.get(key)
+        if c is not None:
+            self._move(key, c, c+1)
+
+    def discard(self, key):
+        c = self._counts.pop(key, None)
+        if c is not None:
+            bucket = self._buckets[c]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[c]
+                if self._min_count == c:
+                    self._min_count = min(self._buckets, default=0)
+
+    def victim(self):
+        bucket = self._buckets[self._min_count]
+        key, _ = bucket.popitem(last=False)
+        del self._counts[key]
+        if not bucket:
+            del self._buckets[self._min_count]
+            self._min_count = min(self._buckets, default=0)
+        return key
+
+    def clear(self):
+        self._counts.clear()
+        self._buckets.clear()
+        self._min_count = 0
+
+    def keys(self):
+        return list(self._counts)
+
+    def __len__(self):
+        return len(self._counts)
+
+
+MEMO_EVICTION_POLICIES = {
+    'lru': LRUEviction,
+    'lfu': LFUEviction,
+}
+
+
+def make_eviction_policy(policy):
+    if policy is None:
+        return LRUEviction()
+    if isinstance(policy, MemoEvictionPolicy):
+        return policy
+    if isinstance(policy, str):
+        if policy not in MEMO_EVICTION_POLICIES:
+            raise ValueError(f'Unknown eviction policy {policy}, expected one of {", ".join(MEMO_EVICTION_POLICIES)}')
+        return MEMO_EVICTION_POLICIES[policy]()
+    raise TypeError(f'Can not construct an eviction policy from {policy!r}')
+
 
 class MemoContainer:
 
@@ -15,7 +145,8 @@ class MemoContainer:
 
     def __init__(self, argument_mode: Tuple[bool], supported_mode : Tuple[bool],
                  variables: Tuple[Variable], body: Partition, is_null_memo=False,
-                 assumption_always_listen=None, dyna_system=None):
+                 assumption_always_listen=None, dyna_system=None, aggregator=None,
+                 max_entries=None, eviction=None):
         # parameterization of the memo table that _should not change_
         self.argument_mode = argument_mode  # these are the variables which are passed as arguments to the computation
         self.supported_mode = supported_mode  # which variables must be bound first before we can query this
@@ -28,6 +159,11 @@ class MemoContainer:
         self.assumption_always_listen = assumption_always_listen or ()
         self.dyna_system = dyna_system  # this should also be referenced by the R-expr
 
+        # the aggregator that is applied to the result of reading from this
+        # table (if known).  The agenda uses this to prioritize updates for
+        # selective aggregators such as `min=`
+        self.aggregator = aggregator
+
         # if this is null, then when an update comes in, we have to recompute rather than being able to just delete
         # this is a property of the table, rather than where we are choosing to use it
         # TODO: the UnkMemo and the NullMemo should probably just be merged and then this should be the trigger between the two
@@ -39,7 +175,35 @@ class MemoContainer:
         # place) to add new memos if anyone else gets a direct reference to this
         # R-expr, then that could potentially cause issues (due to the not being
         # immutable)
-        self.memos = Partition(variables, PrefixTrie(len(self.variables)))
+        self._memos = Partition(variables, self._new_memos_trie())
+
+        # a table that was loaded from a snapshot on disk (see
+        # memo_snapshot.py) is read lazily.  Rows are faulted in by lookup
+        # for the values of the first variable that are read, and everything
+        # is loaded the first time that the memos are accessed in some other
+        # way.
+        self._snapshot = None
+        self._snapshot_faulted = set()
+        self._skip_refresh = False
+
+        # incremented whenever keys are recomputed rather than updated with a delta
+        self.refresh_epoch = 0
+        self.delta_count = 0
+        # head -> value of the aggregator, maintained by the deltas for the current refresh_epoch
+        self._group_values = {}
+        self._group_values_epoch = 0
+
+        # unk memo tables can be bounded to some number of entries, after which
+        # the entries selected by the eviction policy are deleted (and will be
+        # recomputed if they are read again).  Null memos are the complete
+        # table, so they can not drop entries.
+        assert max_entries is None or (not is_null_memo and max_entries > 0), 'only unk memos can have a maximum number of entries'
+        self.max_entries = max_entries
+        self.eviction = make_eviction_policy(eviction)
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
 
 
         # for tracking anything that depends on this expression.
@@ -69,16 +233,66 @@ class MemoContainer:
         for a,b in zip(self.argument_mode, self.supported_mode):
             if b: assert a
 
+    @property
+    def memos(self) -> Partition:
+        if self._snapshot is not None:
+            self._load_snapshot()
+        return self._memos
+
+    @memos.setter
+    def memos(self, memos: Partition):
+        self._snapshot = None
+        self._memos = memos
+
+    def attach_snapshot(self, snapshot):
+        # the snapshot contains the converged state of this (null memo) table,
+        # so the initial refresh of the table is skipped
+        assert self.is_null_memo
+        self._memos = Partition(self.variables, self._new_memos_trie())
+        self._snapshot = snapshot
+        self._snapshot_faulted = set()
+        self._skip_refresh = True
+
+    def _load_snapshot(self, first_value=None):
+        snapshot = self._snapshot
+        children = self._memos._children
+        if first_value is None:
+            # load everything which has not already been faulted in
+            self._snapshot = None
+            faulted = self._snapshot_faulted
+            for key in snapshot.rows():
+                if key[0] not in faulted:
+                    children[key] = [terminal(1)]
+            self._snapshot_faulted = set()
+        else:
+            for key in snapshot.rows(first_value):
+                children[key] = [terminal(1)]
+            self._snapshot_faulted.add(first_value)
+        self._memos._hashcache = None
+
     def lookup(self, values):
         assert len(values) == len(self.variables)
-        r = partition_lookup(self.memos, values)
+        if self._snapshot is not None:
+            first = values[0]
+            if first is None or not self._snapshot.indexed:
+                self._load_snapshot()
+            elif first not in self._snapshot_faulted:
+                self._load_snapshot(first)
+        r = partition_lookup(self._memos, values)
 
         # # TODO: remove the flag
         # assert compute_if_not_set != self.is_null_memo
 
         if r is not None or self.is_null_memo:
             #print('memo ret: ', values, r)
+            if r is not None:
+                self.hit_count += 1
+                if self.max_entries is not None:
+                    self.eviction.touch(values)
+            else:
+                self.miss_count += 1
             return r
+        self.miss_count += 1
         # then we are going to compute the value for this and then return the result
 
         if values in self._computing_cycle:
@@ -87,11 +301,11 @@ class MemoContainer:
             assert not self.is_null_memo
 
             # set the entry to the memo table that this is null for this particular key
-            self.memos._children.setdefault(values, []).append(terminal(0))
+            self._store_entry(values, [terminal(0)])
 
             # push a recompute operation for this entry given that we have just guessed
             msg = AgendaMessage(table=self, key=values, is_null_memo=True)
-            push_work(process_agenda_message, msg, dyna_system=self.dyna_system)
+            push_agenda_message(msg, dyna_system=self.dyna_system)
 
             # return that the value is zero
             return terminal(0)
@@ -105,15 +319,83 @@ class MemoContainer:
         # modify the data structure in place, so we are assuming that we own
         # this (which better be the case), though it breaks the "ideal" that
         # these structures are immutable....
-        self.memos._children.setdefault(values, []).append(nR)
+        self._store_entry(values, [nR])
 
         return nR
 
+    def _store_entry(self, key, value):
+        if self.max_entries is not None:
+            eviction = self.eviction
+            if self.memos._children.get(key) is None:
+                while len(eviction) >= self.max_entries:
+                    self._evict(eviction.victim())
+            eviction.add(key)
+        self.memos._children[key] = value
+
+    def _evict(self, key):
+        children = self.memos._children
+        if children.get(key) is not None:
+            del children[key]
+            self.memos._hashcache = None
+        self.eviction_count += 1
+
+    def _forget_entries(self, key):
+        # entries matching key (which might contain None) were deleted from the table
+        if self.max_entries is None:
+            return
+        if None not in key:
+            self.eviction.discard(key)
+        else:
+            for k in self.eviction.keys():
+                if all(a is None or a == b for a, b in zip(key, k)):
+                    self.eviction.discard(k)
+
+    def counters(self):
+        return {
+            'hits': self.hit_count,
+            'misses': self.miss_count,
+            'evictions': self.eviction_count,
+            'entries': len(self.eviction) if self.max_entries is not None else len(self.memos._children),
+        }
+
+    def reset_counters(self):
+        self.hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
+
+    def _new_memos_trie(self):
+        # memo tables start as columnar storage, which is used as long as all
+        # of the entries are ground with multiplicity 1, otherwise it will
+        # convert itself to a PrefixTrie
+        return ColumnarTrie(len(self.variables), terminal(1))
+
+    def _set_memos(self, memos: Partition):
+        # replace the memos with a new table (computed by simplify), which is
+        # converted to the columnar storage if possible
+        children = memos._children
+        if isinstance(children, ColumnarTrie):
+            # the storage might be shared with the body (eg the facts added by
+            # load_facts), which is extended in place by add_to_term
+            c = children.copy()
+            memos = Partition(memos._unioned_vars, c if c is not None else children.map_values(list))
+        elif memos._unioned_vars == self.variables:
+            c = ColumnarTrie.from_trie(children, terminal(1))
+            if c is not None:
+                memos = Partition(self.variables, c)
+        self.memos = memos
+        self.refresh_epoch += 1
+
+    def _new_frame(self):
+        # a frame for simplifying _full_body
+        if self._frame_slots is None:
+            return Frame()
+        return SlotFrame(self._frame_slots)
+
     def compute(self, values):
         # then we are going to determine what the result of this memoized value
         # is this requires constructing a new sub interpreter and using that to
         # set the values etc
-        frame = Frame()
+        frame = self._new_frame()
         for var, imode, val in zip(self.variables, self.argument_mode, values):
             if imode:
                 var.setValue(frame, val)
@@ -153,15 +435,43 @@ class MemoContainer:
 
         self.assumption = Assumption('memo container')
         self.assumption_listener = AssumptionListener(self)
+        self._inline_body()
+
+        for a in self.assumption_always_listen:
+            self.assumption.track(a)  # ensure that these always get notified
+
+    def _inline_body(self):
+        # (re)build _full_body from the body, and track the assumptions that it reads
         self._full_body = inline_all_calls(self.body, set())
+        self._frame_slots = None
+        if getattr(self.dyna_system, 'slot_frames', False):
+            # the variables of the body are numbered so that the frames which
+            # compute it store their values in a list (see SlotFrame)
+            self._full_body, self._frame_slots = number_variables(self._full_body, ignored=self.variables)
+        self._delta_reads = {}  # upstream MemoContainer -> the Aggregator which reads it or None
+        self._parallel_reads = None  # the memo tables read by the body, or False if it might call something else
 
         all_assumptions = set(get_all_assumptions(self._full_body))
 
+        # the keys of the memo tables that are read by the body (with None for
+        # the variables), so that the signals for keys which can not change
+        # this table are not routed to it
+        read_patterns = defaultdict(set)
+        for c in self._full_body.all_children():
+            if isinstance(c, RMemo):
+                read_patterns[c.memos.assumption].add(
+                    tuple(v.getValue(None) if isinstance(v, ConstantVariable) else None for v in c.variables))
+
         for a in all_assumptions:
-            a.track(self.assumption_listener)
+            a.track(self.assumption_listener, read_patterns.get(a))
 
-        for a in self.assumption_always_listen:
-            self.assumption.track(a)  # ensure that these always get notified
+    def body_extended(self):
+        # add_to_term merges new branches into the partition of the body in
+        # place.  _full_body is a copy which does not have the new branches,
+        # and the reads cached for deltas refer to the R-exprs of that copy,
+        # so the body is inlined again.  The new branches might also read
+        # other memo tables (or other keys of them), which are tracked as well
+        self._inline_body()
 
     def invalidate(self):
         # In the case of an invalidation, then the assumption has changed in
@@ -170,7 +480,10 @@ class MemoContainer:
 
 
         # just delete all of the memos
-        self.memos = Partition(self.variables, PrefixTrie(len(self.variables)))
+        self.memos = Partition(self.variables, self._new_memos_trie())
+        self.eviction.clear()
+        self._skip_refresh = False
+        self.refresh_epoch += 1
 
         assumption = self.assumption
 
@@ -186,7 +499,137 @@ class MemoContainer:
             push_work(refresh_whole_table, self, dyna_system=self.dyna_system)
 
 
+    def parallel_safe(self):
+        # If the body can be computed on another thread while this thread is
+        # not writing to any memo table.  Reading null memos does not modify
+        # them, but an unk memo table (or a call which has not been inlined)
+        # could fill in new entries and push work to the agenda.
+        if self._parallel_reads is None:
+            reads = []
+            for c in self._full_body.all_children():
+                if isinstance(c, RMemo):
+                    reads.append(c.memos)
+                elif isinstance(c, (CallTerm, Evaluate, Evaluate_reflect)):
+                    reads = False
+                    break
+            self._parallel_reads = reads
+        reads = self._parallel_reads
+        # a snapshot which is still being faulted in is written by lookup
+        return reads is not False and all(m.is_null_memo and m._snapshot is None for m in reads)
+
+    def _delta_read(self, table):
+        # The read of the aggregated value of table (an Aggregator over RMemo)
+        # in the body of this table.  If the body is not linear in table (it
+        # is read more than once, or inside of another aggregator) then this
+        # returns None, and deltas can not be used.
+        if table not in self._delta_reads:
+            reads = []
+            count = 0
+            def walk(R, path, nested):
+                nonlocal count
+                if isinstance(R, RMemo):
+                    if R.memos is table:
+                        count += 1
+                    return
+                path = path + (R,)
+                if isinstance(R, Aggregator):
+                    if isinstance(R.body, RMemo) and R.body.memos is table:
+                        reads.append((R, path, nested))
+                    nested = True
+                for c in R.children:
+                    walk(c, path, nested)
+            walk(self._full_body, (), False)
+            r = None
+            if count == 1 and len(reads) == 1 and not reads[0][2]:
+                read, path, _ = reads[0]
+                r = read, set(map(id, path))
+            self._delta_reads[table] = r
+        return self._delta_reads[table]
+
+    def _delta_rows(self, read, head, value):
+        # the rows of this table which are contributed when read has the value
+        # for the head, or None if they are not ground
+        read, path = read
+        def rewriter(R):
+            if R is read:
+                return Terminal(1)
+            if isinstance(R, Partition):
+                # only the branches which contain the read depend on its value
+                return Partition(R._unioned_vars, R._children.map_values(lambda v: [rewriter(a) for a in v if id(a) in path]))
+            return R.rewrite(rewriter)
+        frame = self._new_frame()
+        for var, val in zip((*read.head_vars, read.result), (*head, value)):
+            if var.isBound(frame):
+                if var.getValue(frame) != val:
+                    # the read does not match this key (eg `f += g(3)` and g(4) changed)
+                    return []
+            else:
+                var.setValue(frame, val)
+        nR = simplify(rewriter(self._full_body), frame, flatten_keys=True, reduce_to_single=False)
+        if nR.isEmpty():
+            return []
+        if not isinstance(nR, Partition) or nR._unioned_vars != self.variables:
+            return None
+        rows = []
+        for key, values in nR._children.items():
+            if None in key:
+                return None
+            for v in values:
+                if not isinstance(v, Terminal):
+                    return None
+                rows.extend([key]*v.multiplicity)
+        return rows
+
+    def signal_delta(self, msg):
+        # Semi-naive evaluation: msg is a change to the aggregated value of a
+        # single key in another table.  If this table is aggregated with an
+        # invertible aggregator and the body is linear in the other table, then
+        # the change in the rows of this table is computed by evaluating the
+        # body with only the old and new value of the changed key (rather than
+        # recomputing the whole aggregate).  The rows are pushed to the agenda
+        # and combined into this table by process_agenda_messages.
+        #
+        # returns False if a delta can not be used
+        if not self.is_null_memo or self.aggregator is None or not self.aggregator.invertible:
+            return False
+        head = msg.key[:-1]
+        if None in head:
+            return False
+        read = self._delta_read(msg.table)
+        if read is None:
+            return False
+
+        deletion = []
+        addition = []
+        for values, rows in ((msg.deletion, deletion), (msg.addition, addition)):
+            for v in values:
+                r = self._delta_rows(read, head, v)
+                if r is None:
+                    return False
+                rows.extend(r)
+
+        # the rows which are both added and removed cancel out
+        for r in list(deletion):
+            if r in addition:
+                addition.remove(r)
+                deletion.remove(r)
+
+        groups = defaultdict(lambda: ([], []))
+        for r in deletion:
+            groups[r[:-1]][0].append(r)
+        for r in addition:
+            groups[r[:-1]][1].append(r)
+        for h, (d, a) in groups.items():
+            nmsg = AgendaMessage(table=self, key=h + (None,), deletion=tuple(d), addition=tuple(a),
+                                 is_null_memo=True, priority=msg.priority, epoch=self.refresh_epoch,
+                                 delta_id=next(_delta_ids))
+            push_agenda_message(nmsg, dyna_system=self.dyna_system)
+        return True
+
     def signal(self, msg):
+        if msg.addition is not None and self.signal_delta(msg):
+            return
+
         # an assumption can also send a more fine grained notification that
         # something has changed.  In this case the signal will key the key in
         # _another table_ that has changed, so we are going to identify _all_
@@ -233,7 +676,7 @@ class MemoContainer:
 
         res = partition(self.variables, propagators)
 
-        frame = Frame()
+        frame = self._new_frame()
         for var, val in zip(argument_variables, msg.key):
             if val is not None:
                 var.setValue(frame, val)
@@ -245,11 +688,17 @@ class MemoContainer:
 
         refresh_keys = set(nRes._children.keys())
 
+        # the value of the entry which changed is used to prioritize the
+        # refresh of anything that it contributes to
+        priority = msg.priority
+        if priority is None and msg.key:
+            priority = msg.key[-1]
+
         # now we are going to push invalidations/notifications to ourselves to recompute these keys
 
         for k in refresh_keys:
-            msg = AgendaMessage(table=self, key=k, is_null_memo=(msg.is_null_memo and msg.table is self))
-            push_work(process_agenda_message, msg, dyna_system=self.dyna_system)
+            nmsg = AgendaMessage(table=self, key=k, is_null_memo=(msg.is_null_memo and msg.table is self), priority=priority)
+            push_agenda_message(nmsg, dyna_system=self.dyna_system)
 
     def __hash__(self):
         # I suppose that this could use the hash & eq of the R-expr along with the mode which is memoized?
@@ -287,6 +736,9 @@ class RMemo(RBaseType):
     def __hash__(self):
         return super().__hash__()
 
+    def _intern_key(self):
+        return RMemo, intern_vars_key(self.variables), id(self.memos)
+
 
 @simplify.define(RMemo)
 def simplify_memo(self, frame):
@@ -346,7 +798,7 @@ def getPartition_memos(self, frame):
             return
     vmap = dict(zip(self.memos.variables, self.variables))
     for it in getPartitions(self.memos.memos, f):
-        yield RemapVarIterator(vmap, it, vmap[it.variable])
+        yield RemapVarIterator(vmap, it, vmap[it.variable], f)
 
 
 @get_all_assumptions.define(RMemo)
@@ -378,7 +830,7 @@ def naive_converge_memos(*tables):
                 done = False
 
 
-def refresh_whole_table(table):
+def refresh_whole_table(table, nR=None):
     # this is what gets the memoization processes started once we have made a
     # guess.  It performs a computation of the entire table using the program
     # and then will signal anything that might depend on the changes.
@@ -386,26 +838,52 @@ def refresh_whole_table(table):
     # Eg, in the case of fib, this is going to identify that fib(0) = 0 and
     # fib(1) = 1 are inconsistent with the guess that the whole table is null
 
+    if table._skip_refresh:
+        # the table was loaded from a snapshot of its converged state
+        table._skip_refresh = False
+        return
+
     #import ipdb; ipdb.set_trace()
-    nR = simplify(table._full_body, Frame(), flatten_keys=True, reduce_to_single=False)
+    if nR is None:
+        nR = simplify(table._full_body, table._new_frame(), flatten_keys=True, reduce_to_single=False)
 
     if table.memos != nR:
         # then we are going to have to signal these entries, which means
 
         old_memos = table.memos
-        table.memos = nR
+        table._set_memos(nR)
 
         signals = []
 
         # determine which entries have changed
-        for key, a, b in zip_tries(old_memos._children, nR._children):
-            if a != b:
-                # then this value has changed, and we are going to have to signal anything that depends on this
+        for key, a, b in zip_tries(old_memos._children, nR._children, changed_only=True):
+            # then this value has changed, and we are going to have to signal anything that depends on this
+
+            msg = AgendaMessage(table=table, key=key)
+
+            # these things are going to have to push to the agenda that they have been modified
+            table.assumption.signal(msg)
 
-                msg = AgendaMessage(table=table, key=key)
 
-                # these things are going to have to push to the agenda that they have been modified
-                table.assumption.signal(msg)
+def _parallel_task(table, compute, apply):
+    # (group, compute, apply) for the parallel agenda.  If the table is
+    # invalidated by an earlier task in the same wave, then the body has
+    # changed and the computed result is thrown away
+    assumption = table.assumption
+    def apply_if_valid(result):
+        apply(result if table.assumption is assumption else None)
+    return table, compute, apply_if_valid
+
+
+def prepare_refresh_whole_table(table):
+    if table._skip_refresh or not table.parallel_safe():
+        return None
+    return _parallel_task(
+        table,
+        lambda: simplify(table._full_body, table._new_frame(), flatten_keys=True, reduce_to_single=False),
+        lambda nR: refresh_whole_table(table, nR))
+
+refresh_whole_table.parallel_prepare = prepare_refresh_whole_table
 
 
 class ForwardMemoHole(RBaseType):
@@ -420,9 +898,15 @@ class AgendaMessage(NamedTuple):
     table : MemoContainer  # the container that we are updating, this will be tracked via pointer instead of name
     key : Tuple[object]  # the key in the table, this should match the order of arguments as used by the table, None indicates variable not set
 
-    # used in the case that this is an update, and we are able to just add these changes
-    addition : RBaseType = None  # an Rexpr that we are adding to the table or None to indicate nothing here
-    deletion : RBaseType = None  # an Rexpr that we are removing form the table or None
+    # used in the case that this is an update, and we are able to just add these changes (see MemoContainer.signal_delta)
+    #
+    # For a signal from a table, these are the value of the aggregator for the
+    # (ground) head of key before and after the change, as a tuple which is
+    # empty if there is no value.  For a message on the agenda, these are
+    # tuples of the rows that should be added to/removed from the table.  None
+    # if this is not a delta, in which case the key is refreshed.
+    addition : Tuple = None
+    deletion : Tuple = None
 
     # if this is going through an unmemoized aggregator, then we might not be able to just directly modify the value in the table
     # so we are going to have to invalidate something and the perform a recomputation
@@ -432,7 +916,90 @@ class AgendaMessage(NamedTuple):
     # identify that this is now a null memo
     is_null_memo : bool = False
 
+    # the value of the upstream entry that caused this message, used by the
+    # agenda to order the work for selective aggregators (see agenda.SelectiveAggregatorPolicy)
+    priority : object = None
+
+    # MemoContainer.refresh_epoch of the table when a delta was computed.  If
+    # the table has been refreshed since, then the delta might already be
+    # included, so the key is refreshed instead.
+    epoch : int = None
+
+    # unique for each delta, so that two deltas with the same rows (eg from
+    # adding two facts which both contribute 1 to the same key) are not merged
+    # by the agenda as if they were the same message
+    delta_id : int = None
+
+    # the priority only orders the work, so messages that only differ in the
+    # priority are the same work and are merged by the agenda
+    def _without_priority(self):
+        return self[:_PRIORITY_INDEX] + self[_PRIORITY_INDEX+1:]
+
+    def __eq__(self, other):
+        return isinstance(other, AgendaMessage) and self._without_priority() == other._without_priority()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._without_priority())
+
+_PRIORITY_INDEX = AgendaMessage._fields.index('priority')
+
+_delta_ids = itertools.count()
+
 def process_agenda_message(msg: AgendaMessage):
+    process_agenda_messages([msg])
+
+
+def push_agenda_message(msg: AgendaMessage, dyna_system=None):
+    # messages for the same table are coalesced on the agenda, so that a bulk
+    # update to an upstream table results in a single refresh of this table
+    # rather than one per key
+    is_null_memo = msg.table.is_null_memo or msg.is_null_memo
+    push_batched_work(process_agenda_messages, (msg.table, is_null_memo), msg, dyna_system=dyna_system)
+
+
+# if a batch contains more keys than this, then they are generalized to a single
+# key (with None for positions where the keys differ) and the table is refreshed
+# in one pass of simplify, rather than once per key.
+BATCH_GENERALIZE_THRESHOLD = 8
+
+
+def _key_subsumes(a, b):
+    # True if the key `a` (which might contain None as a wildcard) covers all of the entries matched by `b`
+    return all(x is None or x == y for x, y in zip(a, b))
+
+
+def coalesce_keys(msgs):
+    """
+    Returns a dict key -> AgendaMessage where any message which is covered by a
+    wildcard key (containing None) of another message is dropped.
+    """
+    keys = {}
+    for m in msgs:
+        keys.setdefault(m.key, m)
+    wildcards = [k for k in keys if None in k]
+    if not wildcards:
+        return keys
+    res = {}
+    for k, m in keys.items():
+        if not any(w != k and _key_subsumes(w, k) for w in wildcards):
+            res[k] = m
+    return res
+
+
+def generalize_keys(keys):
+    keys = iter(keys)
+    r = list(next(keys))
+    for k in keys:
+        for i, v in enumerate(k):
+            if r[i] is not None and r[i] != v:
+                r[i] = None
+    return tuple(r)
+
+
+def process_agenda_messages(msgs: List[AgendaMessage], computed=None):
     # the msg contains a pointer to the table and which key needs to be
     # updated/invalidated.
     #
@@ -444,66 +1011,261 @@ def process_agenda_message(msg: AgendaMessage):
     # for everything that has been identified as changing, it signals any
     # downstream dependants and then those dependants are responsible for
     # enqueuing their own refresh updates to the agenda  as needed
+    #
+    # All of the messages are for the same table, and they are either all
+    # recomputed or all invalidated (see push_agenda_message)
+    #
+    # computed is the result of simplifying the body for the keys, if this was
+    # already done by the parallel agenda (see prepare_agenda_messages)
 
+    t = msgs[0].table
+    is_null_memo = msgs[0].is_null_memo
 
+    deltas = [m for m in msgs if m.addition is not None]
+    if deltas:
+        _apply_memo_deltas(t, deltas)
+        msgs = [m for m in msgs if m.addition is None]
+        if not msgs:
+            return
 
-    # first we update the memo table with this new entry
-    assert msg.deletion is None  # TODO handle this case
+    if t.is_null_memo or is_null_memo:
+        keys = _refresh_keys(msgs)
+        for key in keys:
+            _refresh_memo_key(t, key, is_null_memo, computed.get(key) if computed else None)
 
-    # TODO: handle these cases
-    assert msg.addition is None and msg.deletion  is None
+    else:
+        keys = coalesce_keys(msgs)
+        # then we are just going to delete the memos as they are unk
+        # we are also going to send messages to downstream entries
+        for key, msg in keys.items():
+            t.memos._children.filter_raw(key).delete_all()
+            t._forget_entries(key)
+        t.memos._hashcache = None
 
-    t = msg.table
+        # send notifications to everything downstream
 
-    if t.is_null_memo or msg.is_null_memo:
-        frame = Frame()
-        for var, val in zip(t.variables, msg.key):
-            if val is not None:
-                var.setValue(frame, val)
-        nR = simplify(t._full_body, frame, flatten_keys=True, reduce_to_single=False)
-        if nR.isEmpty():
+        # this is going to singnal that this key is invalidated, which will have to then be pushed forward
+        for msg in keys.values():
+            t.assumption.signal(msg)
+
+
+def _refresh_keys(msgs):
+    keys = coalesce_keys(msgs)
+    if len(keys) > BATCH_GENERALIZE_THRESHOLD:
+        # null memos are always fully enumerable, so it is fine to refresh
+        # more of the table than what was requested.
+        keys = (generalize_keys(keys),)
+    return keys
+
+
+def prepare_agenda_messages(msgs: List[AgendaMessage]):
+    # only refreshing the keys of a null memo is split, as deltas are cheap
+    # and deleting unk memos does not compute anything
+    t = msgs[0].table
+    if not (t.is_null_memo or msgs[0].is_null_memo) or any(m.addition is not None for m in msgs):
+        return None
+    if not t.parallel_safe():
+        return None
+    keys = list(_refresh_keys(msgs))
+    return _parallel_task(
+        t,
+        lambda: {key: _compute_memo_key(t, key) for key in keys},
+        lambda computed: process_agenda_messages(msgs, computed))
+
+process_agenda_messages.parallel_prepare = prepare_agenda_messages
+
+
+def _group_value(t, head):
+    # The value of the aggregator for a ground head in a table which memoizes
+    # the body of an aggregator.  Returns a tuple which is empty if there is no
+    # value, or None if the value can not be determined as the memos are not ground
+    aggregator = t.aggregator
+    res = None
+    try:
+        for key, values in t.memos._children.filter_raw(head + (None,)):
+            for v in values:
+                if not isinstance(v, Terminal):
+                    return None
+                mul = v.multiplicity
+                if mul and res is None:
+                    res = key[-1]
+                    mul -= 1
+                if mul > 0:
+                    res = aggregator.combine_multiplicity(res, key[-1], mul)
+    except AggregatorSaturated as s:
+        res = s.value
+    if res is None:
+        return ()
+    res = aggregator.lower(res)
+    return () if res is None else (res,)
+
+
+def _stored_group_value(t, head):
+    # the value of the aggregator for the head, which is kept up to date by
+    # the deltas rather than reading all of the rows for the head each time
+    if t._group_values_epoch != t.refresh_epoch:
+        t._group_values = {}
+        t._group_values_epoch = t.refresh_epoch
+    r = t._group_values.get(head)
+    if r is None:
+        r = _group_value(t, head)
+    return r
+
+
+def _apply_memo_deltas(t, msgs):
+    # combine the rows computed by MemoContainer.signal_delta into the table.
+    # The new value of the aggregator for the head is computed from the old
+    # value and the delta, and then signaled to the downstream tables.
+    aggregator = t.aggregator
+    children = t.memos._children
+    groups = {}
+    refresh = set()
+    for m in msgs:
+        if m.epoch != t.refresh_epoch:
+            # the key was recomputed after the delta was computed
+            refresh.add(m.key)
+            continue
+        deletion, addition = groups.setdefault(m.key, ([], []))
+        deletion.extend(m.deletion)
+        addition.extend(m.addition)
+
+    for key, (deletion, addition) in groups.items():
+        if key in refresh:
+            continue
+        head = key[:-1]
+        old = _stored_group_value(t, head)
+
+        counts = defaultdict(int)
+        for r in addition:
+            counts[r] += 1
+        for r in deletion:
+            counts[r] -= 1
+
+        updates = {}
+        for r, c in counts.items():
+            if c == 0:
+                continue
+            v = children.get(r)
+            if v is None:
+                m = 0
+            elif len(v) == 1 and isinstance(v[0], Terminal):
+                m = v[0].multiplicity
+            else:
+                m = -1
+            if m < 0 or m + c < 0 or old is None:
+                # the delta does not match what is stored in the table
+                refresh.add(key)
+                break
+            updates[r] = m + c
+        else:
+            for r, m in updates.items():
+                if m == 0:
+                    del children[r]
+                else:
+                    children[r] = [terminal(m)]
+            t.memos._hashcache = None
+            t.delta_count += 1
+
+            if not children.filter_raw(key):
+                new = ()
+            elif any(type(r[-1]) is not int for r in counts) or (old and type(old[0]) is not int):
+                # subtracting floats is not exact, which would cause the value
+                # to drift from what is computed by reading the table, so the
+                # value is aggregated from the rows for the head instead
+                new = _group_value(t, head)
+            else:
+                value = old[0] if old else None
+                for r, c in counts.items():
+                    for _ in range(abs(c)):
+                        if c < 0:
+                            value = aggregator.inverse(value, r[-1])
+                        elif value is None:
+                            value = r[-1]
+                        else:
+                            value = aggregator.combine(value, r[-1])
+                new = (aggregator.lower(value),)
+            t._group_values[head] = new
+
+            if old != new:
+                mm = AgendaMessage(table=t, key=key, deletion=old, addition=new, is_null_memo=True,
+                                   priority=new[0] if new else None)
+                t.assumption.signal(mm)
+
+    for key in refresh:
+        _refresh_memo_key(t, key, True)
+
+
+def _compute_memo_key(t, key):
+    frame = t._new_frame()
+    for var, val in zip(t.variables, key):
+        if val is not None:
+            var.setValue(frame, val)
+    return simplify(t._full_body, frame, flatten_keys=True, reduce_to_single=False)
+
+
+def _refresh_memo_key(t, key, is_null_memo, nR=None):
+    if nR is None:
+        nR = _compute_memo_key(t, key)
+    t.refresh_epoch += 1
+
+    tf = t.memos._children.filter_raw(key)
+    if nR.isEmpty():
+        if not t.is_null_memo:
             return
-
+        # everything that was previously in the table for this key is removed
+        tn = PrefixTrie(len(key))
+    else:
         # this needs to handle if the partition does the single
-
-        tf = t.memos._children.filter_raw(msg.key)
         tn = nR._children
 
 
-        changes = []
-
-        # we are going to identify which keys are changes and then update those
-        for key, a, b in zip_tries(tf, tn):
-            if a != b:
-                changes.append((key, b))  # given that we are iterating the table, we don't want to make changes to the table while we are iterating.  So we are instead going
+    changes = []
+
+    # we are going to identify which keys are changes and then update those
+    for ckey, a, b in zip_tries(tf, tn, changed_only=True):
+        changes.append((ckey, b))  # given that we are iterating the table, we don't want to make changes to the table while we are iterating.  So we are instead going
+
+    if t.aggregator is not None and t.is_null_memo:
+        # the table is the body of an aggregator, so the changes are grouped
+        # by the head and the change to the aggregated value is signaled, which
+        # can be used by downstream tables to compute a delta
+        heads = defaultdict(list)
+        for ckey, value in changes:
+            heads[ckey[:-1]].append((ckey, value))
+        for head, head_changes in heads.items():
+            old = _group_value(t, head)
+            for ckey, value in head_changes:
+                _write_memo_entry(t, ckey, value)
+            new = _group_value(t, head)
+            if old is None or new is None:
+                for ckey, value in head_changes:
+                    t.assumption.signal(AgendaMessage(table=t, key=ckey, is_null_memo=is_null_memo))
+            elif old != new:
+                mm = AgendaMessage(table=t, key=head + (None,), deletion=old, addition=new, is_null_memo=is_null_memo,
+                                   priority=new[0] if new else None)
+                t.assumption.signal(mm)
+        return
 
-        for key, value in changes:
-            # we are going to write this memo to the table
-            # and then also notify anything that is downstream that might depend on this
+    for ckey, value in changes:
+        # we are going to write this memo to the table
+        # and then also notify anything that is downstream that might depend on this
+        _write_memo_entry(t, ckey, value)
 
-            # this was a fully recompute, so we are going to replace everything for this key rather than just update
-            #ssert value is not None
-            if value is None:
-                del t.memos._children[key]
-            else:
-                t.memos._children[key] = value
+        mm = AgendaMessage(table=t, key=ckey, is_null_memo=is_null_memo)  # make a new message, as this might be more fine grained than before
+        t.assumption.signal(mm)
 
-            mm = AgendaMessage(table=t, key=key, is_null_memo=msg.is_null_memo)  # make a new message, as this might be more fine grained than before
-            t.assumption.signal(mm)
 
+def _write_memo_entry(t, ckey, value):
+    # this was a fully recompute, so we are going to replace everything for this key rather than just update
+    #ssert value is not None
+    if value is None:
+        del t.memos._children[ckey]
+        t._forget_entries(ckey)
     else:
-        # then we are just going to delete the memos as they are unk
-        # we are also going to send messages to downstream entries
-        t.memos._children.filter_raw(msg.key).delete_all()
-        t.memos._hashcache = None
+        t._store_entry(ckey, value)
 
-        # send notifications to everything downstream
 
-        # this is going to singnal that this key is invalidated, which will have to then be pushed forward
-        t.assumption.signal(msg)
-
-
-def rewrite_to_memoize(R, mem_variables=None, is_null_memo=False, dyna_system=None):
+def rewrite_to_memoize(R, mem_variables=None, is_null_memo=False, dyna_system=None, max_entries=None, eviction=None):
     if isinstance(R, Aggregator):
         # then we are going mark that we require the keys for now I suppose?
         # that should let us memoize anything that is fully determined, but if
@@ -527,7 +1289,8 @@ def rewrite_to_memoize(R, mem_variables=None, is_null_memo=False, dyna_system=No
 
         assert isinstance(R.body, Partition)
 
-        memos = MemoContainer(argument_mode, supported_mode, variables, R.body, is_null_memo=is_null_memo, dyna_system=dyna_system)
+        memos = MemoContainer(argument_mode, supported_mode, variables, R.body, is_null_memo=is_null_memo, dyna_system=dyna_system, aggregator=R.aggregator,
+                              max_entries=max_entries, eviction=eviction)
         return Aggregator(R.result, R.head_vars, R.body_res, R.aggregator, RMemo(variables, memos))
 
     elif isinstance(R, Partition):
@@ -540,13 +1303,16 @@ def rewrite_to_memoize(R, mem_variables=None, is_null_memo=False, dyna_system=No
         if is_null_memo:
             supported_mode = (False,)*len(argument_mode)
         else:
-            supported_mode = (True,)*len(R.head_vars)+(False,)
+            # the memoized variables must be bound to perform a lookup
+            supported_mode = argument_mode
 
-        memos = MemoContainer(argument_mode, supported_mode, variables, R, is_null_memo=is_null_memo, dyna_system=dyna_system)
+        memos = MemoContainer(argument_mode, supported_mode, variables, R, is_null_memo=is_null_memo, dyna_system=dyna_system,
+                              max_entries=max_entries, eviction=eviction)
         return RMemo(variables, memos)
     else:
         if len(R.children) == 1:
-            return R.rewrite(lambda x: rewrite_to_memoize(x, mem_variables=mem_variables, is_null_memo=is_null_memo, dyna_system=dyna_system))
+            return R.rewrite(lambda x: rewrite_to_memoize(x, mem_variables=mem_variables, is_null_memo=is_null_memo, dyna_system=dyna_system,
+                                                          max_entries=max_entries, eviction=eviction))
 
         raise RuntimeError("""
         Did not find an aggregator or partition to rewrite to memoize.
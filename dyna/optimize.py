@@ -501,12 +501,14 @@ def lift_up_equivalent_constraints(R):
     pass
 
 
-def run_optimizer_local(R, exposed_variables):
+def run_optimizer_local(R, exposed_variables, check_exposed=True):
     """This is the entry point for the optimizer that is _only_ going to operate on
     a single R-expr.  This will return a new R-expr that is semantically
     equivalent and at least the variables listed in exposed_variables will have
     the _same_ name (this is not gaurenteed for any other variables which might
-    be eleminated) """
+    be eleminated).  check_exposed asserts that the exposed variables are not
+    removed, which a single branch of a partition is allowed to do if it does
+    not constrain the variable."""
 
     ex = set(R.all_vars()) & set(exposed_variables)
 
@@ -576,7 +578,7 @@ def run_optimizer_local(R, exposed_variables):
 
     # import ipdb; ipdb.set_trace()
 
-    assert ex.issubset(set(R.all_vars())) or R.isEmpty()
+    assert not check_exposed or ex.issubset(set(R.all_vars())) or R.isEmpty()
 
     return R, assumptions
 
@@ -587,12 +589,18 @@ def run_optimizer(R, exposed_variables):
 
     rr, assumptions = run_optimizer_local(R, exposed_variables)
 
+    return split_optimized(rr), assumptions
+
+
+def split_optimized(rr):
+    # split the common states out of the optimized expression into external
+    # calls (see split_heuristic)
     splits = split_heuristic(construct_intersecting(rr))
 
     assert isinstance(rr, RBaseType)
 
     if not splits:
-        return rr, assumptions
+        return rr
 
     rsplits = refine_splits(splits)
 
@@ -602,7 +610,128 @@ def run_optimizer(R, exposed_variables):
 
     assert isinstance(mk, RBaseType)
 
-    return mk, assumptions
+    return mk
+
+
+class OptimizerCache:
+    """
+    The optimized branches of the terms which are optimized by
+    run_optimizer_incremental.  The branches are keyed by their structure, so
+    when a rule is added to a term, only the new branch has to be optimized and
+    the other branches are reused (as long as the assumptions used to optimize
+    them are still valid).
+    """
+
+    def __init__(self):
+        self._terms = {}  # term -> (the exposed variables, {structure key: (optimized branch, assumptions)})
+        self.reset_counters()
+
+    def forget(self, term):
+        self._terms.pop(term, None)
+
+    def reset_counters(self):
+        self.optimized_branches = 0
+        self.optimized_nodes = 0  # the R-expr nodes of the branches which were (re)optimized
+        self.reused_branches = 0
+        self.reused_nodes = 0
+
+    def counters(self):
+        return {
+            'optimized_branches': self.optimized_branches,
+            'optimized_nodes': self.optimized_nodes,
+            'reused_branches': self.reused_branches,
+            'reused_nodes': self.reused_nodes,
+        }
+
+
+def _structure_key(R):
+    # the repr includes the names of the variables, structures and called
+    # terms, which __eq__ does not always compare.  The aggregators are not
+    # part of the repr
+    return repr(R._tuple_rep()), tuple(id(c.aggregator) for c in R.all_children() if isinstance(c, Aggregator))
+
+
+def _rekey_branch(R, key, uv):
+    # a partition with a single branch is replaced by the branch when it is
+    # optimized, with the ground values of the key as unify constraints.  This
+    # moves those values back into the key, so that the branch is stored the
+    # same way as when the whole partition is optimized
+    key = list(key)
+    rest = []
+    for c in (R.children if isinstance(R, Intersect) else (R,)):
+        if isinstance(c, Unify):
+            var, const = (c.v1, c.v2) if isinstance(c.v2, ConstantVariable) else (c.v2, c.v1)
+            if isinstance(const, ConstantVariable) and var in uv and key[uv.index(var)] is None:
+                key[uv.index(var)] = const.getValue(None)
+                continue
+        rest.append(c)
+    return tuple(key), intersect(*rest)
+
+
+def run_optimizer_incremental(R, exposed_variables, cache, term):
+    """Like run_optimizer, but for a term defined by more than one rule (an
+    aggregator over a partition), each branch of the partition is optimized on
+    its own and the results are saved in the cache.  When the term is optimized
+    again, only the branches which have changed are optimized.  Optimizations
+    between the different branches are not found this way."""
+    from .terms import CallTerm
+
+    body = getattr(R, 'body', None)
+    if not (isinstance(R, Aggregator) and isinstance(body, Partition) and
+            sum(len(vs) for _, vs in body._children.items()) > 1):
+        cache.forget(term)
+        return run_optimizer(R, exposed_variables)
+
+    if any(isinstance(c, CallTerm) and c.term_ref == term
+           for _, vs in body._children.items() for b in vs for c in b.all_children()):
+        # a recursive branch inlines all of the branches of the term, so
+        # optimizing it on its own is not the same as optimizing the partition
+        cache.forget(term)
+        return run_optimizer(R, exposed_variables)
+
+    uv = body._unioned_vars
+    bexposed = frozenset((*exposed_variables, *uv, *R.head_vars, R.body_res))
+
+    old_exposed, old = cache._terms.get(term, (None, {}))
+    if old_exposed != bexposed:
+        old = {}
+    saved = {}
+
+    assumptions = set()
+    children = PrefixTrie(len(uv))
+    for key, branches in body._children.items():
+        for b in branches:
+            skey = (key, _structure_key(b))
+            nodes = sum(1 for _ in b.all_children())
+            hit = saved.get(skey) or old.get(skey)
+            if hit is not None and all(a.isValid() for a in hit[1]):
+                rb, ba = hit
+                cache.reused_branches += 1
+                cache.reused_nodes += nodes
+            else:
+                bt = PrefixTrie(len(uv))
+                bt[key] = [b]
+                rb, ba = run_optimizer_local(Partition(uv, bt), bexposed, check_exposed=False)
+                ba = frozenset(ba)
+                cache.optimized_branches += 1
+                cache.optimized_nodes += nodes
+            saved[skey] = (rb, ba)
+            assumptions |= ba
+
+            if rb.isEmpty():
+                continue
+            if isinstance(rb, Partition) and rb._unioned_vars == uv:
+                for k, vs in rb._children.items():
+                    children.setdefault(k, []).extend(vs)
+            else:
+                k, rb = _rekey_branch(rb, key, uv)
+                children.setdefault(k, []).append(rb)
+
+    # only the branches of the current version of the term are kept
+    cache._terms[term] = (bexposed, saved)
+
+    rr = Aggregator(R.result, R.head_vars, R.body_res, R.aggregator, Partition(uv, children))
+    return split_optimized(rr), assumptions
 
 
 
@@ -1,18 +1,64 @@
+from array import array
+import sys
+
 _NOT_FOUND = object()
 #_EMPTY_FILTER = slice(None)
 
+# the bucket of a secondary index for the keys which have a wildcard in one of the indexed positions
+_WILDCARD = object()
+
+# number of times that the bound positions of a filter have to be scanned
+# before a secondary index is built for them
+INDEX_BUILD_THRESHOLD = 2
+
 setdefault = dict.setdefault
 
+
+def _trie_keys(a, depth, prefix=()):
+    # all of the keys in the nested dicts
+    if depth == 0:
+        yield prefix
+        return
+    for k, v in a.items():
+        yield from _trie_keys(v, depth-1, prefix+(k,))
+
+
+def _index_add(index, positions, key):
+    proj = tuple(key[i] for i in positions)
+    if None in proj:
+        proj = _WILDCARD
+    setdefault(index, proj, {})[key] = None
+
+
+def _index_remove(index, positions, key):
+    proj = tuple(key[i] for i in positions)
+    if None in proj:
+        proj = _WILDCARD
+    bucket = index.get(proj)
+    if bucket is not None:
+        bucket.pop(key, None)
+        if not bucket:
+            del index[proj]
+
 class PrefixTrie:
     """
     Basic prefix trie.  None is treated as a wild card.
+
+    Looking up a filter whose bound positions are not a prefix of the key has
+    to scan the levels of the trie before the bound positions.  If the same
+    positions are scanned repeatedly, then a secondary index from the values
+    of those positions to the matching keys is built, so that the lookup is
+    proportional to the number of matches.  The indexes are shared by all of
+    the filtered views of the trie and are updated when keys are set or deleted.
     """
 
-    __slots__ = ('_root', '_filter')
+    __slots__ = ('_root', '_filter', '_indexes')
 
-    def __init__(self, nargs, *, _filter=None, _root=None):
-        self._root = _root or {}
+    def __init__(self, nargs, *, _filter=None, _root=None, _indexes=None):
+        self._root = {} if _root is None else _root
         self._filter = _filter or (None,)*nargs
+        # bound positions -> number of scans, or the index once it is built
+        self._indexes = {} if _indexes is None else _indexes
 
     def _mkfilter(self, key):
         # unsure if this how this filtering should be handled, maybe this should
@@ -64,6 +110,8 @@ class PrefixTrie:
         for i in key[:-1]:
             a = setdefault(a, i, {})
         a[key[-1]] = value
+        if self._indexes:
+            self._indexes_add(key)
 
     def setdefault(self, key, default):
         setdefault = dict.setdefault
@@ -71,8 +119,73 @@ class PrefixTrie:
         a = self._root
         for i in key[:-1]:
             a = setdefault(a, i, {})
+        if self._indexes:
+            self._indexes_add(key)
         return setdefault(a, key[-1], default)
 
+    def _indexes_add(self, key):
+        key = tuple(key)
+        for positions, index in self._indexes.items():
+            if type(index) is dict:
+                _index_add(index, positions, key)
+
+    def _indexes_remove(self, key):
+        key = tuple(key)
+        for positions, index in self._indexes.items():
+            if type(index) is dict:
+                _index_remove(index, positions, key)
+
+    def _index_positions(self):
+        # the bound positions of the filter if they are not a prefix of the key
+        positions = tuple(i for i, v in enumerate(self._filter) if v is not None)
+        if not positions or positions[-1] == len(positions) - 1:
+            return None
+        return positions
+
+    def _index_for(self, positions):
+        # returns the index for the positions, or None if the trie should be
+        # scanned as there have not been enough lookups to build the index
+        indexes = self._indexes
+        index = indexes.get(positions, 0)
+        if type(index) is dict:
+            return index
+        if index + 1 < INDEX_BUILD_THRESHOLD:
+            indexes[positions] = index + 1
+            return None
+        # built before it is stored, as another thread (see the parallel
+        # agenda) might read the index while it is being built
+        index = {}
+        for key in self._all_keys():
+            _index_add(index, positions, key)
+        indexes[positions] = index
+        return index
+
+    def _all_keys(self):
+        return _trie_keys(self._root, len(self._filter))
+
+    def _lookup_key(self, key):
+        # the value for a key that is known to be in the trie
+        a = self._root
+        for i in key:
+            a = a[i]
+        return a
+
+    def _iter_index(self, index, positions):
+        f = self._filter
+        values = tuple(f[i] for i in positions)
+        lookup = self._lookup_key
+        for bucket, check in ((index.get(values), False), (index.get(_WILDCARD), True)):
+            if not bucket:
+                continue
+            for key in bucket:
+                if check and not all(key[i] is None or key[i] == v for i, v in zip(positions, values)):
+                    continue
+                yield key, lookup(key)
+
+    def index_positions(self):
+        # the positions for which there is a secondary index
+        return [positions for positions, index in self._indexes.items() if type(index) is dict]
+
     def filter_extend(self, key):
         # this extends a given filter that might already be applied to the prefix trie
         nfilter = []
@@ -87,15 +200,16 @@ class PrefixTrie:
                 a += 1
         assert b == len(key)
 
-        return PrefixTrie(0, _filter=tuple(nfilter), _root=self._root)
+        return PrefixTrie(0, _filter=tuple(nfilter), _root=self._root, _indexes=self._indexes)
 
     def filter_raw(self, key):
         # this resets the filter, and might expose more stuff then was initially requested
         assert len(key) == len(self._filter)
-        return PrefixTrie(0, _filter=tuple(key), _root=self._root)
+        return PrefixTrie(0, _filter=tuple(key), _root=self._root, _indexes=self._indexes)
 
     def delete_all(self):
         # delete everything that matches the current filter
+        deleted = list(self.keys()) if self._indexes else ()
         def r(prefix, f, a):
             z = f[len(prefix)]
             if len(f) - 1 == len(prefix):
@@ -103,7 +217,7 @@ class PrefixTrie:
                     a.clear()
                 else:
                     assert None not in a  # TODO: how does this get handled, are we deleting it?  It would match I suppose, but it matches many things
-                    del a[z]
+                    a.pop(z, None)
             else:
                 if z is None:
                     for k, v in a.items():
@@ -115,6 +229,8 @@ class PrefixTrie:
                     if w is not None:
                         r(prefix+(z,), f, w)
         r((), self._filter, self._root)
+        for key in deleted:
+            self._indexes_remove(key)
 
     def __delitem__(self, key):
         # this should maybe
@@ -124,9 +240,17 @@ class PrefixTrie:
         for i in key[:-1]:
             a = a[i]  #setdefault(a, i, {})
         del a[key[-1]]
+        if self._indexes:
+            self._indexes_remove(key)
 
     def __iter__(self):
         # this iterates over all of the tuples that match the current filter
+        positions = self._index_positions()
+        if positions is not None:
+            index = self._index_for(positions)
+            if index is not None:
+                yield from self._iter_index(index, positions)
+                return
         def r(prefix, f, a):
             if len(f) == len(prefix):
                 yield prefix, a
@@ -239,86 +363,731 @@ class PrefixTrie:
         return sum(None is v for v in self._filter)
 
 
-def zip_tries(Ta, Tb):
+class _ColumnStore:
+    # the storage shared between all of the filtered views of a ColumnarTrie
+
+    __slots__ = ('unit', 'columns', 'index', 'nrows', 'root', 'indexes')
+
+    def __init__(self, nargs, unit):
+        self.unit = unit  # every row has the value [unit]
+        self.columns = [None]*nargs  # created on the first insert, as the type of column depends on the value
+        self.index = {}  # value of the first column -> row or list of rows
+        self.nrows = 0
+        self.root = None  # set if this has been converted into a prefix trie
+        self.indexes = {}  # the secondary indexes of the prefix trie (see PrefixTrie)
+
+
+def _new_column(value):
+    t = type(value)
+    if t is int:
+        return array('q')
+    elif t is float:
+        return array('d')
+    return []
+
+
+class ColumnarTrie(PrefixTrie):
+    """
+    Compact storage for a trie where every key is ground and every value is
+    [unit] (eg, a memo table of ground values with multiplicity 1).  The keys
+    are stored as typed columns (using array for ints and floats), and there is
+    a hash index over the first column.
+
+    If something is stored which does not fit (a None in the key or a
+    different value), then this is converted into a normal PrefixTrie, which is
+    used by all of the views that share the storage.
+    """
+
+    __slots__ = ('_store',)
+
+    def __init__(self, nargs, unit, *, _filter=None, _store=None):
+        self._filter = _filter or (None,)*nargs
+        self._store = _store or _ColumnStore(len(self._filter), unit)
+
+    @classmethod
+    def from_trie(cls, trie, unit):
+        # returns None if the trie can not be represented with columns
+        r = cls(len(trie._filter), unit)
+        for key, value in trie.items():
+            if not r._conforms(key, value):
+                return None
+            r._append(key)
+        return r
+
+    @classmethod
+    def from_columns(cls, columns, unit):
+        # a trie with a row for each position of the columns, which must all
+        # have the same length.  The columns are used as is, so they should be
+        # arrays (with typecode 'q' or 'd') or lists, and the rows should be
+        # distinct
+        r = cls(len(columns), unit)
+        store = r._store
+        nrows = len(columns[0])
+        assert all(len(c) == nrows for c in columns)
+        store.columns = list(columns)
+        store.nrows = nrows
+        index = store.index
+        for row, v in enumerate(columns[0]):
+            b = index.get(v)
+            if b is None:
+                index[v] = row
+            elif type(b) is int:
+                index[v] = [b, row]
+            else:
+                b.append(row)
+        return r
+
+    def extend_rows(self, other):
+        # add the rows of another ColumnarTrie, returns False (without changing
+        # anything) if either of them is not columnar
+        store = self._store
+        if (store.root is not None or not isinstance(other, ColumnarTrie) or other._store.root is not None or
+            other._store.unit != store.unit or self._filter != (None,)*len(self._filter)):
+            return False
+        for key, _ in other:
+            if self._find(key) == -1:
+                self._append(key)
+        return True
+
+    def _copy_store(self):
+        # an unfiltered trie with a copy of the rows of the storage
+        store = self._store
+        if not store.nrows:
+            return ColumnarTrie(len(self._filter), store.unit)
+        return ColumnarTrie.from_columns([c[:] for c in store.columns], store.unit)
+
+    def copy(self):
+        # a trie with its own storage (the views made by filter_raw share the
+        # storage), None if this can not be stored as columns
+        if self._store.root is None and self._filter == (None,)*len(self._filter):
+            return self._copy_store()
+        return ColumnarTrie.from_trie(self, self._store.unit)
+
+    @property
+    def _root(self):
+        # only set once this has been converted into a prefix trie, in which
+        # case the methods of PrefixTrie can be used directly
+        return self._store.root
+
+    @property
+    def _indexes(self):
+        return self._store.indexes
+
+    @property
+    def is_columnar(self):
+        return self._store.root is None
+
+    def _conforms(self, key, value):
+        return (None not in key and type(value) is list and len(value) == 1 and
+                value[0] == self._store.unit)
+
+    def _promote(self):
+        # convert to a prefix trie
+        store = self._store
+        trie = PrefixTrie(len(self._filter))
+        unit = store.unit
+        for row in range(store.nrows):
+            trie[tuple(c[row] for c in store.columns)] = [unit]
+        store.root = trie._root
+        store.columns = store.index = None
+        store.nrows = 0
+        store.indexes = {}  # the indexes of rows are replaced by the indexes of the prefix trie
+
+    def _row_key(self, row):
+        return tuple(c[row] for c in self._store.columns)
+
+    def _find(self, key):
+        # the row exactly matching the key or -1
+        store = self._store
+        r = store.index.get(key[0])
+        if r is None:
+            return -1
+        columns = store.columns
+        for row in ((r,) if type(r) is int else r):
+            if all(c[row] == k for c, k in zip(columns, key)):
+                return row
+        return -1
+
+    def _rows(self, key):
+        # generate the rows which match the key, None is a wildcard
+        store = self._store
+        columns = store.columns
+        checks = [(c, k) for c, k in zip(columns, key) if k is not None]
+        if key[0] is not None:
+            r = store.index.get(key[0])
+            if r is None:
+                return
+            rows = (r,) if type(r) is int else list(r)
+            checks = checks[1:]
+        elif checks:
+            # the same as the secondary indexes of PrefixTrie, but the index is to the rows
+            positions = tuple(i for i, k in enumerate(key) if k is not None)
+            index = self._row_index(positions)
+            if index is not None:
+                yield from list(index.get(tuple(key[i] for i in positions), ()))
+                return
+            rows = range(store.nrows)
+        else:
+            rows = range(store.nrows)
+        if not checks:
+            yield from rows
+            return
+        for row in rows:
+            for c, k in checks:
+                if c[row] != k:
+                    break
+            else:
+                yield row
+
+    def _row_index(self, positions):
+        store = self._store
+        index = store.indexes.get(positions, 0)
+        if type(index) is dict:
+            return index
+        if index + 1 < INDEX_BUILD_THRESHOLD:
+            store.indexes[positions] = index + 1
+            return None
+        index = {}  # built before it is stored, see PrefixTrie._index_for
+        columns = store.columns
+        for row in range(store.nrows):
+            setdefault(index, tuple(columns[i][row] for i in positions), {})[row] = None
+        store.indexes[positions] = index
+        return index
+
+    def _row_indexes_update(self, row, add):
+        # add or remove the row from all of the secondary indexes
+        columns = self._store.columns
+        for positions, index in self._store.indexes.items():
+            if type(index) is dict:
+                proj = tuple(columns[i][row] for i in positions)
+                if add:
+                    setdefault(index, proj, {})[row] = None
+                else:
+                    bucket = index[proj]
+                    del bucket[row]
+                    if not bucket:
+                        del index[proj]
+
+    def _merged_filter(self, key):
+        if key is None:
+            return self._filter
+        return tuple(f if k is None else k for f, k in zip(self._filter, key))
+
+    def _append(self, key):
+        store = self._store
+        columns = store.columns
+        row = store.nrows
+        for i, v in enumerate(key):
+            c = columns[i]
+            if c is None:
+                c = columns[i] = _new_column(v)
+            if type(c) is array:
+                if type(v) is (int if c.typecode == 'q' else float):
+                    try:
+                        c.append(v)
+                        continue
+                    except OverflowError:
+                        pass
+                c = columns[i] = c.tolist()
+            c.append(v)
+        store.nrows += 1
+        if store.indexes:
+            self._row_indexes_update(row, True)
+        r = store.index.get(key[0])
+        if r is None:
+            store.index[key[0]] = row
+        elif type(r) is int:
+            store.index[key[0]] = [r, row]
+        else:
+            r.append(row)
+
+    def _index_replace(self, k, old, new):
+        # replace (or delete if new is None) the row in the bucket of the index
+        index = self._store.index
+        r = index[k]
+        if type(r) is int:
+            assert r == old
+            if new is None:
+                del index[k]
+            else:
+                index[k] = new
+        else:
+            r.remove(old)
+            if new is not None:
+                r.append(new)
+            elif len(r) == 1:
+                index[k] = r[0]
+
+    def _delete_row(self, row):
+        # move the last row into the deleted slot
+        store = self._store
+        columns = store.columns
+        last = store.nrows - 1
+        if store.indexes:
+            self._row_indexes_update(row, False)
+            if row != last:
+                self._row_indexes_update(last, False)
+        self._index_replace(columns[0][row], row, None)
+        if row != last:
+            self._index_replace(columns[0][last], last, row)
+            for c in columns:
+                c[row] = c[last]
+        for c in columns:
+            c.pop()
+        store.nrows -= 1
+        if store.indexes and row != last:
+            self._row_indexes_update(row, True)
+
+    def get(self, key, default=None):
+        if self._store.root is not None:
+            return PrefixTrie.get(self, key, default)
+        assert len(key) == len(self._filter)
+        if None in key or self._find(key) == -1:
+            return default
+        return [self._store.unit]
+
+    def __setitem__(self, key, value):
+        if self._store.root is None:
+            assert len(key) == len(self._filter)
+            if self._conforms(key, value):
+                if self._find(key) == -1:
+                    self._append(key)
+                return
+            self._promote()
+        PrefixTrie.__setitem__(self, key, value)
+
+    def setdefault(self, key, default):
+        # the returned value might be modified, so we can not keep the columnar representation
+        if self._store.root is None:
+            self._promote()
+        return PrefixTrie.setdefault(self, key, default)
+
+    def filter_extend(self, key):
+        r = PrefixTrie.filter_extend(self, key)
+        return ColumnarTrie(0, None, _filter=r._filter, _store=self._store)
+
+    def filter_raw(self, key):
+        assert len(key) == len(self._filter)
+        return ColumnarTrie(0, None, _filter=tuple(key), _store=self._store)
+
+    def delete_all(self):
+        if self._store.root is not None:
+            return PrefixTrie.delete_all(self)
+        for row in sorted(self._rows(self._filter), reverse=True):
+            self._delete_row(row)
+
+    def __delitem__(self, key):
+        if self._store.root is not None:
+            return PrefixTrie.__delitem__(self, key)
+        row = -1 if None in key else self._find(key)
+        if row == -1:
+            raise KeyError(key)
+        self._delete_row(row)
+
+    def __iter__(self):
+        if self._store.root is not None:
+            yield from PrefixTrie.__iter__(self)
+            return
+        unit = self._store.unit
+        columns = self._store.columns
+        for row in self._rows(self._filter):
+            yield tuple(c[row] for c in columns), [unit]
+
+    def map_values(self, mapper):
+        if self._store.root is not None:
+            return PrefixTrie.map_values(self, mapper)
+        unit = self._store.unit
+        if mapper([unit]) == [unit]:
+            # every value is [unit], so this is a copy (eg renaming the
+            # variables of a term's facts), which can keep the columns
+            return ColumnarTrie(0, None, _filter=self._filter, _store=self._copy_store()._store)
+        r = PrefixTrie(len(self._filter))
+        for k, v in self:
+            r[k] = mapper(v)
+        return r.filter_raw(self._filter)
+
+    def map_values_wkey(self, mapper):
+        if self._store.root is not None:
+            return PrefixTrie.map_values_wkey(self, mapper)
+        r = PrefixTrie(len(self._filter))
+        for k, v in self:
+            r[k] = mapper(k, v)
+        return r.filter_raw(self._filter)
+
+    def column_values(self, position, key=None):
+        # the distinct values in a column for the rows that match the filter
+        # and key, without constructing the rows
+        assert self._store.root is None
+        column = self._store.columns[position]
+        if column is None:
+            return ()
+        return dict.fromkeys(column[row] for row in self._rows(self._merged_filter(key))).keys()
+
+    def count_rows(self, key=None):
+        # the number of rows that match the filter and key
+        assert self._store.root is None
+        key = self._merged_filter(key)
+        if all(k is None for k in key):
+            return self._store.nrows
+        return sum(1 for _ in self._rows(key))
+
+    def contains_value(self, position, value, key=None):
+        assert self._store.root is None
+        key = list(self._merged_filter(key))
+        if key[position] is not None and key[position] != value:
+            return False
+        key[position] = value
+        for row in self._rows(key):
+            return True
+        return False
+
+    def __len__(self):
+        if self._store.root is None and self._filter == (None,)*len(self._filter):
+            return self._store.nrows
+        return PrefixTrie.__len__(self)
+
+    def __eq__(self, other):
+        return self is other or \
+            (isinstance(other, PrefixTrie) and
+             self._filter == other._filter and
+             _same_known_len(self, other) and
+             dict(self.items()) == dict(other.items()))
+
+    def memory_usage(self):
+        # approximate number of bytes used by the columns and the index
+        store = self._store
+        if store.root is not None:
+            return None
+        size = sys.getsizeof(store.index) + sum(sys.getsizeof(k) for k in store.index)
+        for r in store.index.values():
+            size += sys.getsizeof(r) + (sum(sys.getsizeof(a) for a in r) if type(r) is list else 0)
+        for c in store.columns:
+            if c is not None:
+                size += sys.getsizeof(c)
+                if type(c) is list:
+                    size += sum(sys.getsizeof(v) for v in c)
+        return size
+
+
+def _known_len(trie):
+    # the number of rows of an unfiltered columnar or flat trie, None if this
+    # would require iterating over the rows
+    store = getattr(trie, '_store', None)
+    if store is None or store.root is not None or trie._filter != (None,)*len(trie._filter):
+        return None
+    return store.nrows if type(store) is _ColumnStore else len(store.flat)
+
+
+def _same_known_len(a, b):
+    # False if the tries have a different number of rows, which is cheaper to
+    # check than comparing all of the rows
+    la, lb = _known_len(a), _known_len(b)
+    return la is None or lb is None or la == lb
+
+
+class _FlatStore:
+    # the storage shared between all of the filtered views of a FlatTrie
+
+    __slots__ = ('flat', 'root', 'indexes')
+
+    def __init__(self):
+        self.flat = {}  # ground key tuple -> value
+        self.root = None  # set if this has been converted into a prefix trie
+        self.indexes = {}  # the secondary indexes (see PrefixTrie), these are kept when promoted
+
+
+class FlatTrie(PrefixTrie):
+    """
+    A PrefixTrie where all of the keys are ground, stored in a single dict
+    keyed by the tuple rather than in nested dicts with one level per
+    argument.  Setting or iterating a key does not walk the levels or rebuild
+    the key tuple.  Once a key with a wildcard (None) is stored, this is
+    converted into the nested dicts of PrefixTrie, which is used by all of the
+    views that share the storage.
+    """
+
+    __slots__ = ('_store',)
+
+    def __init__(self, nargs, *, _filter=None, _store=None):
+        self._filter = _filter or (None,)*nargs
+        self._store = _FlatStore() if _store is None else _store
+
+    @property
+    def _root(self):
+        return self._store.root
+
+    @property
+    def _indexes(self):
+        return self._store.indexes
+
+    @property
+    def is_flat(self):
+        return self._store.root is None
+
+    def _promote(self):
+        store = self._store
+        trie = PrefixTrie(len(self._filter))
+        for key, value in store.flat.items():
+            PrefixTrie.__setitem__(trie, key, value)
+        store.root = trie._root
+        store.flat = None
+
+    def _all_keys(self):
+        if self._store.root is not None:
+            return PrefixTrie._all_keys(self)
+        return iter(self._store.flat)
+
+    def _lookup_key(self, key):
+        if self._store.root is not None:
+            return PrefixTrie._lookup_key(self, key)
+        return self._store.flat[key]
+
+    def get(self, key, default=None):
+        if self._store.root is not None:
+            return PrefixTrie.get(self, key, default)
+        assert len(key) == len(self._filter)
+        return self._store.flat.get(tuple(key), default)
+
+    def __setitem__(self, key, value):
+        store = self._store
+        if store.root is None:
+            assert len(key) == len(self._filter)
+            if None not in key:
+                key = tuple(key)
+                store.flat[key] = value
+                if store.indexes:
+                    self._indexes_add(key)
+                return
+            self._promote()
+        PrefixTrie.__setitem__(self, key, value)
+
+    def setdefault(self, key, default):
+        store = self._store
+        if store.root is None:
+            assert len(key) == len(self._filter)
+            if None not in key:
+                key = tuple(key)
+                if store.indexes:
+                    self._indexes_add(key)
+                return store.flat.setdefault(key, default)
+            self._promote()
+        return PrefixTrie.setdefault(self, key, default)
+
+    def filter_extend(self, key):
+        r = PrefixTrie.filter_extend(self, key)
+        return FlatTrie(0, _filter=r._filter, _store=self._store)
+
+    def filter_raw(self, key):
+        assert len(key) == len(self._filter)
+        return FlatTrie(0, _filter=tuple(key), _store=self._store)
+
+    def delete_all(self):
+        store = self._store
+        if store.root is not None:
+            return PrefixTrie.delete_all(self)
+        f = self._filter
+        if f == (None,)*len(f):
+            store.flat.clear()
+            for positions, index in store.indexes.items():
+                if type(index) is dict:
+                    index.clear()
+            return
+        for key in list(self.keys()):
+            del store.flat[key]
+            if store.indexes:
+                self._indexes_remove(key)
+
+    def __delitem__(self, key):
+        store = self._store
+        if store.root is not None:
+            return PrefixTrie.__delitem__(self, key)
+        key = tuple(key)
+        del store.flat[key]
+        if store.indexes:
+            self._indexes_remove(key)
+
+    def __iter__(self):
+        store = self._store
+        if store.root is not None:
+            yield from PrefixTrie.__iter__(self)
+            return
+        f = self._filter
+        positions = tuple(i for i, v in enumerate(f) if v is not None)
+        if not positions:
+            yield from store.flat.items()
+        elif len(positions) == len(f):
+            v = store.flat.get(f, _NOT_FOUND)
+            if v is not _NOT_FOUND:
+                yield f, v
+        else:
+            # a prefix of the key is not faster to find than any other positions
+            index = self._index_for(positions)
+            if index is not None:
+                yield from self._iter_index(index, positions)
+                return
+            for key, v in store.flat.items():
+                for i in positions:
+                    if key[i] != f[i]:
+                        break
+                else:
+                    yield key, v
+
+    def _mapped(self, items):
+        r = FlatTrie(len(self._filter))
+        r._store.flat = dict(items)
+        return FlatTrie(0, _filter=self._filter, _store=r._store)
+
+    def map_values(self, mapper):
+        if self._store.root is not None:
+            return PrefixTrie.map_values(self, mapper)
+        return self._mapped((k, mapper(v)) for k, v in self)
+
+    def map_values_wkey(self, mapper):
+        if self._store.root is not None:
+            return PrefixTrie.map_values_wkey(self, mapper)
+        return self._mapped((k, mapper(k, v)) for k, v in self)
+
+    def __len__(self):
+        if self._store.root is None and self._filter == (None,)*len(self._filter):
+            return len(self._store.flat)
+        return PrefixTrie.__len__(self)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, PrefixTrie) or self._filter != other._filter:
+            return False
+        if type(other) is FlatTrie and self._store.root is None and other._store.root is None and \
+           self._filter == (None,)*len(self._filter):
+            return self._store.flat == other._store.flat
+        return _same_known_len(self, other) and dict(self.items()) == dict(other.items())
+
+
+def _zip_flat(fa, fb):
+    # zip of two unfiltered flat tries
+    for key, a in fa.items():
+        yield key, a, fb.get(key)
+    for key, b in fb.items():
+        if key not in fa:
+            yield key, None, b
+
+
+def zip_tries(Ta, Tb, changed_only=False):
     # construct an iterator over both of the elements in the trie with their
     # assocated values.  If one of the tries does not match a particular value,
     # then we are going just return None for that value while still iterating the other trie
     #
     # this should respect the filters of the two tries
+    #
+    # with changed_only, only the keys where the values are different are
+    # returned, and subtrees which are shared between the tries (the same
+    # object) are skipped without looking at them.
+    #
+    # The nested dicts are walked with an explicit stack rather than
+    # recursion, and the key tuple is only constructed for the keys that are
+    # returned.
 
     assert len(Ta._filter) == len(Tb._filter)
 
+    if Ta._root is None or Tb._root is None:
+        # one of these is a ColumnarTrie or a FlatTrie
+        if (type(Ta) is FlatTrie and type(Tb) is FlatTrie and Ta._root is None and Tb._root is None and
+            Ta._filter == Tb._filter == (None,)*len(Ta._filter)):
+            it = _zip_flat(Ta._store.flat, Tb._store.flat)
+        else:
+            it = _zip_tries_items(Ta, Tb)
+        if changed_only:
+            it = ((key, a, b) for key, a, b in it if a is not b and a != b)
+        yield from it
+        return
+
     fa = Ta._filter
     fb = Tb._filter
+    nargs = len(fa)
 
-    def r(a, b, prefix):
-        nonlocal fa, fb
+    path = [None]*nargs
+    stack = [(0, None, Ta._root, Tb._root)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        depth, k, a, b = pop()
+        if depth:
+            path[depth-1] = k
         if a is None and b is None:
-            return
-        elif len(fa) == len(prefix):
-            yield prefix, a, b
-        elif a is None:
-            bz = fb[len(prefix)]
-            if bz is None:
-                for k, v in b.items():
-                    yield from r(None, v, prefix+(k,))
-            else:
-                if None in b:
-                    yield from r(None, b[None], prefix+(None,))
-                w = b.get(bz)
-                if w is not None:
-                    yield from r(None, w, prefix+(bz,))
-            return
-        elif b is None:
-            az = fa[len(prefix)]
-            if az is None:
-                for k,v in a.items():
-                    yield from r(v, None, prefix+(k,))
-            else:
-                if None in a:
-                    yield from r(a[None], None, prefix+(None,))
-                w = a.get(az)
-                if w is not None:
-                    yield from r(w, None, prefix+(az,))
-            return
-        else:
-            az = fa[len(prefix)]
-            bz = fb[len(prefix)]
+            continue
+        if changed_only and a is b:
+            continue
+        if depth == nargs:
+            if changed_only and a == b:
+                continue
+            yield tuple(path), a, b
+            continue
+        depth += 1
+        # pushed in reverse so that the keys come out in the order of the dicts
+        for k, ca, cb in reversed(_zip_level(a, b, fa[depth-1], fb[depth-1])):
+            push((depth, k, ca, cb))
 
-            if az is None and bz is None:
-                for k, v in a.items():
-                    yield from r(v, b.get(k), prefix+(k,))
-                for k, v in b.items():
-                    if k not in a:
-                        yield from r(None, v, prefix+(k,))
-            elif az == bz:
-                if None in a:
-                    if None in b:
-                        yield from r(a[None], b[None], prefix+(None,))
-                    else:
-                        yield from r(a[None], None, prefix+(None,))
-                elif None in b:
-                    yield from r(None, b[None], prefix+(None,))
-                yield r(a.get(az), b.get(bz), prefix+(az,))
-            else:
-                if az is None:
-                    yield from r(a.get(bz), b.get(bz), prefix+(bz,))
-                    for k, v in a.items():
-                        if k != bz:
-                            yield from r(v, None, prefix+(k,))
-
-                elif bz is None:
-                    yield from r(a.get(az), b.get(az), prefix+(az,))
-                    for k,v in b.items():
-                        if k != az:
-                            yield from r(None, v, prefix+(k,))
-                else:
-                    yield from r(a.get(az), None, prefix+(az,))
-                    yield from r(None, b.get(bz), prefix+(bz,))
 
-                    #assert False  # this will have to handle different filters,
-                              # where we are going to get keys from one of the
-                              # maps but not the others.  idk if that would
-                              # actually be used?
+def _zip_level(a, b, az, bz):
+    # the (key, a child, b child) at a single level of the nested dicts, given
+    # the filters az and bz for this level
+    if a is None:
+        if bz is None:
+            return list((k, None, v) for k, v in b.items())
+        r = []
+        if None in b:
+            r.append((None, None, b[None]))
+        w = b.get(bz)
+        if w is not None:
+            r.append((bz, None, w))
+        return r
+    elif b is None:
+        if az is None:
+            return list((k, v, None) for k, v in a.items())
+        r = []
+        if None in a:
+            r.append((None, a[None], None))
+        w = a.get(az)
+        if w is not None:
+            r.append((az, w, None))
+        return r
+    elif az is None and bz is None:
+        r = [(k, v, b.get(k)) for k, v in a.items()]
+        r.extend((k, None, v) for k, v in b.items() if k not in a)
+        return r
+    elif az == bz:
+        r = []
+        if None in a or None in b:
+            r.append((None, a.get(None), b.get(None)))
+        r.append((az, a.get(az), b.get(bz)))
+        return r
+    elif az is None:
+        r = [(bz, a.get(bz), b.get(bz))]
+        r.extend((k, v, None) for k, v in a.items() if k != bz)
+        return r
+    elif bz is None:
+        r = [(az, a.get(az), b.get(az))]
+        r.extend((k, None, v) for k, v in b.items() if k != az)
+        return r
+    else:
+        # different filters, where we are going to get keys from one of the
+        # maps but not the others.  idk if that would actually be used?
+        return [(az, a.get(az), None), (bz, None, b.get(bz))]
+
+
+def _matches_filter(f, key):
+    # the same as the iteration of the trie, a None in the key matches anything
+    return all(a is None or b is None or a == b for a, b in zip(f, key))
+
 
-    yield from r(Ta._root, Tb._root, ())
+def _zip_tries_items(Ta, Tb):
+    # zip of tries that are not backed by nested dicts
+    seen = set()
+    for key, a in Ta.items():
+        b = Tb.get(key) if _matches_filter(Tb._filter, key) else None
+        seen.add(key)
+        yield key, a, b
+    for key, b in Tb.items():
+        if key not in seen:
+            a = Ta.get(key) if _matches_filter(Ta._filter, key) else None
+            yield key, a, b
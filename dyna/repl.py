@@ -249,10 +249,31 @@ class REPL:
     def do_memoize_unk(self, q):
         """Memoize a term using a unknown default
         Term identified as `name/arity`, eg: `fib/1`
+        The size of the table can be bounded with `max=` and the entries which
+        are evicted selected with `evict=lru` or `evict=lfu`, eg: `fib/1 max=100000`
+        """
+        term, *options = q.split()
+        name, arity = term.split('/')
+        arity = int(arity)
+        kwargs = {}
+        for opt in options:
+            k, v = opt.split('=')
+            if k == 'max':
+                kwargs['max_entries'] = int(v)
+            elif k == 'evict':
+                kwargs['eviction'] = v
+            else:
+                raise ValueError(f'Unknown option {k} for memoize_unk')
+        dyna_system.memoize_term((name, arity), kind='unk', **kwargs)
+
+    def do_memo_stats(self, q):
+        """Print the hits, misses and evictions of the memo tables for a term
+        Term identified as `name/arity`, eg: `fib/1`
         """
         name, arity = q.split('/')
         arity = int(arity)
-        dyna_system.memoize_term((name, arity), kind='unk')
+        for k, v in dyna_system.memo_counters((name, arity)).items():
+            print(f'{k}: {v}')
 
     def do_memoize_del(self, q):
         """Delete a memo table
@@ -128,6 +128,8 @@ class BuildStructure(RBaseType):
     Build something like X=&foo(Y).
     """
 
+    _simplify_deterministic = True
+
     def __init__(self, name :str, result :Variable, arguments :List[Variable]):
         super().__init__()
         self.name = name
@@ -148,6 +150,15 @@ class BuildStructure(RBaseType):
     def _tuple_rep(self):
         return self.__class__.__name__, self.name, self.result, self.arguments
 
+    def __eq__(self, other):
+        return super().__eq__(other) and self.name == other.name
+
+    def __hash__(self):
+        return super().__hash__()
+
+    def _intern_key(self):
+        return BuildStructure, self.name, intern_var_key(self.result), intern_vars_key(self.arguments)
+
 
 @simplify.define(BuildStructure)
 def simplify_buildStructure(self, frame):
@@ -266,6 +277,8 @@ class ReflectStructure(RBaseType):
     But having the length as an additional variable is not necessary in the case that
     """
 
+    _simplify_deterministic = True
+
     def __init__(self, result: Variable, name :Variable, num_args :Variable, args_list :Variable):
         super().__init__()
         self.result = result  # the resulting variable that we are trying to reflect
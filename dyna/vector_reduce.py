@@ -0,0 +1,155 @@
+# Combine the values of an aggregator in chunks with numpy
+#
+# The interpreter (simplify_aggregator) and the compiler (aggregator_add)
+# otherwise call the aggregator's combine once for every value of the body.
+# For the aggregators which set a `vector_op` (`+=`, `*=`, `max=` and `min=`),
+# the values are instead collected into a list, and each chunk which is all
+# ints or all floats is reduced with numpy.  The result is required to be the
+# same (bit for bit) as combining the values one at a time from left to right:
+#
+#   * ints are reduced in int64 only if the result can not overflow, and are
+#     then combined with the python int of the previous chunks
+#   * floats are summed/multiplied with `accumulate`, which is sequential
+#     (`np.add.reduce` uses pairwise summation, which rounds differently)
+#   * max/min use argmax/argmin to find the first of the largest values, which
+#     is the same value that folding with python's max/min returns.  Chunks with
+#     a NaN are not vectorized as the comparisons are not ordered
+#
+# Anything else (Terms, bools, mixed ints and floats, small chunks) is combined
+# with the aggregator as before.
+
+import numpy as np
+
+CHUNK_SIZE = 4096
+MIN_VECTOR_SIZE = 16  # smaller chunks are faster to combine without numpy
+
+_INT64_MAX = 2**63 - 1
+
+
+class ChunkedReducer:
+    __slots__ = ('aggregator', 'value', 'chunk', 'chunk_size')
+
+    def __init__(self, aggregator, chunk_size=CHUNK_SIZE):
+        assert aggregator.vector_op in _REDUCERS
+        self.aggregator = aggregator
+        self.value = None  # the combination of the chunks which have been reduced
+        self.chunk = []
+        self.chunk_size = chunk_size
+
+    def add(self, value, mul=1):
+        if mul == 1:
+            chunk = self.chunk
+            chunk.append(value)
+            if len(chunk) >= self.chunk_size:
+                self._flush()
+        else:
+            self._flush()
+            if self.value is None:
+                self.value = value
+                mul -= 1
+            if mul > 0:
+                self.value = self.aggregator.combine_multiplicity(self.value, value, mul)
+
+    def result(self):
+        # the combined value, or None if nothing was added
+        self._flush()
+        return self.value
+
+    def _flush(self):
+        chunk = self.chunk
+        if not chunk:
+            return
+        self.chunk = []
+        if len(chunk) < MIN_VECTOR_SIZE or not _REDUCERS[self.aggregator.vector_op](self, chunk):
+            self._fold(chunk)
+
+    def _fold(self, chunk):
+        combine = self.aggregator.combine
+        it = iter(chunk)
+        acc = self.value
+        if acc is None:
+            acc = next(it)
+        for v in it:
+            acc = combine(acc, v)
+        self.value = acc
+
+
+def _numeric_array(chunk):
+    # returns the chunk as an int64 or float64 array, or None if the values are
+    # not all ints or all floats
+    types = set(map(type, chunk))
+    if len(types) != 1:
+        return None
+    t = types.pop()
+    if t is float:
+        return np.array(chunk, dtype=np.float64)
+    if t is int:
+        try:
+            return np.array(chunk, dtype=np.int64)
+        except OverflowError:
+            return None
+    return None
+
+
+def _reduce_add(self, chunk):
+    arr = _numeric_array(chunk)
+    if arr is None:
+        return False
+    if arr.dtype == np.int64:
+        # combining a float with the ints one at a time rounds after each of them
+        if self.value is not None and type(self.value) is not int:
+            return False
+        if max(-int(arr.min()), int(arr.max())) * len(arr) > _INT64_MAX:
+            return False
+        s = int(np.add.reduce(arr))
+        self.value = s if self.value is None else self.aggregator.combine(self.value, s)
+        return True
+    if self.value is not None:
+        if type(self.value) is not float:
+            return False
+        arr = np.concatenate(([self.value], arr))
+    with np.errstate(all='ignore'):
+        self.value = float(np.add.accumulate(arr)[-1])
+    return True
+
+
+def _reduce_mul(self, chunk):
+    arr = _numeric_array(chunk)
+    if arr is None:
+        return False
+    if arr.dtype == np.int64:
+        if self.value is not None and type(self.value) is not int:
+            return False
+        with np.errstate(all='ignore'):
+            bound = np.multiply.reduce(np.abs(arr.astype(np.float64)))
+        if not bound < 2.0**62:  # leaves room for the rounding of the float product
+            return False
+        s = int(np.multiply.reduce(arr))
+        self.value = s if self.value is None else self.aggregator.combine(self.value, s)
+        return True
+    if self.value is not None:
+        if type(self.value) is not float:
+            return False
+        arr = np.concatenate(([self.value], arr))
+    with np.errstate(all='ignore'):
+        self.value = float(np.multiply.accumulate(arr)[-1])
+    return True
+
+
+def _selective(arg):
+    def reduce(self, chunk):
+        arr = _numeric_array(chunk)
+        if arr is None or (arr.dtype == np.float64 and np.isnan(arr).any()):
+            return False
+        v = chunk[int(arg(arr))]  # the python value, so the type is kept
+        self.value = v if self.value is None else self.aggregator.combine(self.value, v)
+        return True
+    return reduce
+
+
+_REDUCERS = {
+    'add': _reduce_add,
+    'multiply': _reduce_mul,
+    'max': _selective(np.argmax),
+    'min': _selective(np.argmin),
+}
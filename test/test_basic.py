@@ -326,6 +326,76 @@ def test_fib_unk_memos():
 
 
 
+@pytest.mark.parametrize('eviction', ['lru', 'lfu'])
+def test_fib_unk_memos_bounded(eviction):
+    dyna_system.delete_term('fib', 1)
+    dyna_system.define_term('fib', 1, fib)
+    dyna_system.memoize_term(('fib', 1), kind='unk', max_entries=5, eviction=eviction)
+
+    fib_call = dyna_system.call_term('fib', 1)
+
+    def run(n):
+        frame = Frame()
+        frame[0] = n
+        rr = saturate(fib_call, frame)
+        assert rr == Terminal(1)
+        return interpreter.ret_variable.getValue(frame)
+
+    assert run(20) == 6765
+    counters = dyna_system.memo_counters(('fib', 1))
+    assert counters['entries'] == 5
+    assert counters['evictions'] > 0
+
+    # the evicted entries are recomputed when they are read again
+    assert run(20) == 6765
+    assert run(3) == 2
+    assert dyna_system.memo_counters(('fib', 1))['hits'] > counters['hits']
+
+    dyna_system.memoize_term(('fib', 1), kind='none')
+
+
+def test_memo_eviction_policies():
+    from dyna.memos import LRUEviction, LFUEviction
+    lru = LRUEviction()
+    lfu = LFUEviction()
+    for p in (lru, lfu):
+        for k in 'abc':
+            p.add(k)
+        p.touch('a')
+        p.touch('a')
+        p.touch('c')
+    assert [lru.victim(), lru.victim(), lru.victim()] == ['b', 'a', 'c']
+    assert [lfu.victim(), lfu.victim(), lfu.victim()] == ['b', 'c', 'a']
+
+    # storing a key which is already in a full table does not evict anything
+    from dyna.context import SystemContext
+    system = SystemContext()
+    system.add_rules('ev_sq(X) = X * X.')
+    system.memoize_term(('ev_sq', 1), kind='unk', max_entries=3)
+    for i in range(3):
+        frame = Frame()
+        frame[0] = i
+        assert saturate(system.call_term('ev_sq', 1), frame) == Terminal(1)
+    table = system.memo_containers(('ev_sq', 1))[0]
+    table._store_entry((1, None), table.memos._children.get((1, None)))
+    counters = system.memo_counters(('ev_sq', 1))
+    assert counters['entries'] == 3 and counters['evictions'] == 0
+
+
+def test_unk_memo_partition_bounded():
+    # the reads of DynaAPI.table are a partition (without an aggregator), which
+    # is memoized through the Partition branch of rewrite_to_memoize
+    from dyna.api import DynaAPI
+    api = DynaAPI()
+    t = api.table('unk_partition', 1, max_entries=2)
+    for i in range(5):
+        t[i] = i * 10
+    reads = api.make_call('unk_partition/1')
+    assert [reads[i] for i in range(5)] == [0, 10, 20, 30, 40]
+    counters = api.memo_counters('unk_partition', 1)
+    assert counters['entries'] <= 2 and counters['evictions'] > 0
+
+
 def test_fib_null_memos():
     dyna_system.delete_term('fib', 1)
 
@@ -1043,6 +1113,23 @@ def test_watching_terms():
     assert counter == 1
 
 
+def test_load_after_gc(tmp_path):
+    # the memo table that watches $load is only referenced weakly by the
+    # assumptions, so it has to be kept alive by the system
+    import gc
+    from dyna.context import SystemContext
+    system = SystemContext()
+    gc.collect()
+    f = tmp_path / 'loaded.dyna'
+    f.write_text('loaded_after_gc(1) = 7.\n')
+    system.add_rules(f'$load("{f}").')
+    system.run_agenda()
+    frame = Frame()
+    frame[0] = 1
+    assert saturate(system.call_term('loaded_after_gc', 1), frame) == Terminal(1)
+    assert interpreter.ret_variable.getValue(frame) == 7
+
+
 def test_memo_defaults():
     from dyna.syntax.normalizer import add_rules
 
@@ -1102,3 +1189,933 @@ def test_type_information_passing():
     frame = Frame()
     rr = saturate(z, frame)
     assert rr == Terminal(0)
+
+
+@pytest.mark.parametrize('policy', ['fifo', 'lifo', 'selective', lambda task: 0])
+def test_agenda_policies(policy):
+    from dyna.context import SystemContext
+    system = SystemContext(agenda_policy=policy)
+    system.add_rules("""
+    edge(1,2) = 7. edge(1,3) = 9. edge(1,6) = 14. edge(2,3) = 10. edge(2,4) = 15.
+    edge(3,4) = 11. edge(3,6) = 2. edge(4,5) = 6. edge(5,6) = 9. edge(6,5) = 9.
+    path(1) min= 0.
+    path(Y) min= path(X) + edge(X, Y).
+    """)
+    system.agenda.reset_counters()
+    system.memoize_term(('path', 1), 'null')
+    system.run_agenda()
+
+    counters = system.agenda.counters()
+    assert counters['pops'] > 0 and counters['pending'] == 0
+
+    for node, dist in [(1, 0), (2, 7), (3, 9), (4, 20), (5, 20), (6, 11)]:
+        frame = Frame()
+        frame[0] = node
+        rr = saturate(system.call_term('path', 1), frame)
+        assert rr == Terminal(1)
+        assert interpreter.ret_variable.getValue(frame) == dist
+
+
+def test_parallel_agenda():
+    from dyna.context import SystemContext
+    program = """
+    edge(1,2) = 7. edge(1,3) = 9. edge(1,6) = 14. edge(2,3) = 10. edge(2,4) = 15.
+    edge(3,4) = 11. edge(3,6) = 2. edge(4,5) = 6. edge(5,6) = 9. edge(6,5) = 9.
+    path(1) min= 0.
+    path(Y) min= path(X) + edge(X, Y).
+    hops(1) min= 0.
+    hops(Y) min= hops(X) + 1 for edge(X, Y) > 0.
+    cost(X) += path(X) * 2.
+    """
+
+    def run(parallel):
+        system = SystemContext(parallel_agenda=parallel)
+        system.add_rules(program)
+        for name in ('path', 'hops', 'cost'):
+            system.memoize_term((name, 1), 'null')
+        system.run_agenda()
+        system.add_rules('edge(1,4) = 3.')
+        system.run_agenda()
+        values = {}
+        for name in ('path', 'hops', 'cost'):
+            for node in range(1, 7):
+                frame = Frame()
+                frame[0] = node
+                rr = saturate(system.call_term(name, 1), frame)
+                assert rr == Terminal(1)
+                values[(name, node)] = interpreter.ret_variable.getValue(frame)
+        return system, values
+
+    _, serial = run(None)
+    system, parallel = run(2)
+    assert system.agenda.parallel
+    assert system.agenda.counters()['parallel_tasks'] > 0
+    assert parallel == serial
+    assert serial[('path', 4)] == 3 and serial[('hops', 5)] == 2 and serial[('cost', 5)] == 18
+
+    # the same program gives the same result regardless of the scheduling of the threads
+    assert run(4)[1] == serial
+
+
+def test_parallel_agenda_shared_index():
+    # the tables read the same memo table with a filter that builds a secondary
+    # index, which the threads must not see while it is being built
+    from dyna.context import SystemContext
+    program = "src(I, J) += I + J for range(I, 0, 3000), range(J, 0, 12).\n" + \
+        ''.join(f"c_{j} += src(I, {j}).\n" for j in range(12))
+
+    def run(parallel):
+        system = SystemContext(parallel_agenda=parallel)
+        system.add_rules(program)
+        system.memoize_term(('src', 2), 'null')
+        for j in range(12):
+            system.memoize_term((f'c_{j}', 0), 'null')
+        system.run_agenda()
+        values = []
+        for j in range(12):
+            frame = Frame()
+            assert saturate(system.call_term(f'c_{j}', 0), frame) == Terminal(1)
+            values.append(interpreter.ret_variable.getValue(frame))
+        return values
+
+    assert run(8) == [sum(range(3000)) + 3000*j for j in range(12)]
+
+def test_agenda_batches_messages():
+    from dyna.context import SystemContext
+    system = SystemContext()
+    system.add_rules("bulk_e(0) = 0. bulk_total += bulk_e(X).")
+    system.memoize_term(('bulk_e', 1), 'null')
+    system.memoize_term(('bulk_total', 0), 'null')
+    system.run_agenda()
+
+    system.agenda.reset_counters()
+    system.add_rules(' '.join(f'bulk_e({i}) = {i}.' for i in range(1, 100)))
+    system.run_agenda()
+
+    # the changes to bulk_e are all merged into a single refresh of bulk_total
+    counters = system.agenda.counters()
+    assert counters['batched_pushes'] == 98
+    assert counters['pops'] == 2
+
+    frame = Frame()
+    rr = saturate(system.call_term('bulk_total', 0), frame)
+    assert rr == Terminal(1)
+    assert interpreter.ret_variable.getValue(frame) == 4950
+
+
+def test_coalesce_keys():
+    from dyna.memos import coalesce_keys, generalize_keys, AgendaMessage
+    msgs = [AgendaMessage(table=None, key=k) for k in [(1, 2), (1, None), (3, 4), (1, 2), (3, 5)]]
+    assert list(coalesce_keys(msgs)) == [(1, None), (3, 4), (3, 5)]
+    assert generalize_keys([(3, 4), (3, 5)]) == (3, None)
+
+    # the priority is not part of the message, so refreshing the same key is only done once
+    a, b = AgendaMessage(table=None, key=(1, 2), priority=2), AgendaMessage(table=None, key=(1, 2), priority=3)
+    assert a == b and hash(a) == hash(b) and len({a, b}) == 1
+    assert a != AgendaMessage(table=None, key=(1, 3), priority=2)
+
+
+def test_frame_trail():
+    frame = Frame()
+    a, b = VariableId('a'), VariableId('b')
+    a.setValue(frame, 1)
+
+    mark = frame.mark()
+    b.setValue(frame, 2)
+    a._unset(frame)
+    b.setType(frame, 'int')
+    assert not a.isBound(frame) and b.getValue(frame) == 2
+    frame.release(mark)
+
+    assert a.getValue(frame) == 1 and not b.isBound(frame)
+    assert b.getType(frame) is None
+    assert frame._trail is None
+
+    # the loop binds the variables in place, so the frame is not copied for each binding
+    copies = 0
+    class CountingFrame(Frame):
+        def __init__(self, f=None):
+            nonlocal copies
+            if f is not None:
+                copies += 1
+            super().__init__(f)
+
+    values = []
+    def cb(R, f):
+        values.append(b.getValue(f))
+
+    frame = CountingFrame()
+    loop(Partition((b,), [Unify(b, constant(i)) for i in range(5)]), frame, cb)
+    assert sorted(values) == list(range(5))
+    assert copies == 0
+    assert not b.isBound(frame)
+
+
+def test_compiler_python_codegen():
+    from dyna.guards import Assumption
+
+    # f(X, Y) += Z for Z:X..Y.
+    srange = Aggregator(interpreter.ret_variable, variables_named(0,1), VariableId('RR'), AggregatorOpImpl(lambda a,b:a+b),
+                        dyna_system.call_term('range', 3)(VariableId('RR'), 0, 1))
+
+    dyna_system.define_term('comp_range_codegen', 2, srange)
+    dyna_system._optimize_term(('comp_range_codegen', 2))
+    dyna_system._compile_term(('comp_range_codegen', 2), set(variables_named(0,1)))
+
+    ce = dyna_system.terms_as_compiled[('comp_range_codegen', 2)]
+    (mode, instance), = ce.compiled_expressions.items()
+
+    assumption = Assumption('test codegen')
+    instance.collected_assumptions.add(assumption)
+
+    assert instance.generate_python()
+    assert 'for ' in instance.python_source
+
+    def run(a, b):
+        frame = Frame()
+        r = simplify(dyna_system.call_term('comp_range_codegen', 2), frame)
+        frame[0] = a
+        frame[1] = b
+        rr = simplify(r, frame)
+        assert rr == Terminal(1)
+        return interpreter.ret_variable.getValue(frame)
+
+    assert run(3, 7) == sum(range(3, 7))
+    assert run(0, 100) == sum(range(0, 100))
+
+    # once an assumption that the compiled code depended on is invalidated, this goes back to the operations interpreter
+    assumption.invalidate()
+    assert instance._python_function is None
+    assert not instance.generate_python()
+    assert run(3, 7) == sum(range(3, 7))
+
+
+def test_columnar_memos():
+    from dyna.prefix_trie import ColumnarTrie, PrefixTrie
+    from dyna.memos import RMemo
+
+    t = ColumnarTrie(2, 'u')
+    for i in range(10):
+        t[(i % 3, float(i))] = ['u']
+    t[(0, 0.0)] = ['u']
+    assert t.is_columnar and len(t) == 10
+    assert t.get((1, 4.0)) == ['u'] and t.get((1, 5.0)) is None
+    assert sorted(k for k, v in t.filter_raw((2, None))) == [(2, 2.0), (2, 5.0), (2, 8.0)]
+    assert list(t.column_values(0, (None, 3.0))) == [0]
+    t.filter_raw((None, 4.0)).delete_all()
+    del t[(0, 0.0)]
+    assert len(t) == 8 and t.get((1, 4.0)) is None
+
+    # storing something that does not fit into the columns converts it into a prefix trie
+    other = PrefixTrie(2)
+    for k, v in t:
+        other[k] = v
+    t[(5, None)] = ['v']
+    assert not t.is_columnar
+    assert t.get((5, None)) == ['v']
+    del t[(5, None)]
+    assert t == other
+
+    from dyna.context import SystemContext
+    system = SystemContext()
+    system.add_rules("col_e(0) = 0. col_total += col_e(X).")
+    system.memoize_term(('col_e', 1), 'null')
+    system.memoize_term(('col_total', 0), 'null')
+    system.add_rules(' '.join(f'col_e({i}) = {i}.' for i in range(1, 50)))
+    system.run_agenda()
+
+    memos, = [c.memos for c in system.terms_as_memoized[('col_e', 1)].all_children() if isinstance(c, RMemo)]
+    assert memos.memos._children.is_columnar
+    assert len(memos.memos._children) == 50
+
+    frame = Frame()
+    rr = saturate(system.call_term('col_total', 0), frame)
+    assert rr == Terminal(1)
+    assert interpreter.ret_variable.getValue(frame) == sum(range(50))
+
+
+def test_memo_snapshot(tmp_path):
+    from dyna.context import SystemContext
+    path = str(tmp_path / 'memos.snapshot')
+
+    def make_system(extra=''):
+        system = SystemContext()
+        system.add_rules("""
+        snap_e(X) = X*3 for range(X, 0, 20).
+        snap_sq(X) = snap_e(X) * 2.
+        snap_total += snap_e(X).
+        """ + extra)
+        for name in [('snap_e', 1), ('snap_sq', 1), ('snap_total', 0)]:
+            system.memoize_term(name, 'null')
+        return system
+
+    def query(system, name, *args):
+        frame = Frame()
+        for i, a in enumerate(args):
+            frame[i] = a
+        rr = saturate(system.call_term(name, len(args)), frame)
+        assert rr == Terminal(1)
+        return interpreter.ret_variable.getValue(frame)
+
+    system = make_system()
+    assert system.save_memo_snapshot(path) == [('snap_e', 1), ('snap_sq', 1), ('snap_total', 0)]
+
+    system = make_system()
+    assert len(system.load_memo_snapshot(path)) == 3
+    system.run_agenda()
+    assert query(system, 'snap_sq', 7) == 42
+
+    # only the rows which were read are loaded
+    table, = system.memo_containers(('snap_sq', 1))
+    assert table._snapshot is not None and table._snapshot_faulted == {7}
+    assert len(table.memos._children) == 20 and table._snapshot is None
+    assert query(system, 'snap_total') == 3 * sum(range(20))
+
+    # the snapshot is rejected if the program changes
+    system = make_system('snap_e(100) = 1.')
+    assert system.load_memo_snapshot(path) is None
+    system.run_agenda()
+    assert query(system, 'snap_total') == 3 * sum(range(20)) + 1
+
+
+def test_memo_delta_propagation():
+    from dyna.context import SystemContext
+    system = SystemContext()
+    system.add_rules(' '.join(f'delta_e({i}) += {i}.' for i in range(10)) + """
+    delta_w(X) = 3 for range(X, 0, 10).
+    delta_g(X) += delta_e(X) * delta_w(X).
+    delta_total += delta_g(X).
+    delta_max max= delta_g(X).
+    delta_sq += delta_e(X) * delta_e(X).
+    """)
+    names = [('delta_e', 1), ('delta_w', 1), ('delta_g', 1), ('delta_total', 0), ('delta_max', 0), ('delta_sq', 0)]
+    for name in names:
+        system.memoize_term(name, 'null')
+    system.run_agenda()
+
+    values = list(range(10))
+    for i in [3, 7, 3, 0]:
+        values[i] += 5
+        system.add_rules(f'delta_e({i}) += 5.')
+        system.run_agenda()
+
+    def query(name):
+        frame = Frame()
+        assert saturate(system.call_term(name, 0), frame) == Terminal(1)
+        return interpreter.ret_variable.getValue(frame)
+
+    assert query('delta_total') == sum(3*v for v in values)
+    assert query('delta_max') == max(3*v for v in values)
+    assert query('delta_sq') == sum(v*v for v in values)
+
+    counts = {name: system.memo_containers(name)[0].delta_count for name in names}
+    # += over a linear body uses deltas, max= is not invertible and delta_sq reads delta_e twice, so those are refreshed
+    assert counts[('delta_g', 1)] == 4 and counts[('delta_total', 0)] == 4
+    assert counts[('delta_max', 0)] == 0 and counts[('delta_sq', 0)] == 0
+
+
+def test_memo_delta_duplicate_rows():
+    # adding two edges at once gives the same delta row for deg(1), which must
+    # be counted twice
+    from dyna.context import SystemContext
+    system = SystemContext()
+    system.add_rules("""
+    e(1,2). e(1,3).
+    deg(X) += 1 for e(X, Y).
+    deg_one = deg(1).
+    """)
+    system.memoize_term(('e', 2), 'null')
+    system.memoize_term(('deg', 1), 'null')
+    system.run_agenda()
+    system.add_rules('e(1,4). e(1,5).')
+    system.run_agenda()
+
+    frame = Frame()
+    assert saturate(system.call_term('deg_one', 0), frame) == Terminal(1)
+    assert interpreter.ret_variable.getValue(frame) == 4
+
+
+def test_trie_secondary_indexes():
+    from dyna.prefix_trie import ColumnarTrie, PrefixTrie
+
+    def brute(keys, key):
+        return sorted((k for k in keys if all(a is None or b is None or a == b for a, b in zip(key, k))), key=repr)
+
+    for t in (PrefixTrie(3), ColumnarTrie(3, 'u')):
+        keys = set()
+        def put(k):
+            t[k] = ['u']
+            keys.add(k)
+        for i in range(30):
+            put((i % 4, i % 7, i))
+
+        for key in [(None, 3, None), (None, 3, None), (None, None, 10), (2, None, 10), (None, 2, 9)]*2:
+            assert sorted(t.filter_raw(key).keys(), key=repr) == brute(keys, key)
+        positions = t._indexes.keys()
+        assert (1,) in positions and (2,) in positions
+
+        # the indexes are kept up to date
+        put((9, 3, 100))
+        del t[(3, 3, 3)]; keys.discard((3, 3, 3))
+        t.filter_raw((None, None, 10)).delete_all(); keys.discard((2, 3, 10))
+        for key in [(None, 3, None), (None, None, 100), (None, None, 10), (2, None, 10), (None, 2, 9)]:
+            assert sorted(t.filter_raw(key).keys(), key=repr) == brute(keys, key)
+
+        # keys with a wildcard, which converts the columnar trie into a prefix trie
+        put((5, None, 7))
+        for key in [(None, 3, 7), (None, 3, 7), (None, 4, None)]:
+            assert sorted(t.filter_raw(key).keys(), key=repr) == brute(keys, key)
+
+    from dyna.context import SystemContext
+    from dyna.memos import RMemo
+    system = SystemContext()
+    system.add_rules(' '.join(f'idx_edge({i}, {i % 5}).' for i in range(40)))
+    system.memoize_term(('idx_edge', 2), 'null')
+    system.add_rules("idx_into(Y) += 1 for idx_edge(X, Y).")
+    system.run_agenda()
+
+    for _ in range(3):
+        for y in range(5):
+            frame = Frame()
+            frame[1] = y
+            rr = saturate(system.call_term('idx_edge', 2), frame)
+            assert rr != Terminal(0)
+    table, = [c.memos for c in system.terms_as_memoized[('idx_edge', 2)].all_children() if isinstance(c, RMemo)]
+    assert (1,) in table.memos._children._indexes
+
+
+def test_flat_trie():
+    from dyna.prefix_trie import FlatTrie, PrefixTrie, zip_tries
+
+    t = FlatTrie(2)
+    p = PrefixTrie(2)
+    for i in range(20):
+        t[(i % 4, i)] = [i]
+        p[(i % 4, i)] = [i]
+    assert t.is_flat and len(t) == 20 and t == p and p == t
+    assert t.get((1, 5)) == [5] and t.get((1, 6)) is None
+    assert sorted(t.filter_raw((2, None)).keys()) == sorted(p.filter_raw((2, None)).keys())
+    assert list(t.filter_raw((3, 7)).items()) == [((3, 7), [7])]
+    assert t.map_values(lambda v: v * 2).get((3, 7)) == [7, 7]
+
+    u = t.filter_raw((None, None)).map_values(list)
+    u[(0, 0)] = ['changed']
+    del u[(1, 1)]
+    assert sorted((k, a, b) for k, a, b in zip_tries(t, u) if a != b) == [((0, 0), [0], ['changed']), ((1, 1), [1], None)]
+
+    t.filter_raw((2, None)).delete_all()
+    del t[(3, 3)]
+    assert len(t) == 14 and t.get((2, 6)) is None
+
+    # a key with a wildcard converts it into nested dicts
+    view = t.filter_raw((None, None))
+    t[(None, 100)] = ['w']
+    assert not view.is_flat and view.get((None, 100)) == ['w']
+    assert sorted(k for k, _ in t.filter_raw((1, 100))) == [(None, 100)]
+    assert len(t) == 15
+
+
+def test_zip_tries_iterative():
+    from dyna.prefix_trie import PrefixTrie, zip_tries
+
+    a = PrefixTrie(3)
+    b = PrefixTrie(3)
+    for i in range(50):
+        a[(i % 3, i % 5, i)] = [i]
+        if i % 7:
+            b[(i % 3, i % 5, i)] = [i] if i % 4 else [-i]
+    b[(1, None, 100)] = ['w']
+
+    def brute(fa, fb):
+        ta, tb = dict(a.filter_raw(fa)), dict(b.filter_raw(fb))
+        return sorted(((k, ta.get(k), tb.get(k)) for k in set(ta) | set(tb)), key=repr)
+
+    for fa, fb in [((None,)*3, (None,)*3), ((1, None, None), (1, None, None)), ((None, 2, None), (None, None, None))]:
+        r = list(zip_tries(a.filter_raw(fa), b.filter_raw(fb)))
+        assert sorted(r, key=repr) == brute(fa, fb)
+        changed = list(zip_tries(a.filter_raw(fa), b.filter_raw(fb), changed_only=True))
+        assert sorted(changed, key=repr) == [x for x in brute(fa, fb) if x[1] != x[2]]
+
+    # subtrees which are shared by both tries are skipped
+    c = PrefixTrie(3, _root={k: v for k, v in a._root.items()})
+    c._root[2] = {k: dict(v) for k, v in a._root[2].items()}
+    c._root[2][0][5] = ['new']
+    assert list(zip_tries(a, c, changed_only=True)) == [((2, 0, 5), [5], ['new'])]
+
+    # keys which are longer than the recursion limit
+    import sys
+    n = sys.getrecursionlimit() + 10
+    d, e = PrefixTrie(n), PrefixTrie(n)
+    d[(1,)*n] = [1]
+    e[(1,)*n] = [2]
+    assert list(zip_tries(d, e)) == [((1,)*n, [1], [2])]
+
+
+def test_hash_consing():
+    import gc
+    from dyna.interpreter import hash_consing, intern_rexpr, Intersect, intersect, unify, ConstantVariable
+    from dyna.terms import BuildStructure
+
+    a, b, c = variables_named('a', 'b', 'c')
+    def make():
+        return intersect(BuildStructure('f', a, (b,)), unify(b, c), sub(a, b, c))
+
+    pool = hash_consing()
+    try:
+        r1 = intern_rexpr(make())
+        r2 = intern_rexpr(make())
+        assert r1 is r2
+        # structures which __eq__ considers the same, but have a different name are kept separate
+        assert intern_rexpr(BuildStructure('g', a, (b,))) is not intern_rexpr(BuildStructure('f', a, (b,)))
+        # as are constants which are equal but have a different type
+        u1, u2, u3 = (intern_rexpr(unify(a, constant(v))) for v in (1, 1.0, True))
+        assert u1 is not u2 and u1 is not u3 and u2 is not u3
+        assert [type(v.getValue(None)) for v in (u2.v1, u2.v2) if isinstance(v, ConstantVariable)] == [float]
+        assert intern_rexpr(sub(a, constant(1.0), c)) is not intern_rexpr(sub(a, constant(1), c))
+        assert intern_rexpr(BuildStructure('f', a, (constant(True),))) is not intern_rexpr(BuildStructure('f', a, (constant(1),)))
+
+        # the results of simplify are interned
+        frame = Frame()
+        s1 = simplify(make(), frame)
+        s2 = simplify(make(), Frame())
+        assert s1 is s2 and s1 is r1
+
+        size = pool.stats()['size']
+        del r1, r2, s1, s2
+        gc.collect()
+        assert pool.stats()['size'] < size
+        assert pool.stats()['hits'] > 0
+    finally:
+        hash_consing(False)
+    assert intern_rexpr(make()) is not intern_rexpr(make())
+
+
+def test_simplify_cache():
+    from dyna.context import SystemContext
+    system = SystemContext()
+    system.add_rules("""
+    sc_w(X) = X * 2 for X >= 0, X < 10.
+    sc_total(N) += sc_w(X) for range(X, 0, N).
+    sc_norm(N) += sc_w(X) * sc_total(N) for range(X, 0, N).
+    sc_m(X) = X + 1 for X >= 0, X < 10.
+    sc_read(N) += sc_m(X) for range(X, 0, N).
+    sc_dbl(X) = X * 2.
+    sc_agg(X) += sc_dbl(X) for range(Y, 0, 2).
+    """)
+    system.memoize_term(('sc_m', 1), 'null')
+    system.run_agenda()
+
+    def query(name, n):
+        frame = Frame()
+        frame[0] = n
+        rr = saturate(system.call_term(name, 1), frame)
+        assert rr == Terminal(1)
+        return interpreter.ret_variable.getValue(frame)
+
+    expected = [(query('sc_norm', n), query('sc_read', n)) for n in range(1, 8)]
+
+    cache = simplify.enable_cache(max_entries=64)
+    try:
+        term = system.call_term('sc_norm', 1)
+        for _ in range(3):
+            for n in range(1, 8):
+                frame = Frame()
+                frame[0] = n
+                assert saturate(term, frame) == Terminal(1)
+                assert interpreter.ret_variable.getValue(frame) == expected[n-1][0]
+                assert query('sc_read', n) == expected[n-1][1]
+        report = cache.report()
+        # sc_total(N) is the same for each of the X in sc_norm
+        assert report['Aggregator']['hits'] > 0 and report['Aggregator']['time_saved'] > 0
+        assert all(0 <= r['hit_rate'] <= 1 for r in report.values())
+        # the reads of the memo table are never cached
+        assert sum(r['bypassed'] for r in report.values()) > 0
+        assert len(cache._entries) <= 64
+
+        # 1 and 1.0 are different keys
+        r = query('sc_agg', 1)
+        assert r == 4 and type(r) is int
+        r = query('sc_agg', 1.0)
+        assert r == 4.0 and type(r) is float
+
+        # a partition is changed in place when rules are added, so it is not cached
+        from dyna.prefix_trie import PrefixTrie
+        x, r = variables_named('sc_x', 'sc_r')
+        trie = PrefixTrie(2)
+        trie[(1, 10)] = [Terminal(1)]
+        agg = Aggregator(interpreter.ret_variable, (), r, AggregatorOpImpl(lambda a, b: a + b), interpreter.Partition((x, r), trie))
+        for rows, total in ([], 10), ([(2, 20)], 30):
+            for row in rows:
+                trie.setdefault(row, []).append(Terminal(1))
+            frame = Frame()
+            assert simplify(agg, frame) == Terminal(1)
+            assert interpreter.ret_variable.getValue(frame) == total
+    finally:
+        simplify.disable_cache()
+
+
+def test_loop_cheapest_iterator():
+    from dyna.interpreter import cheapest_partition, getPartitions, IteratorFromIterable
+    from dyna.context import SystemContext
+
+    big, rb = M.range(1, constant(0), constant(1000))
+    small, rs = M.range(1, constant(5), constant(8))
+    R = Intersect(big, small)
+    r = {rb: constant(True), rs: constant(True)}
+    R = saturate(R.rename_vars(lambda x: r.get(x, x)), Frame())
+
+    frame = Frame()
+    p = cheapest_partition(getPartitions(R, frame), frame)
+    assert isinstance(p, IteratorFromIterable) and p.estimate_cardinality(frame) == 3
+
+    vals = []
+    loop(R, frame, lambda r, f: vals.append(VariableId(1).getValue(f)), till_terminal=True)
+    assert sorted(vals) == [5, 6, 7]
+
+    # the estimates of a memo table are the number of rows
+    system = SystemContext()
+    system.add_rules("""
+    lc_big(X) = true for range(X, 0, 50).
+    lc_small(X) = true for range(X, 0, 3).
+    lc_join += 1 for lc_big(X), lc_small(X).
+    """)
+    system.memoize_term(('lc_big', 1), 'null')
+    system.memoize_term(('lc_small', 1), 'null')
+    system.run_agenda()
+    for name, size in (('lc_big', 50), ('lc_small', 3)):
+        table = system.memo_containers((name, 1))[0]
+        frame = Frame()
+        ests = [p.estimate_cardinality(frame) for p in getPartitions(table.memos, frame)]
+        assert ests and all(e == size for e in ests)
+
+    frame = Frame()
+    assert saturate(system.call_term('lc_join', 0), frame) == Terminal(1)
+    assert interpreter.ret_variable.getValue(frame) == 3
+
+
+def test_trie_join():
+    from dyna.context import SystemContext
+    edges = {(1, 2), (2, 3), (3, 1), (2, 4), (4, 5), (5, 2), (3, 4), (5, 6)}
+    expected = {(a, b, c) for a, b in edges for c in range(7) if (b, c) in edges and (c, a) in edges}
+
+    def triangles(join):
+        interpreter.join_iterators(join)
+        try:
+            system = SystemContext()
+            system.add_rules(' '.join(f'tj_e({a},{b}).' for a, b in edges))
+            system.add_rules('tj_t(X,Y,Z) |= tj_e(X,Y), tj_e(Y,Z), tj_e(Z,X).')
+            system.memoize_term(('tj_e', 2), 'null')
+            system.run_agenda()
+
+            chosen = []
+            orig = interpreter.loop_partition
+            def loop_partition(R, frame, callback, partition):
+                chosen.append(type(partition))
+                return orig(R, frame, callback, partition)
+            interpreter.loop_partition = loop_partition
+            try:
+                system.memoize_term(('tj_t', 3), 'null')
+                system.run_agenda()
+            finally:
+                interpreter.loop_partition = orig
+            table = system.memo_containers(('tj_t', 3))[0]
+            return {k[:3] for k, _ in table.memos._children}, chosen
+        finally:
+            interpreter.join_iterators(True)
+
+    res, chosen = triangles(True)
+    assert res == expected
+    # all of the variables are bound by the join in a single loop
+    assert chosen == [interpreter.TrieJoinIterator]
+
+    res, chosen = triangles(False)
+    assert res == expected
+    assert interpreter.TrieJoinIterator not in chosen and len(chosen) > 1
+
+
+def test_vector_reduce():
+    import functools, random
+    from dyna.aggregators import AGGREGATORS
+    from dyna.vector_reduce import ChunkedReducer
+
+    def fold(agg, vals):
+        return functools.reduce(agg.combine, vals)
+
+    def reduce(agg, vals, chunk_size=100):
+        r = ChunkedReducer(agg, chunk_size)
+        for v in vals:
+            r.add(v)
+        return r.result()
+
+    rng = random.Random(4)
+    floats = [rng.uniform(-1, 1) * 10**rng.randint(-12, 12) for _ in range(1000)]
+    ints = [rng.randint(-10**6, 10**6) for _ in range(1000)]
+    cases = [
+        floats, ints,
+        [2**62, 2**62, 2**62] * 10,  # overflows int64
+        [1.0 + x * 1e-9 for x in floats],
+        [0.0, -0.0] * 20 + [-0.0, 0.0] * 20,  # max/min return the first of the equal values
+        floats[:50] + ints[:50],  # mixed ints and floats are combined one at a time
+        [float('nan')] + floats[:40],
+        [Term('f', (i,)) for i in range(40)],
+    ]
+    for name in ('+=', '*=', 'max=', 'min='):
+        agg = AGGREGATORS[name]
+        for vals in cases:
+            if name in ('+=', '*=') and isinstance(vals[0], Term):
+                continue
+            expected = fold(agg, vals)
+            res = reduce(agg, vals)
+            assert type(res) is type(expected)
+            # repr to compare -0.0 and nan
+            assert repr(res) == repr(expected) if isinstance(res, float) else res == expected
+    assert reduce(AGGREGATORS['+='], []) is None
+
+    # multiplicity is the same as adding the value multiple times
+    r = ChunkedReducer(AGGREGATORS['+='], 16)
+    for v in floats[:40]:
+        r.add(v, 3)
+    assert r.result() == fold(AGGREGATORS['+='], [v for v in floats[:40] for _ in range(3)])
+
+    # through simplify_aggregator and the compiler
+    dyna_system.add_rules("""
+    vr_sum(N) += X * 0.1 for range(X, 0, N).
+    vr_max(N) max= X * 70 - X * X for range(X, 0, N).
+    """)
+    srange = Aggregator(interpreter.ret_variable, variables_named(0,1), VariableId('RR'), AGGREGATORS['+='],
+                        dyna_system.call_term('range', 3)(VariableId('RR'), 0, 1))
+    dyna_system.define_term('vr_comp_range', 2, srange)
+    dyna_system._optimize_term(('vr_comp_range', 2))
+    dyna_system._compile_term(('vr_comp_range', 2), set(variables_named(0,1)))
+    for n in (5, 3000):
+        frame = Frame()
+        frame[0] = n
+        assert saturate(dyna_system.call_term('vr_sum', 1), frame) == Terminal(1)
+        assert interpreter.ret_variable.getValue(frame) == fold(AGGREGATORS['+='], [x * 0.1 for x in range(n)])
+
+        frame = Frame()
+        frame[0] = n
+        assert saturate(dyna_system.call_term('vr_max', 1), frame) == Terminal(1)
+        assert interpreter.ret_variable.getValue(frame) == max(x * 70 - x * x for x in range(n))
+
+        frame = Frame()
+        r = simplify(dyna_system.call_term('vr_comp_range', 2), frame)
+        frame[0] = 0
+        frame[1] = n
+        assert simplify(r, frame) == Terminal(1)
+        assert interpreter.ret_variable.getValue(frame) == sum(range(n))
+
+
+def test_slot_frames():
+    from dyna.interpreter import SlotVariable, VariableId
+
+    a, b = SlotVariable(0), SlotVariable(1)
+    assert a == VariableId('$S0') and hash(a) == hash(VariableId('$S0'))
+
+    frame = SlotFrame(2)
+    a.setValue(frame, 5)
+    assert a.isBound(frame) and not b.isBound(frame)
+    mark = frame.mark()
+    b.setValue(frame, 7)
+    VariableId('x').setValue(frame, 1)
+    assert b.getValue(frame) == 7
+    frame.undo(mark)
+    assert not b.isBound(frame) and 'x' not in frame
+    assert a.getValue(frame) == 5
+    frame.release(mark)
+
+    # the values are copied to a Frame under the names of the variables
+    copy = Frame(frame)
+    assert not isinstance(copy, SlotFrame)
+    assert VariableId('$S0').getValue(copy) == 5 and not b.isBound(copy)
+
+    R = Intersect(Unify(VariableId('x'), VariableId('y')), Unify(VariableId('y'), constant(3)))
+    nR, nslots = number_variables(R, ignored=(VariableId('x'),))
+    assert nslots == 1
+    frame = SlotFrame(nslots)
+    assert saturate(nR, frame) == Terminal(1)
+    assert VariableId('x').getValue(frame) == 3
+
+    # the memo tables compute the same values
+    program = """
+    sf_edge(1, 2). sf_edge(2, 3). sf_edge(3, 4).
+    sf_path(X, Y) :- sf_edge(X, Y).
+    sf_path(X, Z) :- sf_path(X, Y), sf_edge(Y, Z).
+    sf_count += 1 for sf_path(X, Y).
+    """
+    results = []
+    for slot_frames in (False, True):
+        system = context.SystemContext(slot_frames=slot_frames)
+        system.add_rules(program)
+        system.memoize_term(('sf_path', 2), 'null')
+        system.memoize_term(('sf_count', 0), 'null')
+        system.run_agenda()
+        system.add_rules('sf_edge(4, 5).')
+        system.run_agenda()
+        frame = Frame()
+        assert saturate(system.call_term('sf_count', 0), frame) == Terminal(1)
+        results.append(interpreter.ret_variable.getValue(frame))
+    assert results == [10, 10]
+
+    # the deltas still find the reads of the body after it is numbered again
+    # for a new rule of the memoized term
+    results = []
+    for slot_frames in (False, True):
+        system = context.SystemContext(slot_frames=slot_frames)
+        system.add_rules('sf_c(1) = 1. sf_c(2) = 2. sf_s += sf_c(X).')
+        system.memoize_term(('sf_c', 1), 'null')
+        system.memoize_term(('sf_s', 0), 'null')
+        system.run_agenda()
+        for rule in ('sf_c(3) = 3.', 'sf_s += 100.', 'sf_c(4) = 4.'):
+            system.add_rules(rule)
+            system.run_agenda()
+        frame = Frame()
+        assert saturate(system.call_term('sf_s', 0), frame) == Terminal(1)
+        results.append(interpreter.ret_variable.getValue(frame))
+    assert results == [110, 110]
+
+
+def test_incremental_optimizer():
+    rules = ' '.join(f'io_f(X) += io_g(X, {i}) * {i} for int(X).' for i in range(5))
+    results = []
+    for incremental in (False, True):
+        system = context.SystemContext(incremental_optimizer=incremental)
+        system.add_rules('io_g(X, Y) = X + Y. ' + rules)
+        system._optimize_term(('io_f', 1))
+        if incremental:
+            assert system.optimizer_counters()['optimized_branches'] == 5
+            system.optimizer_cache.reset_counters()
+
+        # only the new branch is optimized
+        system.add_rules('io_f(X) += X for int(X).')
+        system._optimize_term(('io_f', 1))
+        if incremental:
+            c = system.optimizer_counters()
+            assert c['optimized_branches'] == 1 and c['reused_branches'] == 5
+            assert 0 < c['optimized_nodes'] < c['reused_nodes']
+        system.run_agenda()
+
+        frame = Frame()
+        frame[0] = 3
+        assert saturate(system.call_term('io_f', 1), frame) == Terminal(1)
+        results.append(interpreter.ret_variable.getValue(frame))
+    assert results == [sum((3 + i) * i for i in range(5)) + 3] * 2
+
+    # a recursive term is optimized as a whole, as its branches inline each other
+    from dyna.exceptions import DynaSolverUnLoopable
+    for incremental in (False, True):
+        system = context.SystemContext(incremental_optimizer=incremental)
+        system.add_rules('io_fib(0) = 0. io_fib(1) = 1. io_fib(X) = io_fib(X-1) + io_fib(X-2) for X > 1.')
+        system.add_rules('io_fib(2) = 99.')
+        system.optimize_system()
+        system.run_agenda()
+        frame = Frame()
+        frame[0] = 3
+        with pytest.raises(DynaSolverUnLoopable):
+            saturate(system.call_term('io_fib', 1), frame)
+
+
+def test_assumption_pruning():
+    import gc
+    from dyna.guards import Assumption, AssumptionListener, AssumptionResponse
+
+    class Table:
+        def __init__(self):
+            self.msgs = []
+        def signal(self, msg):
+            self.msgs.append(msg)
+        def invalidate(self):
+            pass
+
+    a = Assumption('test')
+    fired = []
+    response = AssumptionResponse(lambda: fired.append(1))
+    a.track(response)
+    t1, t2 = Table(), Table()
+    l1, l2 = AssumptionListener(t1), AssumptionListener(t2)
+    a.track(l1)
+    a.track(l2)
+    assert a.fan_out() == 3
+
+    # the response has fired, so it would fail if it was signaled
+    response.invalidate()
+    a.signal('msg')
+    assert fired == [1] and t1.msgs == ['msg'] and t2.msgs == ['msg']
+    assert a.fan_out() == 2
+
+    # a listener that is dropped is removed, and one which was invalidated is not signaled
+    del l1
+    gc.collect()
+    l2.invalidate()
+    a.signal('msg2')
+    assert t2.msgs == ['msg'] and a.fan_out() == 0
+
+    # memo tables which are replaced are not kept by the memo tables they read from
+    system = context.SystemContext()
+    system.add_rules('ap_f(0) = 0. ap_f(1) = 1. ap_g(X) += ap_f(Y) for int(X), X < 3.')
+    system.memoize_term(('ap_f', 1), 'null')
+    for _ in range(10):
+        system.memoize_term(('ap_g', 1), 'unk')
+        frame = Frame()
+        frame[0] = 1
+        saturate(system.call_term('ap_g', 1), frame)
+    gc.collect()
+    f_assumption = system.memo_containers(('ap_f', 1))[0].assumption
+    assert f_assumption.fan_out() <= 2
+    assert system.assumption_fan_out()[f_assumption] == f_assumption.fan_out()
+
+
+def test_signal_routing():
+    from dyna.guards import Assumption
+
+    class Reciever:
+        def __init__(self):
+            self.msgs = []
+        def signal(self, msg):
+            self.msgs.append(msg.key)
+        def isValid(self):
+            return True
+
+    class Msg:
+        def __init__(self, key):
+            self.key = key
+
+    a = Assumption('test')
+    r_all, r_3, r_both = Reciever(), Reciever(), Reciever()
+    a.track(r_all)
+    a.track(r_3, [(None, 3, None)])
+    a.track(r_both, [(None, 3, None), (1, None, None)])
+    for key in [(1, 3, 5), (2, 3, None), (1, 4, 1), (2, 4, 2), (None, 4, None)]:
+        a.signal(Msg(key))
+    assert len(r_all.msgs) == 5
+    assert r_3.msgs == [(1, 3, 5), (2, 3, None)]
+    assert r_both.msgs == [(1, 3, 5), (2, 3, None), (1, 4, 1), (None, 4, None)]  # only once for (1, 3, 5)
+    assert a.fan_out() == 3
+
+    # the memo tables only get the signals for the keys of the upstream table that they read
+    system = context.SystemContext()
+    system.add_rules('sr_base(0) += 1. sr_base(1) += 2.')
+    system.add_rules('sr_src(I, J) += sr_base(I) + J for range(J, 0, 3).')
+    system.add_rules(' '.join(f'sr_c{j}(I) += sr_src(I, {j}) * 2.' for j in range(3)))
+    for name in [('sr_base', 1), ('sr_src', 2)] + [(f'sr_c{j}', 1) for j in range(3)]:
+        system.memoize_term(name, 'null')
+    system.run_agenda()
+
+    signals = []
+    for j in range(3):
+        table = system.memo_containers((f'sr_c{j}', 1))[0]
+        def counting_signal(msg, orig=table.signal, j=j):
+            signals.append((j, msg.key))
+            return orig(msg)
+        table.signal = counting_signal
+
+    system.add_rules('sr_base(1) += 10.')
+    system.run_agenda()
+    assert sorted(j for j, key in signals) == [0, 1, 2]
+    assert all(key[1] == j for j, key in signals)
+
+    for j in range(3):
+        frame = Frame()
+        frame[0] = 1
+        assert saturate(system.call_term(f'sr_c{j}', 1), frame) == Terminal(1)
+        assert interpreter.ret_variable.getValue(frame) == (12 + j) * 2
@@ -71,3 +71,135 @@ def test_python_api():
     assert api.call('cnt_table2') == 2
 
     assert api.call('table2(8)') is opd
+
+
+def test_python_api_iteration():
+    import threading
+    from dyna.interpreter import iter_loop, loop, Frame, saturate
+
+    api = DynaAPI("""
+    it_r(X) = X * 2 for range(X, 0, 1000).
+    it_pair(X, Y) = X + Y for range(X, 0, 3), range(Y, 0, 2).
+    """)
+
+    threads = threading.active_count()
+    r = api.make_call('it_r(%)')
+    assert dict(r) == {(x,): x * 2 for x in range(1000)}
+    assert r.to_dict() == dict(r)
+    out = []
+    r.callback(out.append)
+    assert sorted(out) == sorted(r)
+
+    # abandoning the iteration does not leave anything running
+    it = iter(r)
+    assert next(it)[1] % 2 == 0
+    del it
+    assert threading.active_count() == threads
+
+    assert sorted(api.make_call('it_pair(%,%)')) == sorted(((x, y), x + y) for x in range(3) for y in range(2))
+
+    # the generator yields the same as the callback version of loop
+    call = api._system.call_term('it_pair', 2)
+    frame = Frame()
+    R = saturate(call, frame)
+    expected = []
+    loop(R, frame, lambda rr, ff: expected.append((rr, dict(ff))), best_effort=True)
+    assert [(rr, dict(ff)) for rr, ff in iter_loop(R, frame, best_effort=True)] == expected
+    assert len(expected) == 6 and 0 not in frame and 1 not in frame  # rolled back after the loop
+
+
+def test_python_api_load_twice_memoized():
+    # the memo table of a memoized term of facts must not share the storage of
+    # the facts, which is extended in place by the second load
+    api = DynaAPI("""
+    ldm_deg(X) += 1 for ldm_edge(X, Y).
+    """)
+    system = api._system
+    system.load_facts('ldm_edge', 2, [(1, 2), (1, 3), (2, 3)])
+    system.memoize_term(('ldm_edge', 2), 'null')
+    system.memoize_term(('ldm_deg', 1), 'null')
+    assert api.call('ldm_deg(1)') == 2
+    system.load_facts('ldm_edge', 2, [(1, 4), (2, 4)])
+    assert api.call('ldm_deg(1)') == 3 and api.call('ldm_deg(2)') == 2
+    assert sorted(api.make_call('ldm_edge(%,%)')) == [((1, 2), True), ((1, 3), True), ((1, 4), True), ((2, 3), True), ((2, 4), True)]
+
+
+def test_python_api_load(tmp_path):
+    import numpy as np
+
+    api = DynaAPI("""
+    ld_total += ld_table(X, Y) for X > 0.
+    """)
+    t = api.table('ld_table', 2)
+    assert t.load([(1, 2, 10), (2, 3, 20)]) == 2
+    t[1, 2] = 30  # a later value overrides the loaded value
+    assert t.to_dict() == {(1, 2): 30, (2, 3): 20}
+    t.load({(1, 2): 40, (0, 0): 5})
+    assert t.to_dict() == {(1, 2): 40, (2, 3): 20, (0, 0): 5}
+    t.load(np.array([[5, 6, 7], [5, 6, 8]]))  # the later row wins
+    assert t[5, 6] == 8
+    assert api.call('ld_total') == 68
+
+    api.add_rules("""
+    ld_edge(0, 1).
+    ld_path(X, Y) :- ld_edge(X, Y).
+    ld_path(X, Z) :- ld_path(X, Y), ld_edge(Y, Z).
+    ld_reach(Y) :- ld_path(0, Y).
+    """)
+    system = api._system
+    system.memoize_term(('ld_path', 2), 'null')
+    system.run_agenda()
+    assert sorted(api.make_call('ld_reach(%)')) == [((1,), True)]
+
+    assert system.load_facts('ld_edge', 2, np.array([[1, 2], [2, 3], [2, 3]])) == 2  # duplicates are removed
+    api.add_rules('ld_edge(3, 4).')
+
+    f = tmp_path / 'edges.csv'
+    f.write_text('4,5\n5,end\n')
+    api.add_rules(f'$load_csv("{f}", &ld_edge).')
+    assert sorted(map(repr, api.make_call('ld_reach(%)'))) == sorted(repr(((y,), True)) for y in [1, 2, 3, 4, 5, 'end'])
+
+
+def test_python_api_load_file(tmp_path):
+    import json
+    import numpy as np
+    from array import array
+    from dyna import fact_loading
+
+    api = DynaAPI("""
+    lf_deg(X) += 1 for lf_edge(X, Y).
+    lf_total += lf_weight(X, Y).
+    """)
+    system = api._system
+
+    f = tmp_path / 'edges.csv'
+    f.write_text('src,dst\n' + ''.join(f'{i % 7},{i}\n' for i in range(100)) + '1,1.5\n1,x\n0,0\n')
+    # the types of the columns are inferred, and change when a later chunk does not parse
+    chunks = list(fact_loading.iter_csv_columns(f, header=True, chunk_rows=40))
+    assert [len(c[0]) for c in chunks] == [40, 40, 23]
+    assert type(chunks[0][1]) is array and chunks[-1][1][-3:] == [1.5, 'x', 0]
+    with pytest.raises(ValueError):
+        list(fact_loading.iter_csv_columns(f, types=('int', 'int'), header=True))
+
+    assert system.load_file(str(f), 'lf_edge', header=True, chunk_rows=16) == 102  # 0,0 is in the file twice
+    system.memoize_term(('lf_edge', 2), 'null')
+    system.memoize_term(('lf_deg', 1), 'null')
+    assert api.call('lf_deg(1)') == 17
+
+    # the memo table of lf_edge is updated when more rows are loaded
+    f = tmp_path / 'edges.npy'
+    np.save(f, np.array([[1, 200], [2, 201], [1, 200]]))
+    api.add_rules(f'$load_npy("{f}", &lf_edge).')
+    assert api.call('lf_deg(1)') == 18 and api.call('lf_deg(2)') == 15
+
+    f = tmp_path / 'weights.ndjson'
+    f.write_text('\n'.join(json.dumps({'a': i, 'b': [i, 'x'], 'w': i * .5}) for i in range(5)))
+    assert system.load_file(str(f), 'lf_weight', aggregator='=', chunk_rows=2) == 5
+    assert api.call('lf_weight(3, [3, "x"])') == 1.5
+    assert api.call('lf_total') == 5.0
+
+    # rows are compared by their values, so 0.0 and -0.0 are the same row
+    f = tmp_path / 'zeros.npy'
+    np.save(f, np.array([[0.0, 1.0], [-0.0, 1.0], [2.0, 3.0]]))
+    assert system.load_file(str(f), 'lf_zero') == 2
+    assert fact_loading._unique_rows([array('d', [0.0, -0.0]), array('q', [1, 1])]) == [array('d', [0.0]), array('q', [1])]